@@ -32,6 +32,12 @@ from ib_async.contract import Stock, Option
 from ib_async.ib import IB
 from ib_async import *
 
+# conId de acciones y opciones ya cualificadas hoy (sin una petición por contrato)
+from contratos import cache_contratos
+
+# varias conexiones de market data: los snapshots de OI se reparten entre ellas
+from conexiones import PoolConexiones, TIPO_MERCADO
+
 
 # =========================================================
 #                    CONFIGURACIÓN
@@ -40,6 +46,7 @@ from ib_async import *
 TWS_HOST = "127.0.0.1"
 TWS_PORT = 7496
 CLIENT_ID = 19
+CLIENT_IDS = [CLIENT_ID, CLIENT_ID + 1]     # conexiones de market data del pool (conexiones.py)
 MARKET_DATA_TYPE = 1
 
 EXCEL_FILE = "open_interest.xlsx"
@@ -242,7 +249,7 @@ def on_error(reqId, errorCode, errorString, contract):
 
 async def get_spot_price(ib, symbol):
     stk = Stock(symbol, "SMART", "USD")
-    await ib.qualifyContractsAsync(stk)
+    await cache_contratos.cualificar_async(ib, stk)
     ib.reqMarketDataType(MARKET_DATA_TYPE)
     t = ib.reqMktData(stk, "", False, False)
     await asyncio.sleep(2)
@@ -262,8 +269,8 @@ async def filtra_strikes_validos(ib: IB, symbol: str, expiration: str,
     for k in strikes:
         opt = Option(symbol=symbol, lastTradeDateOrContractMonth=expiration,
                          strike=float(k), right=right, exchange=exchange, currency="USD")
-        cds = await ib.reqContractDetailsAsync(opt)
-        if cds:  # si hay al menos un ContractDetails, el contrato existe
+        # si hay al menos un ContractDetails, el contrato existe (la caché recuerda también los que no)
+        if await cache_contratos.existe_async(ib, opt):
             validos.append(float(k))
 
     return validos
@@ -346,11 +353,12 @@ def pick_equity_option_chain(params, ticker, prefer_smart=True):
 
 
 
-async def collect_chain(ib: IB, symbol: str, expiry: str, spot_price: float, queue: asyncio.Queue):
+async def collect_chain(pool: PoolConexiones, symbol: str, expiry: str, spot_price: float, queue: asyncio.Queue):
     print(f"[CHAIN] {symbol} {expiry}")
+    ib = pool.ib(TIPO_MERCADO)
 
     stk = Stock(symbol, "SMART", "USD")
-    await ib.qualifyContractsAsync(stk)
+    await cache_contratos.cualificar_async(ib, stk)
 
     print("Solicitamos parámetros de opciones...")
 
@@ -425,7 +433,7 @@ async def collect_chain(ib: IB, symbol: str, expiry: str, spot_price: float, que
             return float(x.strip())
         raise TypeError(f"Strike inválido: {x!r}")
 
-    tasks = []
+    opciones = []
     for right, lista_8 in mis_strikes:
         if right not in ("C", "P"):
             print("Right desconocido; lo salto:", right)
@@ -439,51 +447,56 @@ async def collect_chain(ib: IB, symbol: str, expiry: str, spot_price: float, que
                 print("Descarto strike:", s, e)
                 continue
 
-            opt = Option(symbol=symbol, lastTradeDateOrContractMonth=expiry,
-                         strike=k, right=right, exchange="SMART", currency="USD")
-            tasks.append(asyncio.create_task(fetch_option_oi(ib, opt, queue)))
+            opciones.append(Option(symbol=symbol, lastTradeDateOrContractMonth=expiry,
+                                   strike=k, right=right, exchange="SMART", currency="USD"))
+
+    # las que no estén en la caché de hoy se cualifican en un solo lote
+    await cache_contratos.cualificar_async(ib, *opciones)
+    tasks = [asyncio.create_task(fetch_option_oi(pool, opt, queue)) for opt in opciones]
 
     results = await asyncio.gather(*tasks, return_exceptions=True)
 
 
 
-async def fetch_option_oi(ib: IB, opt: Option, queue: asyncio.Queue):
+async def fetch_option_oi(pool: PoolConexiones, opt: Option, queue: asyncio.Queue):
 
     #print ("Buscando opción ......")
     #print (opt)
 
     try:
-        [optp]= await ib.qualifyContractsAsync(opt)
-        ib.reqMarketDataType(MARKET_DATA_TYPE)
+        # la conexión de mercado menos cargada; cuenta como ocupada mientras dura el snapshot
+        with pool.usar(TIPO_MERCADO) as ib:
+            [optp]= await cache_contratos.cualificar_async(ib, opt)
+            ib.reqMarketDataType(MARKET_DATA_TYPE)
 
-        ticker = ib.reqMktData(optp, '101', False, False)
-        await asyncio.sleep(4.5)
+            ticker = ib.reqMktData(optp, '101', False, False)
+            await asyncio.sleep(4.5)
 
-        if opt.right == "C":
-            openint= ticker.callOpenInterest
-        else:
-            openint= ticker.putOpenInterest
+            if opt.right == "C":
+                openint= ticker.callOpenInterest
+            else:
+                openint= ticker.putOpenInterest
 
-        row = {
-            #"date": date.today().isoformat(),
-            "date": (datetime.now(LOCAL_TZ) - timedelta(hours=6)).date().isoformat(),
-            "symbol": opt.symbol,
-            "expiry": opt.lastTradeDateOrContractMonth,
-            "right": opt.right,
-            "strike": opt.strike,
-            "conId": opt.conId,
-            "local_symbol": opt.localSymbol,
-            "open_interest": openint,
-            "last": ticker.last,
-            "inserted_at": (datetime.now(LOCAL_TZ) - timedelta(hours=6)).date().isoformat()
-        }
+            row = {
+                #"date": date.today().isoformat(),
+                "date": (datetime.now(LOCAL_TZ) - timedelta(hours=6)).date().isoformat(),
+                "symbol": opt.symbol,
+                "expiry": opt.lastTradeDateOrContractMonth,
+                "right": opt.right,
+                "strike": opt.strike,
+                "conId": opt.conId,
+                "local_symbol": opt.localSymbol,
+                "open_interest": openint,
+                "last": ticker.last,
+                "inserted_at": (datetime.now(LOCAL_TZ) - timedelta(hours=6)).date().isoformat()
+            }
 
-        #print (f"Encolamos: {row}")
-        #print ("Encolamos ..")
+            #print (f"Encolamos: {row}")
+            #print ("Encolamos ..")
 
-        await queue.put(row)
+            await queue.put(row)
 
-        ib.cancelMktData(opt)
+            ib.cancelMktData(opt)
 
     except Exception as e:
         print(f"[ERROR] {opt.symbol} {opt.strike}{opt.right}", e)
@@ -526,11 +539,13 @@ async def worker_excel(queue: asyncio.Queue):
 async def main():
     print("Inicio recolección OI:", datetime.now(LOCAL_TZ))
 
-    ib = IB()
-    await ib.connectAsync(TWS_HOST, TWS_PORT, clientId=CLIENT_ID)
-    print("Conectado a IB:", ib.isConnected())
+    pool = PoolConexiones({TIPO_MERCADO: CLIENT_IDS}, TWS_HOST, TWS_PORT, fabrica=IB)
+    await pool.conectar_async()
+    print("Conectado a IB:", pool.resumen())
 
-    ib.errorEvent += on_error
+    pool.suscribir("errorEvent", on_error)
+    vigilancia = asyncio.create_task(pool.vigilar_async())
+    cache_contratos.abrir()
 
     queue = asyncio.Queue()
     asyncio.create_task(worker_excel(queue))
@@ -543,11 +558,11 @@ async def main():
 
 
     for symbol, expiries in symbols_dict.items():
-        spot = await get_spot_price(ib, symbol)
+        spot = await get_spot_price(pool.ib(TIPO_MERCADO), symbol)
         print(f"[SPOT] {symbol} = {spot}")
 
         for expiry in expiries:
-            await collect_chain(ib, symbol, expiry, spot, queue)
+            await collect_chain(pool, symbol, expiry, spot, queue)
 
     # ---------------------------------------------------
     # 🔥 FLUSH FINAL REAL DEL WORKER EXCEL
@@ -558,8 +573,10 @@ async def main():
     while not queue.empty():
         await asyncio.sleep(1)
 
-    print("Finalizado.")
-    ib.disconnect()
+    print("Finalizado.", cache_contratos.resumen())
+    cache_contratos.close()
+    vigilancia.cancel()
+    pool.desconectar()
 
 
 if __name__ == "__main__":
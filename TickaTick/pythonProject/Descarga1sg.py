@@ -4,7 +4,7 @@ Este script descarga datos en barras en 1sg de Interactivebrokers.
 Características principales del script:
 
 1.- Un directorio por activo (ejemplo: ./data/AAPL/).
-2.- Un fichero XLS por cada sesión de Wall Street (ejemplo: 2025-09-25.xls).
+2.- Un fichero por cada sesión de Wall Street (ejemplo: 2025-09-25.parquet). XLSX queda como exportación opcional (ver almacen.py).
 3.- La primera vez que se ejecuta para un activo:
     Crea el directorio si no existe.
     Intentará bajar el máximo histórico permitido
@@ -22,7 +22,6 @@ Ajusta TICKERS, OUTPUT_ROOT, INIT_DAYS_BACK según necesites.
 """
 
 import os
-import time
 from datetime import datetime, timedelta, time as dtime
 import pytz
 import pandas as pd
@@ -31,6 +30,15 @@ from ib_insync import IB, Stock, Future
 import logging
 from logging.handlers import TimedRotatingFileHandler
 
+# Guardado/lectura de sesiones (parquet por defecto, XLSX opcional)
+from almacen import save_session_df, list_downloaded_dates
+
+# Pacing compartido con el resto de descargadores (sustituye a los sleeps fijos)
+from pacing import gobernador, clave_contrato
+
+# Festivos y cierres anticipados de NYSE
+from calendario import calendario
+
 
 
 # ----------------------------
@@ -44,6 +52,7 @@ INIT_DAYS_BACK = 5                  # si no existe historial, intentamos éste n
 IB_HOST = "127.0.0.1"
 IB_PORT = 7496
 IB_CLIENTID = 1
+REINTENTOS_BLOQUE = 3               # intentos por bloque; después el bloque queda sin datos
 
 # Timezone / horario mercado
 NY_TZ = pytz.timezone("America/New_York")
@@ -94,6 +103,8 @@ def connect_ib():
         raise
     if not ib.isConnected():
         raise RuntimeError("❌ No se pudo establecer conexión con TWS/Gateway")
+    # Los errores de pacing (162/420) activan el backoff del gobernador
+    ib.errorEvent += gobernador.on_error
     print("✅ Conectado a IB")
     return ib
 
@@ -102,40 +113,15 @@ def ensure_symbol_dir(symbol):
     os.makedirs(d, exist_ok=True)
     return d
 
-def list_downloaded_dates(symbol_dir):
-    """Devuelve set de fechas descargadas en formato date (YYYY-MM-DD.xlsx)"""
-    if not os.path.exists(symbol_dir):
-        return set()
-    names = os.listdir(symbol_dir)
-    dates = set()
-    for n in names:
-        # aceptar .xlsx o .xls
-        if n.lower().endswith(".xlsx") or n.lower().endswith(".xls"):
-            base = os.path.splitext(n)[0]
-            try:
-                dt = datetime.strptime(base, "%Y-%m-%d").date()
-                dates.add(dt)
-            except Exception:
-                continue
-    return dates
-
 def is_market_open(now=None):
-    """True si ahora (NY) está entre 9:30 y 16:00 (sesión regular)."""
-    now = now or datetime.now(pytz.utc).astimezone(NY_TZ)
-    tod = now.time()
-    return (tod >= SESSION_OPEN) and (tod <= SESSION_CLOSE) and (now.weekday() < 5)
+    """True si ahora está dentro de la sesión de NYSE (festivos y medias sesiones incluidos)."""
+    return calendario().abierto(now)
 
 def next_business_day(date):
-    d = date + timedelta(days=1)
-    while d.weekday() >= 5:
-        d += timedelta(days=1)
-    return d
+    return calendario().siguiente(date)
 
 def prev_business_day(date):
-    d = date - timedelta(days=1)
-    while d.weekday() >= 5:
-        d -= timedelta(days=1)
-    return d
+    return calendario().anterior(date)
 
 # Helper robusto para extraer campos de ticks (bid/ask)
 def _get_attr(obj, names):
@@ -364,12 +350,16 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
     rows = []
     block_start = start_utc
     iteration = 0
+    fallos = 0
 
     while block_start < end_utc:
         iteration += 1
         block_end = min(block_start + timedelta(minutes=30), end_utc)
         logger.debug(f"Iteración {iteration}: {block_start} → {block_end}")
 
+        gobernador.adquirir(clave_contrato(contract, WHAT_TO_SHOW),
+                            firma=(contract.conId, WHAT_TO_SHOW, block_end, "1800 S", "1 secs"))
+        marca = gobernador.marca()
         try:
             bars = ib.reqHistoricalData(
                 contract,
@@ -382,9 +372,19 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
                 keepUpToDate=False
             )
             logger.debug(f"Recibidas {len(bars)} barras de 1s en iter {iteration}")
+            # [] tras un error de IB (p.ej. pacing) es un fallo, no un bloque sin datos
+            gobernador.verificar_respuesta(marca, contract, bars)
+            gobernador.notificar_exito()
+            fallos = 0
         except Exception as e:
-            logger.error(f"⚠️ reqHistoricalData fallo en iter {iteration}: {e}")
-            time.sleep(1.0)
+            fallos += 1
+            logger.error(f"⚠️ reqHistoricalData fallo en iter {iteration} ({fallos}/{REINTENTOS_BLOQUE}): {e}")
+            if fallos < REINTENTOS_BLOQUE:
+                # el reintento espera en el gobernador (regla de petición idéntica / backoff)
+                continue
+            logger.error(f"⚠️ Bloque {block_start} → {block_end} abandonado tras {fallos} intentos")
+            fallos = 0
+            block_start = block_end
             continue
 
         if not bars:
@@ -412,7 +412,6 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
             })
 
         block_start = block_end
-        time.sleep(2)
 
     if rows:
         df = pd.DataFrame(rows)
@@ -424,40 +423,6 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
 
 
 
-# ----------------------------
-# GUARDADO por DÍA (XLSX)
-# ----------------------------
-def save_session_df(symbol_dir, date_obj, df):
-    """
-    Guarda dataframe de sesión en symbol_dir/YYYY-MM-DD.xlsx
-    Convierte time a tz-naive UTC antes de escribir y crea formato de columna.
-    """
-    from openpyxl import load_workbook
-
-    filename = os.path.join(symbol_dir, f"{date_obj.strftime('%Y-%m-%d')}.xlsx")
-    if df.empty:
-        print(f"    (vacío) No se guarda {filename}")
-        return
-
-    # convertir time tz-aware UTC -> tz-naive (Excel no acepta tz-aware)
-    df_to_write = df.copy()
-    df_to_write["time"] = pd.to_datetime(df_to_write["time"]).dt.tz_convert(pytz.utc).dt.tz_localize(None)
-
-    # Guardar con pandas (openpyxl) y luego aplicar formato a columna A
-    df_to_write.to_excel(filename, index=False)
-
-    # Formatear la columna A como datetime 'yyyy-mm-dd hh:mm:ss' usando openpyxl
-    try:
-        wb = load_workbook(filename)
-        ws = wb.active
-        for cell in ws["A"][2:]:  # saltar encabezado (fila 1)
-            cell.number_format = "yyyy-mm-dd hh:mm:ss"
-        wb.save(filename)
-    except Exception as e:
-        print(f"    ⚠️ No se pudo aplicar formato a {filename}: {e}")
-
-    print(f"    💾 Guardado {filename} ({len(df)} filas)")
-
 # ----------------------------
 # LÓGICA PRINCIPAL
 # ----------------------------
@@ -479,15 +444,8 @@ def main():
             end_date = today_ny
             if market_open_now:
                 end_date = prev_business_day(today_ny)  # no descargar sesión en curso
-            # retroceder hasta obtener INIT_DAYS_BACK business days
-            start_date = end_date
-            days_added = 0
-            while days_added < INIT_DAYS_BACK:
-                if start_date.weekday() < 5:
-                    days_added += 1
-                start_date -= timedelta(days=1)
-            # after loop start_date is 1 day earlier than needed
-            start_date = next_business_day(start_date)
+            # retroceder hasta obtener INIT_DAYS_BACK sesiones (sin fines de semana ni festivos)
+            start_date = calendario().retroceder(end_date, INIT_DAYS_BACK)
         else:
             last = max(downloaded)
             start_date = next_business_day(last)
@@ -513,7 +471,7 @@ def main():
 
         d = start_date
         while d <= end_date:
-            if d.weekday() >= 5:
+            if not calendario().es_habil(d):
                 d = next_business_day(d)
                 continue
             if d in downloaded:
@@ -522,13 +480,11 @@ def main():
                 continue
 
             print(f"    → Descargando sesión {d}")
-            session_start = NY_TZ.localize(datetime.combine(d, SESSION_OPEN))
-            session_end = NY_TZ.localize(datetime.combine(d, SESSION_CLOSE))
+            session_start, session_end = calendario().sesion(d)  # cierre a las 13:00 en medias sesiones
             try:
                 df_day = fetch_ticks_for_session(ib, contract, session_start, session_end)
                 if not df_day.empty:
                     save_session_df(symbol_dir, d, df_day)
-                    time.sleep(80.0) #Evitar el pacing
                 else:
                     print(f"    ⚠️ No hubo ticks para {symbol} {d}")
             except Exception as e:
@@ -536,6 +492,7 @@ def main():
 
             d = next_business_day(d)
 
+    logger.info(f"Pacing: {gobernador.resumen()}")
     ib.disconnect()
     print("\n✂ Desconectado. Proceso finalizado.")
 
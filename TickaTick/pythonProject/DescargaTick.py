@@ -4,7 +4,7 @@ Este script descarga datos tick a tick de Interactivebrokers.
 Características principales del script:
 
 1.- Un directorio por activo (ejemplo: ./data/AAPL/).
-2.- Un fichero XLS por cada sesión de Wall Street (ejemplo: 2025-09-25.xls).
+2.- Un fichero por cada sesión de Wall Street (ejemplo: 2025-09-25.parquet). XLSX queda como exportación opcional (ver almacen.py).
 3.- La primera vez que se ejecuta para un activo:
     Crea el directorio si no existe.
     Intentará bajar el máximo histórico permitido
@@ -21,10 +21,15 @@ encadenando llamadas de 1000 en 1000 hasta completar la sesión,
 guardando un fichero XLSX por día en un subdirectorio por ticker.
 
 Ajusta TICKERS, OUTPUT_ROOT, INIT_DAYS_BACK según necesites.
+
+Uso:
+    python DescargaTick.py                                   # TICKERS y WHAT_TO_SHOW
+    python DescargaTick.py --tickers AAPL SPY --what-to-show Trades+Bid_Ask
 """
 
+import argparse
+import asyncio
 import os
-import time
 from datetime import datetime, timedelta, time as dtime
 import pytz
 import pandas as pd
@@ -33,6 +38,24 @@ from ib_insync import IB, Stock
 import logging
 from logging.handlers import TimedRotatingFileHandler
 
+# Guardado/lectura de sesiones (parquet por defecto, XLSX opcional)
+from almacen import save_session_df, list_downloaded_dates, StagingSesion
+
+# Conversión de páginas de ticks a columnas NumPy (sin dict por tick)
+from ingesta import ticks_to_frame, concat_frames, columnas_ticks, DedupeFrontera, FusionAsOf
+
+# Pacing compartido con el resto de descargadores (sustituye a los sleeps fijos)
+from pacing import gobernador, clave_contrato
+
+# Festivos y cierres anticipados de NYSE
+from calendario import calendario
+
+# Relleno de huecos compartido con ib_downloader (validación + plan mínimo de peticiones)
+from ib_downloader import completar_sesion
+
+# Archivo memory-map por símbolo para lecturas de meses de ticks
+from archivo_ticks import ArchivoTicks
+
 
 
 # ----------------------------
@@ -41,11 +64,15 @@ from logging.handlers import TimedRotatingFileHandler
 TICKERS = ["AAPL"]    # Lista de símbolos
 OUTPUT_ROOT = "E:/DATOSBOLSA/datatick"                # Carpeta raíz donde se crearán subdirectorios
 #WHAT_TO_SHOW = "Bid_Ask"              # Usamos Bid_Ask para reqHistoricalTicks
-WHAT_TO_SHOW = "Trades"              # Usamos Bid_Ask para reqHistoricalTicks
+WHAT_TO_SHOW = "Trades"              # por defecto; --what-to-show en la línea de comandos
+FUSION = "Trades+Bid_Ask"            # las dos a la vez: cada trade con la cotización vigente
+TIPOS_TICKS = ["Trades", "Bid_Ask", FUSION]
 INIT_DAYS_BACK = 3                  # si no existe historial, intentamos éste nº de días atrás (ajustable)
 IB_HOST = "127.0.0.1"
 IB_PORT = 7496
 IB_CLIENTID = 1
+REINTENTOS_PAGINA = 3               # intentos por página antes de cortar (el hueco se rellena después)
+ARCHIVAR_TICKS = False              # además de la sesión, anexar al archivo OUTPUT_ROOT/archivo/<SYMBOL>
 
 # Timezone / horario mercado
 NY_TZ = pytz.timezone("America/New_York")
@@ -96,6 +123,8 @@ def connect_ib():
         raise
     if not ib.isConnected():
         raise RuntimeError("❌ No se pudo establecer conexión con TWS/Gateway")
+    # Los errores de pacing (162/420) activan el backoff del gobernador
+    ib.errorEvent += gobernador.on_error
     print("✅ Conectado a IB")
     return ib
 
@@ -104,40 +133,15 @@ def ensure_symbol_dir(symbol):
     os.makedirs(d, exist_ok=True)
     return d
 
-def list_downloaded_dates(symbol_dir):
-    """Devuelve set de fechas descargadas en formato date (YYYY-MM-DD.xlsx)"""
-    if not os.path.exists(symbol_dir):
-        return set()
-    names = os.listdir(symbol_dir)
-    dates = set()
-    for n in names:
-        # aceptar .xlsx o .xls
-        if n.lower().endswith(".xlsx") or n.lower().endswith(".xls"):
-            base = os.path.splitext(n)[0]
-            try:
-                dt = datetime.strptime(base, "%Y-%m-%d").date()
-                dates.add(dt)
-            except Exception:
-                continue
-    return dates
-
 def is_market_open(now=None):
-    """True si ahora (NY) está entre 9:30 y 16:00 (sesión regular)."""
-    now = now or datetime.now(pytz.utc).astimezone(NY_TZ)
-    tod = now.time()
-    return (tod >= SESSION_OPEN) and (tod <= SESSION_CLOSE) and (now.weekday() < 5)
+    """True si ahora está dentro de la sesión de NYSE (festivos y medias sesiones incluidos)."""
+    return calendario().abierto(now)
 
 def next_business_day(date):
-    d = date + timedelta(days=1)
-    while d.weekday() >= 5:
-        d += timedelta(days=1)
-    return d
+    return calendario().siguiente(date)
 
 def prev_business_day(date):
-    d = date - timedelta(days=1)
-    while d.weekday() >= 5:
-        d -= timedelta(days=1)
-    return d
+    return calendario().anterior(date)
 
 # Helper robusto para extraer campos de ticks (bid/ask)
 def _get_attr(obj, names):
@@ -210,7 +214,7 @@ def tick_obj_to_row(tick):
 # ----------------------------
 # DESCARGA ENCadenada para UN DÍA
 # ----------------------------
-def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
+def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny, staging=None, what_to_show=None):
     """
     Descarga todos los ticks de la sesión [session_start_ny, session_end_ny] (ambos tz-aware NY)
     encadenando llamadas de 1000 en 1000 hacia atrás hasta cubrir la sesión completa.
@@ -219,21 +223,32 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
     Descarga todos los ticks de la sesión encadenando bloques de 1000 ticks hacia adelante.
     Soporta Bid_Ask y Last según WHAT_TO_SHOW
 
-
+    Si se pasa staging (StagingSesion) cada página se guarda al llegar junto con el cursor;
+    una sesión interrumpida se reanuda desde la última página completada.
+    what_to_show: "Trades" o "Bid_Ask" (por defecto WHAT_TO_SHOW).
     """
+    what_to_show = what_to_show or WHAT_TO_SHOW
     # convertir a UTC tz-aware datetimes
     start_utc = session_start_ny.astimezone(pytz.utc)
     end_utc = session_end_ny.astimezone(pytz.utc)
 
-    key= None
-    rows = []
-    seen_keys = set()  # para evitar duplicados por solapamientos entre pages
+    frames = []
+    dedupe = DedupeFrontera()  # para evitar duplicados en el segundo en que se solapan las pages
 
     #Antes current_start = start_utc
     current_end= end_utc
 
     iteration = 0
     max_time = None
+    fallos = 0
+
+    if staging is not None and staging.reanudada:
+        previos = staging.leer_bloques()
+        frames.append(previos)
+        dedupe.cargar(previos)
+        current_end = pd.Timestamp(staging.cursor).to_pydatetime()
+        iteration = len(staging.bloques_completados())
+        logger.info(f"Reanudando sesión desde {current_end} ({len(previos)} ticks en staging)")
 
     while current_end >= start_utc:
         iteration += 1
@@ -242,9 +257,13 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
         #Antes end_str = end_utc.strftime("%Y%m%d %H:%M:%S")
 
         end_str = current_end.strftime("%Y%m%d %H:%M:%S")
+        clave_pagina = current_end.isoformat()  # end_str puede repetirse dentro del mismo segundo
 
         logger.debug(f"Iteración {iteration} tiempo a pedir: {end_str}")
 
+        gobernador.adquirir(clave_contrato(contract, what_to_show),
+                            firma=(contract.conId, what_to_show, current_end, 1000))
+        marca = gobernador.marca()
         try:
             ticks = ib.reqHistoricalTicks(
                 contract,
@@ -252,16 +271,23 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
                 startDateTime="",
                 endDateTime=current_end, # end_str,
                 numberOfTicks=1000,
-                whatToShow=WHAT_TO_SHOW,
+                whatToShow=what_to_show,
                 useRth=True,
                 ignoreSize=False
             )
             logger.debug(f"Recibidos {len(ticks)} ticks en iter {iteration} ({start_utc} → {end_str})")
+            # [] tras un error de IB es un fallo de la petición, no el final de la sesión
+            gobernador.verificar_respuesta(marca, contract, ticks)
+            gobernador.notificar_exito()
+            fallos = 0
         except Exception as e:
+            fallos += 1
             print(f"    ⚠️ reqHistoricalTicks fallo en iter {iteration} hasta {end_str}: {e}")
             logger.exception(f"⚠️ reqHistoricalTicks fallo en iter {iteration} hasta {end_str}")
-            # si falla por pacing, esperar y reintentar
-            time.sleep(1.0)
+            if fallos >= REINTENTOS_PAGINA:
+                # lo que falta hasta start_utc queda como hueco: lo rellena completar_sesion
+                break
+            # si falla por pacing, el gobernador hace esperar al reintento
             continue
 
         if not ticks:
@@ -277,117 +303,157 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
 
         # convertir y filtrar por >0 start-utc Usar dedupe por key compuesto para evitar duplicados entre páginas
 
-        block_rows = []
-        block_times = []
-
-        for t in ticks:
-            row = tick_obj_to_row(t)
-            if row is None:
-                continue
-
-            ttime = row["time"] #tz-aware UTC
-            logger.debug (f"tiempo tick: {ttime}")
-            # filtrar fuera de sesión (anterior al inicio)
-            if ttime < start_utc or ttime > end_utc:
-                logger.info("Fuera de sesión")
-                continue
-
-            if "bid" in row:  # estamos en Bid_Ask
-                key = (
-                    ttime.isoformat(),
-                    row.get("bid"),
-                    row.get("ask"),
-                    row.get("bid_size"),
-                    row.get("ask_size")
-                )
-            elif "price" in row:  # estamos en Trades/Last
-                key = (
-                    ttime.isoformat(),
-                    row.get("price"),
-                    row.get("size")
-                )
-            else:  # fallback genérico
-                key = tuple(row.items())
-
-
-
-            if key in seen_keys:
-                continue
+        # página entera a columnas (filtra fuera de sesión); la zona horaria se resuelve una vez
+        page = ticks_to_frame(ticks, what_to_show, start_utc, end_utc)
+        if len(page) < len(ticks):
+            logger.debug(f"Fuera de sesión: {len(ticks) - len(page)} ticks")
 
-            logger.debug(f"Key generada: {key}")
-            seen_keys.add(key)
-            block_rows.append(row)
-            block_times.append(ttime)
-            #logger.debug(f"Append block_times: {ttime}")
+        block = dedupe.filtrar(page)
 
-        if block_rows:
-            rows.extend(block_rows)
-
-        if not block_rows:
-            break
+        if block.empty:
+            if page.empty or len(ticks) < 1000:
+                break
+            # la página entera es el segundo frontera ya visto (>= 1000 ticks en ese segundo):
+            # IB sólo entiende segundos, así que se sigue desde el anterior en vez de cortar la sesión
+            logger.warning(f"⚠️ Página completa en el segundo de {current_end}: se sigue desde el anterior")
+            current_end -= timedelta(seconds=1)
+            continue
+        frames.append(block)
 
-        # retroceder el end actual justo antes del tick más antiguo del bloque
-        earliest = min(block_times)
+        # la siguiente page termina en el tick más antiguo del bloque: se solapa en ese segundo
+        # (dedupe lo resuelve) en vez de saltarse el resto del segundo con -1s
+        earliest = block["time"].min().to_pydatetime()
         logger.debug(f"El earliest: {earliest}")
-        current_end = earliest - timedelta(seconds=1)  # IB solo entiende segundos
+        current_end = earliest if earliest < current_end else current_end - timedelta(seconds=1)
 
-        time.sleep(0.2)
+        if staging is not None:
+            staging.guardar_bloque(clave_pagina, block, cursor=current_end.isoformat())
 
     logger.debug(f"valor current_end: {current_end}")
     # al final, ordenar todos los ticks ascendentemente por tiempo
-    if rows:
-        df = pd.DataFrame(rows)
-        df.sort_values("time", inplace=True)
-        df["time"] = pd.to_datetime(df["time"]).dt.tz_convert(pytz.utc)
-    else:
-        df = pd.DataFrame(columns=["time", "bid", "bid_size", "ask", "ask_size", "midpoint"])
-
-    return df
+    return concat_frames(frames, columnas_ticks(what_to_show))
 
 # ----------------------------
-# GUARDADO por DÍA (XLSX)
+# TRADES + BID_ASK A LA VEZ
 # ----------------------------
-def save_session_df(symbol_dir, date_obj, df):
+async def _cadena_ticks(ib, contract, start_utc, end_utc, what_to_show, flujo, fusion, salida, avance):
     """
-    Guarda dataframe de sesión en symbol_dir/YYYY-MM-DD.xlsx
-    Convierte time a tz-naive UTC antes de escribir y crea formato de columna.
+    Una de las dos cadenas de páginas hacia atrás de fetch_ticks_fusionados. Cada página va a
+    la fusión en cuanto llega; si este flujo va muy por delante del otro, espera (avance).
+    Si una página agota REINTENTOS_PAGINA lanza RuntimeError: una cadena cortada no se da por
+    completa (la fusión emparejaría los trades con cotizaciones de otro momento).
     """
-    from openpyxl import load_workbook
-
-    filename = os.path.join(symbol_dir, f"{date_obj.strftime('%Y-%m-%d')}.xlsx")
-    if df.empty:
-        print(f"    (vacío) No se guarda {filename}")
-        return
+    dedupe = DedupeFrontera()
+    current_end = end_utc
+    fallos = 0
+    while current_end >= start_utc and fusion.necesita(flujo):
+        while not fusion.puede_pedir(flujo):
+            avance.clear()
+            await avance.wait()
+
+        await gobernador.adquirir_async(clave_contrato(contract, what_to_show),
+                                        firma=(contract.conId, what_to_show, current_end, 1000))
+        marca = gobernador.marca()
+        try:
+            ticks = await ib.reqHistoricalTicksAsync(
+                contract,
+                startDateTime="",
+                endDateTime=current_end,
+                numberOfTicks=1000,
+                whatToShow=what_to_show,
+                useRth=True,
+                ignoreSize=False
+            )
+            gobernador.verificar_respuesta(marca, contract, ticks)
+            gobernador.notificar_exito()
+            fallos = 0
+        except Exception as e:
+            fallos += 1
+            logger.exception(f"⚠️ reqHistoricalTicksAsync {what_to_show} fallo hasta {current_end}")
+            if fallos >= REINTENTOS_PAGINA:
+                raise RuntimeError(f"{what_to_show} hasta {current_end} sin datos tras "
+                                   f"{REINTENTOS_PAGINA} intentos: {e}") from e
+            continue
 
-    # convertir time tz-aware UTC -> tz-naive (Excel no acepta tz-aware)
-    df_to_write = df.copy()
-    df_to_write["time"] = pd.to_datetime(df_to_write["time"]).dt.tz_convert(pytz.utc).dt.tz_localize(None)
+        if not ticks:
+            break
+        page = ticks_to_frame(ticks, what_to_show, start_utc, end_utc)
+        block = dedupe.filtrar(page)
+        if block.empty:
+            if page.empty or len(ticks) < 1000:
+                break
+            # página entera del segundo frontera ya visto: seguir desde el segundo anterior
+            current_end -= timedelta(seconds=1)
+            continue
+        salida.append(fusion.anadir(flujo, block))
+        avance.set()
 
-    # Guardar con pandas (openpyxl) y luego aplicar formato a columna A
-    df_to_write.to_excel(filename, index=False)
+        earliest = block["time"].min().to_pydatetime()
+        current_end = earliest if earliest < current_end else current_end - timedelta(seconds=1)
 
-    # Formatear la columna A como datetime 'yyyy-mm-dd hh:mm:ss' usando openpyxl
-    try:
-        wb = load_workbook(filename)
-        ws = wb.active
-        for cell in ws["A"][2:]:  # saltar encabezado (fila 1)
-            cell.number_format = "yyyy-mm-dd hh:mm:ss"
-        wb.save(filename)
-    except Exception as e:
-        print(f"    ⚠️ No se pudo aplicar formato a {filename}: {e}")
+    salida.append(fusion.terminar(flujo))
+    avance.set()
 
-    print(f"    💾 Guardado {filename} ({len(df)} filas)")
+def fetch_ticks_fusionados(ib, contract, session_start_ny, session_end_ny):
+    """
+    Pide Trades y Bid_Ask de la misma sesión a la vez (dos cadenas de páginas con el pacing
+    compartido) y devuelve los trades con la cotización vigente (ingesta.FusionAsOf):
+    time, price, size, bid, bid_size, ask, ask_size, midpoint, lado.
+    La fusión es por páginas: en memoria sólo quedan las cotizaciones entre las dos cadenas.
+    Sin staging: una sesión interrumpida se vuelve a pedir entera. Si una de las cadenas falla
+    se cancela la otra y se lanza el error (la sesión no se guarda truncada).
+    """
+    start_utc = session_start_ny.astimezone(pytz.utc)
+    end_utc = session_end_ny.astimezone(pytz.utc)
+    fusion = FusionAsOf()
+    salida = []
+
+    async def _ambas():
+        avance = asyncio.Event()
+        cadenas = [
+            asyncio.ensure_future(_cadena_ticks(ib, contract, start_utc, end_utc, "Trades", "trades",
+                                                fusion, salida, avance)),
+            asyncio.ensure_future(_cadena_ticks(ib, contract, start_utc, end_utc, "Bid_Ask", "cotizaciones",
+                                                fusion, salida, avance)),
+        ]
+        try:
+            await asyncio.gather(*cadenas)
+        finally:
+            # si una cadena falla, la otra no debe quedarse esperando en avance
+            for cadena in cadenas:
+                cadena.cancel()
+
+    ib.run(_ambas())
+    return concat_frames(salida, columnas_ticks(FUSION))
+
+def descargar_sesion(ib, contract, session_start, session_end, staging=None, what_to_show=None):
+    """Sesión de ticks según what_to_show (una cadena, o Trades + Bid_Ask fusionados)."""
+    what_to_show = what_to_show or WHAT_TO_SHOW
+    if what_to_show == FUSION:
+        return fetch_ticks_fusionados(ib, contract, session_start, session_end)
+    return fetch_ticks_for_session(ib, contract, session_start, session_end, staging, what_to_show)
 
 # ----------------------------
 # LÓGICA PRINCIPAL
 # ----------------------------
 def main():
+    parser = argparse.ArgumentParser(description="Descarga incremental tick a tick desde IB")
+    parser.add_argument("--tickers", nargs="+", default=TICKERS)
+    parser.add_argument("--what-to-show", choices=TIPOS_TICKS, default=WHAT_TO_SHOW,
+                        help=f"{FUSION}: trades con la cotización vigente")
+    args = parser.parse_args()
+    what_to_show = args.what_to_show
+
+    def _pedir_tramo(ib, contract, inicio, fin):
+        # huecos de completar_sesion: con el mismo what_to_show que la sesión
+        return descargar_sesion(ib, contract, inicio, fin, what_to_show=what_to_show)
+
     ib = connect_ib()
 
     today_ny = datetime.now(pytz.utc).astimezone(NY_TZ).date()
     market_open_now = is_market_open()
 
-    for symbol in TICKERS:
+    for symbol in args.tickers:
         print(f"\n== Procesando {symbol} ==")
         logger.info(f"== Procesando {symbol} ==")
         symbol_dir = ensure_symbol_dir(symbol)
@@ -399,15 +465,8 @@ def main():
             end_date = today_ny
             if market_open_now:
                 end_date = prev_business_day(today_ny)  # no descargar sesión en curso
-            # retroceder hasta obtener INIT_DAYS_BACK business days
-            start_date = end_date
-            days_added = 0
-            while days_added < INIT_DAYS_BACK:
-                if start_date.weekday() < 5:
-                    days_added += 1
-                start_date -= timedelta(days=1)
-            # after loop start_date is 1 day earlier than needed
-            start_date = next_business_day(start_date)
+            # retroceder hasta obtener INIT_DAYS_BACK sesiones (sin fines de semana ni festivos)
+            start_date = calendario().retroceder(end_date, INIT_DAYS_BACK)
         else:
             last = max(downloaded)
             start_date = next_business_day(last)
@@ -432,7 +491,7 @@ def main():
 
         d = start_date
         while d <= end_date:
-            if d.weekday() >= 5:
+            if not calendario().es_habil(d):
                 d = next_business_day(d)
                 continue
             if d in downloaded:
@@ -441,19 +500,25 @@ def main():
                 continue
 
             print(f"    → Descargando sesión {d}")
-            session_start = NY_TZ.localize(datetime.combine(d, SESSION_OPEN))
-            session_end = NY_TZ.localize(datetime.combine(d, SESSION_CLOSE))
+            session_start, session_end = calendario().sesion(d)  # cierre a las 13:00 en medias sesiones
+            staging = StagingSesion(symbol_dir, d)
             try:
-                df_day = fetch_ticks_for_session(ib, contract, session_start, session_end)
+                df_day = descargar_sesion(ib, contract, session_start, session_end, staging, what_to_show)
+                df_day, _ = completar_sesion(ib, contract, "Tick2Tick", df_day, session_start, session_end,
+                                             pedir_ticks=_pedir_tramo)
                 if not df_day.empty:
                     save_session_df(symbol_dir, d, df_day)
+                    if ARCHIVAR_TICKS:
+                        ArchivoTicks(os.path.join(OUTPUT_ROOT, "archivo", symbol)).anexar(d, df_day)
                 else:
                     print(f"    ⚠️ No hubo ticks para {symbol} {d}")
+                staging.limpiar()  # sólo cuando la sesión ya está guardada
             except Exception as e:
                 print(f"    ❌ Error Descargar {symbol} {d}: {e}")
 
             d = next_business_day(d)
 
+    logger.info(f"Pacing: {gobernador.resumen()}")
     ib.disconnect()
     print("\n✂ Desconectado. Proceso finalizado.")
 
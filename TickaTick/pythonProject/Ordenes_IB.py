@@ -8,13 +8,20 @@ import numpy as np
 import ib_async
 from ib_async import *
 
+# conId de la acción y la opción de cada orden ya cualificados hoy
+from contratos import cache_contratos
+
+# ejecuciones y market data en conexiones separadas (conexiones.py)
+from conexiones import PoolConexiones, TIPO_EJECUCIONES, TIPO_MERCADO
+
 # =========================================================
 #                    CONFIGURACIÓN
 # =========================================================
 
 TWS_HOST = "127.0.0.1"
 TWS_PORT = 7496
-CLIENT_ID = 0
+CLIENT_ID = 0              # ejecuciones: el clientId 0 recibe las órdenes de todos los clientes
+CLIENT_ID_MERCADO = 20     # subyacente y griegas de cada orden
 MARKET_DATA_TYPE = 1
 
 EXCEL_FILE = "ib2025.xlsx"
@@ -193,18 +200,19 @@ def make_greeks_handler(fut: asyncio.Future):
 #                 WORKER PRINCIPAL
 # =========================================================
 
-async def worker_ordenes(ib: IB):
+async def worker_ordenes(pool: PoolConexiones):
     while True:
         msg = await cola.get()
         data = msg["data"]
 
         try:
             symbol = data["symbol"]
+            ib = pool.ib(TIPO_MERCADO)
 
             # ---------- Subyacente ----------
             ib.reqMarketDataType(MARKET_DATA_TYPE)
             stk = Stock(symbol, "SMART", "USD")
-            await ib.qualifyContractsAsync(stk)
+            await cache_contratos.cualificar_async(ib, stk)
 
             t_stk = ib.reqMktData(stk, "", False, False)
             await asyncio.sleep(2)
@@ -221,7 +229,7 @@ async def worker_ordenes(ib: IB):
                 currency="USD",
             )
 
-            await ib.qualifyContractsAsync(opt)
+            await cache_contratos.cualificar_async(ib, opt)
 
             greeks_fut = asyncio.get_event_loop().create_future()
             t_opt = ib.reqMktData(opt, "", False, False)
@@ -253,16 +261,19 @@ async def worker_ordenes(ib: IB):
 async def main():
     print("Inicio ORDER listener:", datetime.now(LOCAL_TZ))
 
-    ib = IB()
-    await ib.connectAsync(TWS_HOST, TWS_PORT, clientId=CLIENT_ID)
-    print("Conectado a IB:", ib.isConnected())
+    pool = PoolConexiones({TIPO_EJECUCIONES: [CLIENT_ID], TIPO_MERCADO: [CLIENT_ID_MERCADO]},
+                          TWS_HOST, TWS_PORT, fabrica=IB)
+    await pool.conectar_async()
+    print("Conectado a IB:", pool.resumen())
 
-    ib.execDetailsEvent += on_ejecucion
-    ib.commissionReportEvent += on_informe_comisiones
-    ib.orderStatusEvent += on_orden_status
-    ib.errorEvent += on_error
+    pool.suscribir("execDetailsEvent", on_ejecucion, tipo=TIPO_EJECUCIONES)
+    pool.suscribir("commissionReportEvent", on_informe_comisiones, tipo=TIPO_EJECUCIONES)
+    pool.suscribir("orderStatusEvent", on_orden_status, tipo=TIPO_EJECUCIONES)
+    pool.suscribir("errorEvent", on_error)
+    cache_contratos.abrir()
 
-    asyncio.create_task(worker_ordenes(ib))
+    asyncio.create_task(worker_ordenes(pool))
+    asyncio.create_task(pool.vigilar_async())
 
     while True:
         await asyncio.sleep(3600)
@@ -0,0 +1,286 @@
+'''
+Barras construidas a partir de las sesiones de ticks guardadas (time / price / size).
+
+Tipos de barra (especificación "tipo:umbral"):
+
+    time:1min          barras de tiempo a cualquier resolución (alineadas a la apertura de la sesión)
+    tick:1000          cada N ticks
+    volume:50000       cada N unidades de volumen
+    dollar:5e6         cada N de importe (price * size)
+    tick_imbalance:500     barras de desequilibrio de ticks (López de Prado); el umbral es el
+    volume_imbalance:500   nº esperado de ticks por barra con el que arranca cada sesión
+
+Todo se calcula de una sesión en una sesión (la memoria no depende del histórico) y con NumPy:
+el identificador de barra sale de sumas acumuladas (volumen y dólar: floor(acumulado previo / N))
+y el OHLCV de np.ufunc.reduceat sobre los cortes. Las barras de desequilibrio necesitan el
+umbral de la barra anterior, así que se busca cada cierre con la suma acumulada de una ventana
+que crece si no basta.
+
+Las barras no cruzan sesiones: cada sesión empieza en una barra nueva y la última puede quedar
+incompleta (columna ticks). Así cada día es independiente y se puede paralelizar por días.
+
+Salida: <destino>/<nombre_barra>/<SYMBOL>/YYYY-MM-DD.parquet (p.ej. Agg_volume_50000), con
+save_session_df; se leen con read_session_df / read_range como el resto del almacén.
+
+Uso:
+    python agregacion.py E:/DATOSBOLSA/Tick2Tick/AAPL --barras time:1min volume:50000 tick_imbalance:500
+    python agregacion.py E:/DATOSBOLSA/Tick2Tick/AAPL --barras dollar:5e6 --procesos 6
+'''
+
+import argparse
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import logging
+
+from almacen import BASE_DIR, list_downloaded_dates, read_session_df, save_session_df
+from calendario import calendario_tipo
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+TIPOS_BARRA = ["time", "tick", "volume", "dollar", "tick_imbalance", "volume_imbalance"]
+PREFIJO_DIRECTORIO = "Agg"
+COLUMNAS_SALIDA = ["time", "time_fin", "open", "high", "low", "close", "volume", "dollar", "vwap", "ticks"]
+ALFA_IMBALANCE = 0.1                # EWMA de E[T] y E[b] entre barras de desequilibrio
+VENTANA_IMBALANCE = 4               # la búsqueda del cierre mira VENTANA_IMBALANCE * E[T] ticks de una vez
+# E[T] no se aleja más de este factor del umbral inicial: sin límite, con flujo equilibrado
+# (E[b] ~ 0) las barras se van encogiendo hasta quedarse en 1-2 ticks
+LIMITE_IMBALANCE = 10
+MIN_DESEQUILIBRIO = 0.05            # |E[b]| mínimo en el umbral
+PROCESOS = max(1, (os.cpu_count() or 2) - 1)
+
+Especificacion = namedtuple("Especificacion", ["tipo", "umbral"])
+
+
+def parse_barra(texto):
+    """'volume:50000' -> Especificacion('volume', 50000.0); 'time:1min' -> ('time', Timedelta)."""
+    tipo, _, umbral = texto.partition(":")
+    if tipo not in TIPOS_BARRA or not umbral:
+        raise ValueError(f"Barra no válida: {texto} (tipos: {', '.join(TIPOS_BARRA)})")
+    if tipo == "time":
+        valor = pd.Timedelta(umbral)
+    else:
+        valor = float(umbral)
+    if (valor <= pd.Timedelta(0)) if tipo == "time" else (valor <= 0):
+        raise ValueError(f"Umbral no válido: {texto}")
+    return Especificacion(tipo, valor)
+
+
+_UNIDADES_TIEMPO = [("d", 86400 * 10**9), ("h", 3600 * 10**9), ("min", 60 * 10**9),
+                    ("s", 10**9), ("ms", 10**6), ("us", 10**3), ("ns", 1)]
+
+
+def nombre_barra(esp):
+    """Directorio de la barra en el almacén: Agg_time_1min, Agg_volume_50000..."""
+    if esp.tipo == "time":
+        ns = esp.umbral.value
+        unidad, factor = next((u, f) for u, f in _UNIDADES_TIEMPO if ns % f == 0)
+        umbral = f"{ns // factor}{unidad}"
+    elif float(esp.umbral).is_integer():
+        umbral = str(int(esp.umbral))
+    else:
+        umbral = f"{esp.umbral:g}"
+    return f"{PREFIJO_DIRECTORIO}_{esp.tipo}_{umbral}"
+
+
+# ----------------------------
+# AGREGACIÓN VECTORIZADA
+# ----------------------------
+def _columnas_ticks(df):
+    """(ns, price, size) como arrays; en sesiones Bid_Ask se usa el midpoint con tamaño 0."""
+    ns = pd.to_datetime(df["time"], utc=True).astype("datetime64[ns, UTC]").array.asi8
+    if "price" in df.columns:
+        price = df["price"].to_numpy(np.float64)
+        size = df["size"].to_numpy(np.float64) if "size" in df.columns else np.zeros(len(df))
+    else:
+        price = df["midpoint"].to_numpy(np.float64)
+        size = np.zeros(len(df))
+    valido = ~np.isnan(price)
+    size = np.nan_to_num(size[valido])
+    return ns[valido], price[valido], size
+
+
+def _ohlcv(ns, price, size, ids, time_barra=None):
+    """Barras de ids (no decrecientes) -> DataFrame COLUMNAS_SALIDA, con reduceat sobre los cortes."""
+    if len(ns) == 0:
+        return pd.DataFrame({c: pd.Series(dtype="float64") for c in COLUMNAS_SALIDA})
+    inicios = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    fines = np.r_[inicios[1:], len(ns)] - 1
+    importe = price * size
+    volumen = np.add.reduceat(size, inicios)
+    dolar = np.add.reduceat(importe, inicios)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        vwap = np.where(volumen > 0, dolar / volumen, np.nan)
+    t = time_barra[inicios] if time_barra is not None else ns[inicios]
+    return pd.DataFrame({
+        "time": pd.to_datetime(t, utc=True),
+        "time_fin": pd.to_datetime(ns[fines], utc=True),
+        "open": price[inicios],
+        "high": np.maximum.reduceat(price, inicios),
+        "low": np.minimum.reduceat(price, inicios),
+        "close": price[fines],
+        "volume": volumen,
+        "dollar": dolar,
+        "vwap": vwap,
+        "ticks": (fines - inicios + 1).astype(np.int64),
+    })
+
+
+def _signo_tick(price):
+    """Regla del tick: +1 si sube, -1 si baja, el signo anterior si no cambia (1 al principio)."""
+    d = np.sign(np.diff(price, prepend=price[0]))
+    idx = np.where(d != 0, np.arange(len(d)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    b = d[idx]
+    b[b == 0] = 1
+    return b
+
+
+def _ids_imbalance(b, esperado_t):
+    """
+    Identificador de barra de desequilibrio: la barra se cierra cuando |sum(b)| desde su inicio
+    llega a E[T] * |E[b]|; E[T] y E[b] se actualizan con EWMA al cerrar cada barra.
+    """
+    n = len(b)
+    ids = np.empty(n, dtype=np.int64)
+    minimo, maximo = esperado_t / LIMITE_IMBALANCE, esperado_t * LIMITE_IMBALANCE
+    e_t = float(esperado_t)
+    e_b = float(np.mean(b[:int(esperado_t)])) if n else 0.0
+    i = barra = 0
+    while i < n:
+        umbral = max(1.0, e_t * max(abs(e_b), MIN_DESEQUILIBRIO))
+        ventana = max(16, int(VENTANA_IMBALANCE * e_t))
+        fin = None
+        while fin is None:
+            tramo = np.abs(np.cumsum(b[i:i + ventana]))
+            cruces = np.flatnonzero(tramo >= umbral)
+            if len(cruces):
+                fin = i + int(cruces[0]) + 1
+            elif i + ventana >= n:
+                fin = n
+            else:
+                ventana *= 2
+        ids[i:fin] = barra
+        largo = fin - i
+        e_t = min(maximo, max(minimo, ALFA_IMBALANCE * largo + (1 - ALFA_IMBALANCE) * e_t))
+        e_b = ALFA_IMBALANCE * float(np.mean(b[i:fin])) + (1 - ALFA_IMBALANCE) * e_b
+        i, barra = fin, barra + 1
+    return ids
+
+
+def agregar(df, esp, apertura=None):
+    """
+    Sesión de ticks -> barras según la especificación.
+    apertura (timestamp UTC): origen de las barras de tiempo; si falta, el primer tick.
+    """
+    ns, price, size = _columnas_ticks(df)
+    if len(ns) == 0:
+        return _ohlcv(ns, price, size, np.zeros(0, dtype=np.int64))
+    orden = np.argsort(ns, kind="stable")
+    ns, price, size = ns[orden], price[orden], size[orden]
+
+    if esp.tipo == "time":
+        origen = pd.Timestamp(apertura).value if apertura is not None else int(ns[0])
+        paso = esp.umbral.value
+        ids = (ns - origen) // paso
+        return _ohlcv(ns, price, size, ids, time_barra=origen + ids * paso)
+    if esp.tipo == "tick":
+        ids = np.arange(len(ns)) // int(esp.umbral)
+    elif esp.tipo in ("volume", "dollar"):
+        x = size if esp.tipo == "volume" else price * size
+        acumulado = np.cumsum(x)
+        # el tick que cruza el umbral cierra la barra en la que empieza
+        ids = ((acumulado - x) // esp.umbral).astype(np.int64)
+    else:
+        b = _signo_tick(price)
+        if esp.tipo == "volume_imbalance":
+            # desequilibrio de volumen: se escala con el tamaño medio de la sesión
+            medio = size.mean() if size.any() else 1.0
+            b = b * size / medio
+        ids = _ids_imbalance(b, esp.umbral)
+    return _ohlcv(ns, price, size, ids)
+
+
+# ----------------------------
+# SESIONES Y DÍAS
+# ----------------------------
+def agregar_dia(symbol_dir, d, especificaciones, destino, tipo="stock"):
+    """Lee la sesión de ticks del día d y guarda cada barra pedida. Devuelve {nombre: nº barras}."""
+    df = read_session_df(symbol_dir, d)
+    if df is None or df.empty:
+        return {}
+    sesion = calendario_tipo(tipo).sesion(d)
+    apertura = pd.Timestamp(sesion[0]).tz_convert("UTC") if sesion else None
+    symbol = os.path.basename(os.path.normpath(symbol_dir))
+    hechas = {}
+    for esp in especificaciones:
+        barras = agregar(df, esp, apertura)
+        nombre = nombre_barra(esp)
+        salida = os.path.join(destino, nombre, symbol)
+        os.makedirs(salida, exist_ok=True)
+        save_session_df(salida, d, barras)
+        hechas[nombre] = len(barras)
+    return hechas
+
+
+def _tarea_dia(args):
+    return args[1], agregar_dia(*args)
+
+
+def dias_pendientes(symbol_dir, especificaciones, destino, rehacer=False):
+    """Días con ticks a los que les falta alguna de las barras pedidas (incremental)."""
+    dias = list_downloaded_dates(symbol_dir)
+    if rehacer:
+        return sorted(dias)
+    symbol = os.path.basename(os.path.normpath(symbol_dir))
+    hechos = [list_downloaded_dates(os.path.join(destino, nombre_barra(e), symbol)) for e in especificaciones]
+    return sorted(d for d in dias if not all(d in h for h in hechos))
+
+
+def agregar_directorio(symbol_dir, especificaciones, destino=None, tipo="stock", procesos=1, rehacer=False):
+    """
+    Agrega todos los días pendientes de symbol_dir. Con procesos > 1 cada día va a un proceso
+    (ProcessPoolExecutor). Devuelve el nº de días procesados.
+    """
+    destino = destino or BASE_DIR
+    dias = dias_pendientes(symbol_dir, especificaciones, destino, rehacer)
+    tareas = [(symbol_dir, d, especificaciones, destino, tipo) for d in dias]
+    logger.info(f"Agregación: {len(dias)} días de {symbol_dir} -> {[nombre_barra(e) for e in especificaciones]}")
+    if procesos > 1 and len(tareas) > 1:
+        with ProcessPoolExecutor(max_workers=procesos) as pool:
+            resultados = pool.map(_tarea_dia, tareas)
+            for d, hechas in resultados:
+                logger.info(f"    {d}: {hechas}")
+    else:
+        for t in tareas:
+            d, hechas = _tarea_dia(t)
+            logger.info(f"    {d}: {hechas}")
+    return len(dias)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Barras de tiempo, ticks, volumen, dólar y desequilibrio")
+    parser.add_argument("directorio", help="sesiones de ticks de un símbolo (p.ej. BASE_DIR/Tick2Tick/AAPL)")
+    parser.add_argument("--barras", nargs="+", required=True, help="tipo:umbral, p.ej. time:1min volume:50000")
+    parser.add_argument("--destino", default=BASE_DIR, help="raíz del almacén de salida")
+    parser.add_argument("--tipo", default="stock", help="tipo de activo (calendario: apertura de las barras de tiempo)")
+    parser.add_argument("--procesos", type=int, default=PROCESOS)
+    parser.add_argument("--rehacer", action="store_true", help="recalcular también los días ya agregados")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    especificaciones = [parse_barra(b) for b in args.barras]
+    n = agregar_directorio(args.directorio, especificaciones, args.destino, args.tipo, args.procesos, args.rehacer)
+    print(f"{n} días agregados")
+
+
+if __name__ == "__main__":
+    main()
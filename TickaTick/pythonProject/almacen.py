@@ -0,0 +1,464 @@
+'''
+Almacén de sesiones descargadas desde IB.
+
+Sustituye al guardado por día en XLSX de save_session_df. Cada sesión se guarda en
+<symbol_dir>/YYYY-MM-DD.<ext> usando un backend enchufable:
+
+    parquet -> columnar (pyarrow), time como int64 ns UTC, precios float64, compresión por fichero.
+    xlsx    -> formato antiguo (openpyxl). Queda como exportación opcional.
+
+list_downloaded_dates y read_session_df entienden ambos formatos, así que los directorios
+con históricos en XLSX siguen funcionando sin migrar.
+
+Cada parquet se escribe en grupos de FILAS_POR_GRUPO filas y lleva al lado un índice pequeño
+(<fichero>.idx.json: fila inicial y primer/último time de cada grupo, más min/max de la
+sesión). read_range / read_session_range lo usan para leer sólo los grupos que tocan el
+intervalo pedido en vez de cargar el día entero y filtrar con pandas.
+
+'''
+
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+import pandas as pd
+
+import logging
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+FORMATO_ALMACEN = "parquet"         # "parquet" o "xlsx"
+EXPORTAR_XLSX = False               # además del formato principal, escribir copia XLSX
+COMPRESION_PARQUET = "zstd"         # zstd, snappy, gzip, none
+PRECISION_PRECIOS = "float64"       # float32 reduce a la mitad el disco, pierde decimales en precios altos
+FILAS_POR_GRUPO = 8192              # filas por row group del parquet = granularidad del índice
+SUFIJO_INDICE = ".idx.json"         # índice temporal al lado de cada parquet
+BASE_DIR = os.environ.get("DATOSBOLSA_DIR", "E:/DATOSBOLSA")
+
+# Columnas de precio/tamaño conocidas (barras y ticks). El resto se deja con el tipo que traiga.
+COLUMNAS_NUMERICAS = [
+    "open", "high", "low", "close", "volume",
+    "price", "size",
+    "bid", "bid_size", "ask", "ask_size", "midpoint",
+]
+
+
+# ----------------------------
+# BACKENDS
+# ----------------------------
+class BackendParquet:
+    nombre = "parquet"
+    extension = ".parquet"
+
+    def __init__(self, compresion=COMPRESION_PARQUET, precision=PRECISION_PRECIOS, indice=True):
+        self.compresion = None if compresion in (None, "none") else compresion
+        self.precision = precision
+        self.indice = indice
+
+    def _tabla(self, df):
+        import pyarrow as pa
+
+        df = df.copy()
+        # time tz-aware UTC -> timestamp[ns, UTC] (int64 en disco)
+        df["time"] = pd.to_datetime(df["time"], utc=True).astype("datetime64[ns, UTC]")
+        for c in COLUMNAS_NUMERICAS:
+            if c in df.columns:
+                df[c] = pd.to_numeric(df[c], errors="coerce").astype(self.precision)
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+    def guardar(self, filename, df):
+        import pyarrow.parquet as pq
+
+        tabla = self._tabla(df)
+        tmp = filename + ".tmp"
+        pq.write_table(tabla, tmp, compression=self.compresion, row_group_size=FILAS_POR_GRUPO)
+        os.replace(tmp, filename)  # atómico: nunca queda un parquet a medias
+        if self.indice and "time" in tabla.column_names:
+            ns = tabla.column("time").cast("int64").to_numpy()
+            _guardar_indice(filename, _indice_desde_ns(ns, FILAS_POR_GRUPO, os.path.getsize(filename)))
+
+    def leer(self, filename, columns=None):
+        import pyarrow.parquet as pq
+
+        return pq.read_table(filename, columns=columns).to_pandas()
+
+    def leer_rango(self, filename, inicio_ns, fin_ns, columns=None):
+        """Filas con time en [inicio_ns, fin_ns): sólo se leen los row groups que lo tocan."""
+        import pyarrow.parquet as pq
+
+        indice = leer_indice(filename)
+        if columns is not None and "time" not in columns:
+            columns = ["time"] + list(columns)
+        if indice is None:
+            df = self.leer(filename, columns=columns)
+        elif indice["filas"] == 0 or indice["max"] < inicio_ns or indice["min"] >= fin_ns:
+            df = pq.read_schema(filename).empty_table().to_pandas()
+            return df if columns is None else df[columns]
+        else:
+            grupos = np.asarray(indice["grupos"], dtype=np.int64).reshape(-1, 3)
+            tocan = np.flatnonzero((grupos[:, 2] >= inicio_ns) & (grupos[:, 1] < fin_ns))
+            df = pq.ParquetFile(filename).read_row_groups(tocan.tolist(), columns=columns).to_pandas()
+        return _recortar(df, inicio_ns, fin_ns)
+
+
+class BackendXlsx:
+    nombre = "xlsx"
+    extension = ".xlsx"
+
+    def guardar(self, filename, df):
+        # convertir time tz-aware UTC -> tz-naive (Excel no acepta tz-aware)
+        df_to_write = df.copy()
+        df_to_write["time"] = pd.to_datetime(df_to_write["time"], utc=True).dt.tz_localize(None)
+
+        # El formato de fecha se aplica al escribir: no hace falta reabrir el libro con load_workbook
+        with pd.ExcelWriter(filename, engine="openpyxl",
+                            datetime_format="yyyy-mm-dd hh:mm:ss") as w:
+            df_to_write.to_excel(w, index=False)
+
+    def leer(self, filename, columns=None):
+        df = pd.read_excel(filename, engine="openpyxl", usecols=columns)
+        if "time" in df.columns:
+            df["time"] = pd.to_datetime(df["time"]).dt.tz_localize(pytz.utc)
+        return df
+
+    def leer_rango(self, filename, inicio_ns, fin_ns, columns=None):
+        # XLSX no permite saltar a una fila: se lee entero y se filtra
+        if columns is not None and "time" not in columns:
+            columns = ["time"] + list(columns)
+        return _recortar(self.leer(filename, columns=columns), inicio_ns, fin_ns)
+
+
+# ----------------------------
+# ÍNDICE TEMPORAL (sidecar)
+# ----------------------------
+def ruta_indice(filename):
+    return filename + SUFIJO_INDICE
+
+
+def _indice_desde_ns(ns, filas_grupo, bytes_fichero):
+    """Índice de un parquet a partir de su columna time (int64 ns) y del tamaño de grupo."""
+    grupos = []
+    for fila in range(0, len(ns), filas_grupo):
+        trozo = ns[fila:fila + filas_grupo]
+        # min/max del grupo: el índice vale aunque la sesión no venga ordenada
+        grupos.append([fila, int(trozo.min()), int(trozo.max())])
+    return {
+        "filas": int(len(ns)),
+        "bytes": int(bytes_fichero),
+        "min": int(ns.min()) if len(ns) else None,
+        "max": int(ns.max()) if len(ns) else None,
+        "grupos": grupos,
+    }
+
+
+def _guardar_indice(filename, indice):
+    path = ruta_indice(filename)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(indice, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def indexar(filename):
+    """
+    Construye el índice de un parquet leyendo sólo su pie (estadísticas de time por row group).
+    Para parquets escritos antes del índice. Devuelve el índice o None si no hay estadísticas.
+    """
+    import pyarrow.parquet as pq
+
+    meta = pq.ParquetFile(filename).metadata
+    nombres = [meta.schema.column(i).name for i in range(meta.num_columns)]
+    if "time" not in nombres:
+        return None
+    col = nombres.index("time")
+    grupos, fila = [], 0
+    for g in range(meta.num_row_groups):
+        rg = meta.row_group(g)
+        stats = rg.column(col).statistics
+        if rg.num_rows and (stats is None or not stats.has_min_max):
+            return None
+        if rg.num_rows:
+            # las estadísticas pueden venir en us: se ensancha 1 us para no perder filas
+            grupos.append([fila, pd.Timestamp(stats.min).value - 1000, pd.Timestamp(stats.max).value + 1000])
+        fila += rg.num_rows
+    indice = {
+        "filas": fila,
+        "bytes": os.path.getsize(filename),
+        "min": min(g[1] for g in grupos) if grupos else None,
+        "max": max(g[2] for g in grupos) if grupos else None,
+        "grupos": grupos,
+    }
+    _guardar_indice(filename, indice)
+    return indice
+
+
+def leer_indice(filename):
+    """Índice del parquet; si falta o es de otra versión del fichero se reconstruye desde el pie."""
+    path = ruta_indice(filename)
+    if os.path.exists(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                indice = json.load(f)
+            if indice.get("bytes") == os.path.getsize(filename):
+                return indice
+        except (OSError, ValueError):
+            pass
+    try:
+        return indexar(filename)
+    except Exception as e:
+        logger.warning(f"No se pudo indexar {filename}: {e}")
+        return None
+
+
+def _ns_utc(ts):
+    ts = pd.Timestamp(ts)
+    if ts.tzinfo is None:
+        ts = ts.tz_localize("UTC")
+    return ts.tz_convert("UTC").as_unit("ns").value
+
+
+def _recortar(df, inicio_ns, fin_ns):
+    if df.empty:
+        return df.reset_index(drop=True)
+    ns = pd.to_datetime(df["time"], utc=True).astype("datetime64[ns, UTC]").array.asi8
+    return df[(ns >= inicio_ns) & (ns < fin_ns)].reset_index(drop=True)
+
+
+BACKENDS = {
+    "parquet": BackendParquet,
+    "xlsx": BackendXlsx,
+}
+
+# Orden de preferencia al leer si hay varios ficheros para el mismo día
+EXTENSIONES_LECTURA = [".parquet", ".xlsx", ".xls"]
+
+
+def get_backend(formato=None):
+    formato = (formato or FORMATO_ALMACEN).lower()
+    if formato not in BACKENDS:
+        raise ValueError(f"Formato de almacén no soportado: {formato}")
+    return BACKENDS[formato]()
+
+
+def _backend_por_extension(ext):
+    if ext == ".parquet":
+        return BackendParquet()
+    if ext in (".xlsx", ".xls"):
+        return BackendXlsx()
+    return None
+
+
+# ----------------------------
+# API
+# ----------------------------
+def session_path(symbol_dir, date_obj, formato=None):
+    backend = get_backend(formato)
+    return os.path.join(symbol_dir, f"{date_obj.strftime('%Y-%m-%d')}{backend.extension}")
+
+
+def find_session_file(symbol_dir, date_obj):
+    """Devuelve la ruta del fichero de la sesión (prefiere parquet) o None si no existe."""
+    base = os.path.join(symbol_dir, date_obj.strftime('%Y-%m-%d'))
+    for ext in EXTENSIONES_LECTURA:
+        if os.path.exists(base + ext):
+            return base + ext
+    return None
+
+
+def list_downloaded_dates(symbol_dir):
+    """Devuelve set de fechas descargadas (YYYY-MM-DD.parquet / .xlsx / .xls)"""
+    if not os.path.exists(symbol_dir):
+        return set()
+    names = os.listdir(symbol_dir)
+    dates = set()
+    for n in names:
+        base, ext = os.path.splitext(n)
+        if ext.lower() not in EXTENSIONES_LECTURA:
+            continue
+        try:
+            dt = datetime.strptime(base, "%Y-%m-%d").date()
+            dates.add(dt)
+        except Exception:
+            continue
+    return dates
+
+
+def read_session_df(symbol_dir, date_obj, columns=None):
+    """
+    Lee la sesión de symbol_dir para date_obj en el formato que exista.
+    Devuelve DataFrame con time tz-aware UTC, o None si no hay fichero.
+    """
+    filename = find_session_file(symbol_dir, date_obj)
+    if filename is None:
+        return None
+    return read_session_file(filename, columns=columns)
+
+
+def read_session_file(filename, columns=None):
+    ext = os.path.splitext(filename)[1].lower()
+    backend = _backend_por_extension(ext)
+    if backend is None:
+        raise ValueError(f"Extensión no soportada: {filename}")
+    return backend.leer(filename, columns=columns)
+
+
+def read_session_range(filename, start, end, columns=None):
+    """
+    Filas de la sesión filename con time en [start, end) (tz-aware o naive UTC).
+    En parquet sólo se leen los row groups que solapan el intervalo (ver leer_indice).
+    """
+    backend = _backend_por_extension(os.path.splitext(filename)[1].lower())
+    if backend is None:
+        raise ValueError(f"Extensión no soportada: {filename}")
+    return backend.leer_rango(filename, _ns_utc(start), _ns_utc(end), columns=columns)
+
+
+def read_range(symbol, bar_type, start, end, columns=None, base_dir=None):
+    """
+    Datos de symbol / bar_type con time en [start, end), aunque abarque varias sesiones.
+    Recorre los ficheros de base_dir/<bar_type>/<symbol> de los días (NY) que toca el intervalo;
+    se mira también el día siguiente porque la sesión de futuros y divisas abre la víspera.
+    Devuelve DataFrame ordenado por time (vacío si no hay nada).
+    """
+    symbol_dir = os.path.join(base_dir or BASE_DIR, bar_type, symbol)
+    ny = pytz.timezone("America/New_York")
+    inicio, fin = _ns_utc(start), _ns_utc(end)
+    d = pd.Timestamp(inicio, tz="UTC").tz_convert(ny).date()
+    ultimo = pd.Timestamp(fin, tz="UTC").tz_convert(ny).date() + timedelta(days=1)
+    partes = []
+    while d <= ultimo:
+        filename = find_session_file(symbol_dir, d)
+        if filename:
+            partes.append(read_session_range(filename, inicio, fin, columns=columns))
+        d += timedelta(days=1)
+    partes = [p for p in partes if not p.empty]
+    if not partes:
+        return pd.DataFrame(columns=["time"] + list(columns or []))
+    df = pd.concat(partes, ignore_index=True)
+    return df.sort_values("time", kind="stable").reset_index(drop=True)
+
+
+def save_session_df(symbol_dir, date_obj, df, formato=None, exportar_xlsx=None):
+    """
+    Guarda dataframe de sesión en symbol_dir/YYYY-MM-DD.<ext> con el backend configurado.
+    Si exportar_xlsx (o EXPORTAR_XLSX) está activo, además deja una copia .xlsx.
+    Devuelve la ruta del fichero principal o None si df está vacío.
+    """
+    backend = get_backend(formato)
+    filename = session_path(symbol_dir, date_obj, backend.nombre)
+    if df.empty:
+        logger.info(f"    (vacío) No se guarda {filename}")
+        return None
+
+    backend.guardar(filename, df)
+    logger.info(f"    💾 Guardado {filename} ({len(df)} filas)")
+
+    if exportar_xlsx is None:
+        exportar_xlsx = EXPORTAR_XLSX
+    if exportar_xlsx and backend.nombre != "xlsx":
+        xlsx = session_path(symbol_dir, date_obj, "xlsx")
+        try:
+            BackendXlsx().guardar(xlsx, df)
+        except Exception as e:
+            logger.warning(f"    ⚠️ No se pudo exportar {xlsx}: {e}")
+
+    return filename
+
+
+# ----------------------------
+# STAGING POR BLOQUES (checkpoint / resume)
+# ----------------------------
+STAGING_DIR = "_staging"            # subdirectorio dentro de symbol_dir
+
+
+class StagingSesion:
+    """
+    Área de staging de una sesión: cada bloque/página descargado se guarda en
+    symbol_dir/_staging/YYYY-MM-DD/ en cuanto llega, y progreso.json recuerda qué bloques
+    están hechos y el cursor (para los ticks, que se piden hacia atrás).
+
+    Si el proceso se cae a mitad de sesión, al relanzar se saltan los bloques ya hechos.
+    Quien trocea la sesión con un plan que cambia entre ejecuciones (plan_bloques) guarda
+    aquí el troceo al empezar (guardar_plan) y lo reutiliza al reanudar: así las claves de
+    los bloques hechos siguen coincidiendo.
+    Al final se junta todo, se guarda la sesión con save_session_df y se borra el staging.
+    """
+
+    def __init__(self, symbol_dir, date_obj, subdir=STAGING_DIR):
+        self.dir = os.path.join(symbol_dir, subdir, date_obj.strftime('%Y-%m-%d'))
+        self._progreso_path = os.path.join(self.dir, "progreso.json")
+        self._backend = BackendParquet(indice=False)   # bloques temporales: sin índice
+        self._progreso = self._cargar_progreso()
+
+    def _cargar_progreso(self):
+        if not os.path.exists(self._progreso_path):
+            return {"bloques": {}, "cursor": None}
+        with open(self._progreso_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _guardar_progreso(self):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = self._progreso_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._progreso, f)
+        os.replace(tmp, self._progreso_path)
+
+    @property
+    def reanudada(self):
+        return bool(self._progreso["bloques"])
+
+    def bloques_completados(self):
+        return set(self._progreso["bloques"])
+
+    @property
+    def cursor(self):
+        return self._progreso["cursor"]
+
+    @property
+    def plan(self):
+        """Troceo guardado con guardar_plan (None si no hay)."""
+        return self._progreso.get("plan")
+
+    def guardar_plan(self, plan):
+        """plan: lista serializable en JSON (p.ej. [(block_end ISO, durationStr, barSizeSetting)])."""
+        self._progreso["plan"] = [list(p) for p in plan]
+        self._guardar_progreso()
+
+    def guardar_bloque(self, clave, rows, cursor=None):
+        """
+        Persiste las filas de un bloque (lista de dicts o DataFrame) y lo marca como hecho.
+        clave: identificador estable del bloque (p.ej. block_end en ISO).
+        cursor: posición desde la que seguir (ticks); se guarda junto al bloque.
+        """
+        clave = str(clave)
+        df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+        fichero = None
+        if not df.empty:
+            os.makedirs(self.dir, exist_ok=True)
+            fichero = f"bloque_{len(self._progreso['bloques']):05d}.parquet"
+            self._backend.guardar(os.path.join(self.dir, fichero), df)
+        self._progreso["bloques"][clave] = fichero
+        if cursor is not None:
+            self._progreso["cursor"] = str(cursor)
+        self._guardar_progreso()
+
+    def leer_bloques(self):
+        """Concatena todos los bloques guardados (vacío si no hay)."""
+        partes = [
+            self._backend.leer(os.path.join(self.dir, fichero))
+            for fichero in self._progreso["bloques"].values() if fichero
+        ]
+        if not partes:
+            return pd.DataFrame()
+        return pd.concat(partes, ignore_index=True)
+
+    def limpiar(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self._progreso = {"bloques": {}, "cursor": None}
@@ -0,0 +1,245 @@
+'''
+Archivo de ticks por símbolo en disco, de sólo anexado y leído con memory-map.
+
+Cargar meses de ticks como DataFrames por día no cabe en RAM. Aquí cada símbolo tiene:
+
+    <dir>/ticks.bin     registros de ancho fijo (TICK_DTYPE, 64 bytes), un día detrás de otro
+    <dir>/dias.npy      directorio por día (DIR_DTYPE: ordinal del día, primer registro, nº de registros)
+
+Los lectores obtienen vistas NumPy sobre np.memmap (sin copia): varios procesos que leen el
+mismo símbolo comparten las páginas a través de la caché del sistema operativo.
+
+Escritura: los registros se anexan a ticks.bin (flush + fsync) y después se reescribe dias.npy
+de forma atómica. Si el proceso se cae entre medias, al abrir se trunca la cola de ticks.bin que
+ningún día referencia. Un día ya archivado no se vuelve a escribir (sólo anexado).
+
+Uso (archivar las sesiones guardadas por DescargaTick):
+    python archivo_ticks.py E:/DATOSBOLSA/datatick/AAPL E:/DATOSBOLSA/datatick/archivo/AAPL
+'''
+
+import argparse
+import os
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+import logging
+
+from almacen import list_downloaded_dates, read_session_df
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+TICK_DTYPE = np.dtype([
+    ("time_ns", "<i8"),
+    ("price", "<f8"),
+    ("size", "<f8"),
+    ("bid", "<f8"),
+    ("ask", "<f8"),
+    ("bid_size", "<f8"),
+    ("ask_size", "<f8"),
+    ("flags", "<u4"),
+    ("_reserva", "<u4"),        # relleno hasta 64 bytes (alineado a línea de caché)
+])
+DIR_DTYPE = np.dtype([("dia", "<i4"), ("inicio", "<i8"), ("filas", "<i8")])
+
+FICHERO_TICKS = "ticks.bin"
+FICHERO_DIAS = "dias.npy"
+
+# flags de cada registro
+FLAG_TRADE = 1                  # price/size válidos (WHAT_TO_SHOW Trades)
+FLAG_BID_ASK = 2                # bid/ask válidos (WHAT_TO_SHOW Bid_Ask)
+
+# columnas de la sesión (DescargaTick / Tick2Tick) -> campo del registro
+COLUMNAS_REGISTRO = ["price", "size", "bid", "ask", "bid_size", "ask_size"]
+
+
+def registros_desde_df(df):
+    """Sesión de ticks (time UTC + price/size o bid/ask) -> array TICK_DTYPE ordenado por time."""
+    rec = np.zeros(len(df), dtype=TICK_DTYPE)
+    if df.empty:
+        return rec
+    rec["time_ns"] = pd.to_datetime(df["time"], utc=True).astype("datetime64[ns, UTC]").array.asi8
+    flags = np.zeros(len(df), dtype=np.uint32)
+    for c in COLUMNAS_REGISTRO:
+        if c in df.columns:
+            rec[c] = df[c].to_numpy(np.float64)
+        else:
+            rec[c] = np.nan
+    if "price" in df.columns:
+        flags |= np.where(~np.isnan(rec["price"]), FLAG_TRADE, 0).astype(np.uint32)
+    if "bid" in df.columns:
+        flags |= np.where(~np.isnan(rec["bid"]) | ~np.isnan(rec["ask"]), FLAG_BID_ASK, 0).astype(np.uint32)
+    rec["flags"] = flags
+    return rec[np.argsort(rec["time_ns"], kind="stable")]
+
+
+class ArchivoTicks:
+    """Archivo de ticks de un símbolo (ver docstring del módulo)."""
+
+    def __init__(self, directorio):
+        self.dir = directorio
+        self._ticks_path = os.path.join(directorio, FICHERO_TICKS)
+        self._dias_path = os.path.join(directorio, FICHERO_DIAS)
+        self._dias = self._cargar_dias()
+        self._mmap = None
+        self._recuperar_cola()
+
+    # ----------------------------
+    # Directorio de días
+    # ----------------------------
+    def _cargar_dias(self):
+        if not os.path.exists(self._dias_path):
+            return np.zeros(0, dtype=DIR_DTYPE)
+        return np.load(self._dias_path)
+
+    def _guardar_dias(self, dias):
+        tmp = self._dias_path + ".tmp.npy"
+        np.save(tmp, dias)
+        os.replace(tmp, self._dias_path)
+        self._dias = dias
+
+    def _recuperar_cola(self):
+        """Trunca los registros que quedaron sin día tras una escritura interrumpida."""
+        if not os.path.exists(self._ticks_path):
+            return
+        fin = int((self._dias["inicio"] + self._dias["filas"]).max()) if len(self._dias) else 0
+        esperado = fin * TICK_DTYPE.itemsize
+        if os.path.getsize(self._ticks_path) > esperado:
+            logger.warning(f"Archivo de ticks {self.dir}: se descarta una escritura incompleta")
+            with open(self._ticks_path, "r+b") as f:
+                f.truncate(esperado)
+
+    def dias(self):
+        """Días archivados (ordenados)."""
+        return [date.fromordinal(int(o)) for o in self._dias["dia"]]
+
+    def __contains__(self, d):
+        return self._posicion(d) is not None
+
+    def __len__(self):
+        return int(self._dias["filas"].sum())
+
+    def _posicion(self, d):
+        i = int(np.searchsorted(self._dias["dia"], d.toordinal()))
+        if i < len(self._dias) and self._dias["dia"][i] == d.toordinal():
+            return i
+        return None
+
+    # ----------------------------
+    # Escritura
+    # ----------------------------
+    def anexar(self, d, datos):
+        """
+        Añade los ticks del día d (DataFrame de sesión o array TICK_DTYPE).
+        Devuelve el nº de registros escritos (0 si el día ya estaba archivado).
+        """
+        if d in self:
+            logger.info(f"    Archivo de ticks: {d} ya archivado en {self.dir}")
+            return 0
+        rec = datos if isinstance(datos, np.ndarray) else registros_desde_df(datos)
+        if rec.dtype != TICK_DTYPE:
+            raise ValueError(f"Registros con dtype {rec.dtype}, se esperaba TICK_DTYPE")
+        if np.any(rec["time_ns"][1:] < rec["time_ns"][:-1]):
+            # dentro de cada día el orden por time es lo que permite la búsqueda binaria
+            rec = rec[np.argsort(rec["time_ns"], kind="stable")]
+
+        os.makedirs(self.dir, exist_ok=True)
+        inicio = len(self)
+        with open(self._ticks_path, "ab") as f:
+            f.write(rec.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        dias = np.append(self._dias, np.array([(d.toordinal(), inicio, len(rec))], dtype=DIR_DTYPE))
+        self._guardar_dias(np.sort(dias, order="dia"))
+        self._mmap = None   # el tamaño ha cambiado: el próximo lector vuelve a mapear
+        return len(rec)
+
+    # ----------------------------
+    # Lectura (vistas sin copia)
+    # ----------------------------
+    def _mapa(self):
+        if self._mmap is None:
+            if not len(self):
+                return np.zeros(0, dtype=TICK_DTYPE)
+            self._mmap = np.memmap(self._ticks_path, dtype=TICK_DTYPE, mode="r", shape=(len(self),))
+        return self._mmap
+
+    def dia(self, d):
+        """Vista de los ticks del día d (vacía si no está archivado)."""
+        i = self._posicion(d)
+        if i is None:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        inicio, filas = int(self._dias["inicio"][i]), int(self._dias["filas"][i])
+        return self._mapa()[inicio:inicio + filas]
+
+    def _tramos(self, tramos):
+        """
+        [(primer registro, fin)] -> una sola vista si van seguidos en el fichero (lo normal al
+        archivar en orden); si no, se concatenan (copia).
+        """
+        tramos = [(i, f) for i, f in tramos if f > i]
+        if not tramos:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        mapa = self._mapa()
+        if all(f == i for (_, f), (i, _) in zip(tramos, tramos[1:])):
+            return mapa[tramos[0][0]:tramos[-1][1]]
+        return np.concatenate([mapa[i:f] for i, f in tramos])
+
+    def _seleccion(self, desde, hasta):
+        dias = self._dias
+        return dias[(dias["dia"] >= desde.toordinal()) & (dias["dia"] <= hasta.toordinal())]
+
+    def rango(self, desde, hasta):
+        """Ticks de los días archivados en [desde, hasta]."""
+        sel = self._seleccion(desde, hasta)
+        return self._tramos([(int(i), int(i + n)) for i, n in zip(sel["inicio"], sel["filas"])])
+
+    def entre(self, inicio, fin):
+        """
+        Ticks con time en [inicio, fin) (tz-aware o naive UTC). Búsqueda binaria dentro de
+        cada día: sólo se tocan las páginas del fichero que hacen falta.
+        """
+        a, b = pd.Timestamp(inicio), pd.Timestamp(fin)
+        a = a.tz_localize("UTC") if a.tzinfo is None else a.tz_convert("UTC")
+        b = b.tz_localize("UTC") if b.tzinfo is None else b.tz_convert("UTC")
+        # un día de margen a cada lado: días de sesión en NY, y futuros / divisas abren la víspera
+        sel = self._seleccion(a.date() - timedelta(days=1), b.date() + timedelta(days=1))
+        tiempos = self._mapa()["time_ns"] if len(sel) else None
+        tramos = []
+        for i, n in zip(sel["inicio"].tolist(), sel["filas"].tolist()):
+            t = tiempos[i:i + n]
+            tramos.append((i + int(np.searchsorted(t, a.value)), i + int(np.searchsorted(t, b.value))))
+        return self._tramos(tramos)
+
+
+def archivar_directorio(symbol_dir, archivo):
+    """Anexa al archivo las sesiones de symbol_dir que aún no tiene. Devuelve registros añadidos."""
+    total = 0
+    for d in sorted(list_downloaded_dates(symbol_dir)):
+        if d in archivo:
+            continue
+        df = read_session_df(symbol_dir, d)
+        if df is not None and not df.empty:
+            total += archivo.anexar(d, df)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archiva sesiones de ticks en formato memory-map")
+    parser.add_argument("origen", help="directorio de sesiones de un símbolo (DescargaTick / Tick2Tick)")
+    parser.add_argument("destino", help="directorio del archivo de ese símbolo")
+    args = parser.parse_args()
+
+    archivo = ArchivoTicks(args.destino)
+    n = archivar_directorio(args.origen, archivo)
+    print(f"{n} ticks añadidos; {len(archivo)} ticks en {len(archivo.dias())} días")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+'''
+Benchmark de la cadena descarga -> almacenamiento.
+
+Mide dónde se va el tiempo entre reqHistoricalData/reqHistoricalTicks, la conversión de las
+páginas a columnas (ingesta.bars_to_frame / ticks_to_frame), sort_values y el guardado.
+En los casos de ticks se mide también la ruta antigua (dict por tick) como referencia.
+Se ejecuta contra FakeIB (sin TWS), con datos sintéticos o con una grabación.
+
+Casos:
+    bars1s      sesión completa de barras de 1 sg (fetch_ticks_for_session + save_session_df)
+    ticks1k     1.000 ticks
+    ticks100k   100.000 ticks
+    ticks1m     1.000.000 ticks
+
+Cada caso se ejecuta dos veces: la primera mide los tiempos sin tracemalloc (que ralentiza
+mucho las asignaciones) y la segunda sólo la memoria. Por etapa se informa latencia, filas/s y
+pico de memoria Python (tracemalloc); por caso, su pico de memoria Python, el pico de RSS del
+proceso hasta ese caso (ru_maxrss) y los bytes en disco. Las peticiones a FakeIB pasan por un
+gobernador de pacing sin límites: se mide la cadena, no las esperas. El resultado se guarda en JSON
+(bench_results/<fecha>_<commit>.json) para comparar entre commits:
+
+    python benchmark_pipeline.py
+    python benchmark_pipeline.py --casos bars1s ticks100k --xlsx
+    python benchmark_pipeline.py --comparar bench_results/anterior.json
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+# Antes de importar ib_downloader: no tocar E:/DATOSBOLSA ni conectar a TWS
+_TMP = tempfile.TemporaryDirectory(prefix="bench_ib_", ignore_cleanup_errors=True)
+os.environ.setdefault("DATOSBOLSA_DIR", _TMP.name)
+os.environ.setdefault("IB_FAKE", _TMP.name)
+
+import random
+
+import pytz
+import pandas as pd
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+DIR_RESULTADOS = "bench_results"
+CASOS = {
+    "bars1s": None,
+    "ticks1k": 1_000,
+    "ticks100k": 100_000,
+    "ticks1m": 1_000_000,
+}
+SESION_BENCH = datetime(2025, 3, 3)   # lunes cualquiera
+UMBRAL_REGRESION = 1.20               # +20 % de tiempo en una etapa se marca como regresión
+
+
+def _rss_pico_mb():
+    """Pico de RSS del proceso en MB desde que arrancó (ru_maxrss; peak_wset de psutil en Windows)."""
+    try:
+        import resource
+
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return pico / 1024 if sys.platform != "darwin" else pico / 2**20
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset / 2**20
+    except (ImportError, AttributeError):
+        return None
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return "sin_git"
+
+
+def _bytes_dir(path):
+    total = 0
+    for raiz, _, ficheros in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(raiz, f)) for f in ficheros)
+    return total
+
+
+class Cronometro:
+    """
+    Acumula etapas. Con memoria=False mide segundos y filas/s; con memoria=True sólo el pico de
+    memoria Python de cada etapa y del caso entero (tracemalloc activo durante todo el caso).
+    """
+
+    def __init__(self, memoria=False):
+        self.memoria = memoria
+        self.etapas = {}
+        self.pico_mb = 0.0
+
+    def medir(self, nombre, filas, func, *args, **kwargs):
+        if not self.memoria:
+            t0 = time.perf_counter()
+            res = func(*args, **kwargs)
+            dt = time.perf_counter() - t0
+            self.etapas[nombre] = {"segundos": dt, "filas": filas, "filas_s": filas / dt if dt > 0 else None}
+            return res
+        tracemalloc.reset_peak()
+        res = func(*args, **kwargs)
+        _, pico = tracemalloc.get_traced_memory()
+        self.etapas[nombre] = {"pico_py_mb": pico / 2**20}
+        self.pico_mb = max(self.pico_mb, pico / 2**20)
+        return res
+
+
+def _ticks_sinteticos(n, fin, semilla=7):
+    rnd = random.Random(semilla)
+    precio = 100.0
+    t = fin
+    ticks = []
+    for _ in range(n):
+        t -= timedelta(microseconds=rnd.randint(1_000, 20_000))
+        precio += rnd.gauss(0, 0.01)
+        ticks.append(SimpleNamespace(time=t.replace(tzinfo=None), price=precio,
+                                     size=float(rnd.randint(1, 300))))
+    ticks.reverse()
+    return ticks
+
+
+def bench_bars1s(ibd, ib, xlsx, salida, c):
+    from almacen import save_session_df, BackendXlsx
+    from ingesta import bars_to_frame
+
+    contract = ibd.build_contract("AAPL", "stock")
+    ib.qualifyContracts(contract)
+    s = ibd.NY_TZ.localize(datetime.combine(SESION_BENCH.date(), ibd.SESSION_OPEN))
+    e = ibd.NY_TZ.localize(datetime.combine(SESION_BENCH.date(), ibd.SESSION_CLOSE))
+    start_utc, end_utc = s.astimezone(pytz.utc), e.astimezone(pytz.utc)
+
+    # Etapas por separado sobre una página de 30 minutos x 13 (lo que hace fetch_ticks_for_session)
+    bloque, duracion, tamaño = timedelta(minutes=30), "1800 S", "1 secs"
+    finales, b = [], start_utc
+    while b < end_utc:
+        b = min(b + bloque, end_utc)
+        finales.append(b)
+
+    def _pedir():
+        out = []
+        for fin in finales:
+            out.extend(ib.reqHistoricalData(contract, endDateTime=fin, durationStr=duracion,
+                                            barSizeSetting=tamaño, whatToShow="TRADES", useRTH=True))
+        return out
+
+    bars = c.medir("reqHistoricalData", 0, _pedir)
+    n = len(bars)
+    if not c.memoria:
+        c.etapas["reqHistoricalData"].update(filas=n, filas_s=n / c.etapas["reqHistoricalData"]["segundos"])
+    df = c.medir("bars_to_frame", n, bars_to_frame, bars, start_utc, end_utc)
+    df = c.medir("sort_values", n, lambda: df.sort_values("time", kind="stable"))
+
+    ruta = os.path.join(salida, "bars1s")
+    os.makedirs(ruta, exist_ok=True)
+    c.medir("save_parquet", n, save_session_df, ruta, SESION_BENCH.date(), df, formato="parquet")
+    if xlsx:
+        c.medir("save_xlsx", n, BackendXlsx().guardar, os.path.join(ruta, "sesion.xlsx"), df)
+
+    # Y la función completa, como la usa main
+    c.medir("fetch_ticks_for_session", n, ibd.fetch_ticks_for_session, ib, contract, s, e, "Bars1s")
+    return n, _bytes_dir(ruta)
+
+
+def bench_ticks(ibd, ib, xlsx, salida, c, n):
+    from almacen import save_session_df, BackendXlsx
+    from ingesta import ticks_to_frame
+
+    fin = datetime(2025, 3, 3, 21, 0, tzinfo=timezone.utc)
+    ticks = _ticks_sinteticos(n, fin)
+
+    def _filas():
+        rows = []
+        for t in ticks:
+            row = ibd.tick_obj_to_row(t)
+            if row is not None:
+                rows.append(row)
+        return rows
+
+    # Ruta antigua (referencia): dict por tick + DataFrame + tz_convert
+    rows = c.medir("dicts", n, _filas)
+    df = c.medir("DataFrame", n, pd.DataFrame, rows)
+    del rows
+    c.medir("tz_convert", n, lambda: df.assign(time=pd.to_datetime(df["time"]).dt.tz_convert(pytz.utc)))
+
+    # Ruta actual: página entera a columnas NumPy
+    df = c.medir("ticks_to_frame", n, ticks_to_frame, ticks, "TRADES")
+    df = c.medir("sort_values", n, lambda: df.sort_values("time", kind="stable"))
+
+    ruta = os.path.join(salida, f"ticks{n}")
+    os.makedirs(ruta, exist_ok=True)
+    c.medir("save_parquet", n, save_session_df, ruta, SESION_BENCH.date(), df, formato="parquet")
+    if xlsx and n <= 1_048_575:  # límite de filas de Excel
+        c.medir("save_xlsx", n, BackendXlsx().guardar, os.path.join(ruta, "sesion.xlsx"), df)
+    return n, _bytes_dir(ruta)
+
+
+def ejecutar(casos, xlsx, salida):
+    import ib_downloader as ibd
+    from fake_ib import FakeIB
+    from pacing import GobernadorPacing
+
+    # FakeIB responde al instante: sin ventanas ni firmas idénticas, los bloques no esperan
+    ibd.gobernador = GobernadorPacing(max_peticiones=10**9, identica=0.0, max_por_contrato=10**9)
+    ib = FakeIB(latencia=0.0, jitter=0.0)
+    ib.errorEvent += ibd.gobernador.on_error
+    resultados = {}
+    for caso in casos:
+        bench = bench_bars1s if caso == "bars1s" else bench_ticks
+        extra = () if caso == "bars1s" else (CASOS[caso],)
+        cron = Cronometro()
+        filas, disco = bench(ibd, ib, xlsx, salida, cron, *extra)
+        memoria = Cronometro(memoria=True)
+        tracemalloc.start()
+        try:
+            bench(ibd, ib, xlsx, salida, memoria, *extra)
+        finally:
+            tracemalloc.stop()
+        for nombre, e in cron.etapas.items():
+            e.update(memoria.etapas.get(nombre, {}))
+        resultados[caso] = {
+            "filas": filas,
+            "etapas": cron.etapas,
+            "total_s": sum(e["segundos"] for k, e in cron.etapas.items() if k != "fetch_ticks_for_session"),
+            "pico_py_mb": memoria.pico_mb,
+            "rss_pico_mb": _rss_pico_mb(),
+            "bytes_disco": disco,
+        }
+        print(f"\n== {caso} ({filas} filas, {disco / 2**20:.2f} MB en disco, "
+              f"pico py {memoria.pico_mb:.1f} MB) ==")
+        for nombre, e in cron.etapas.items():
+            fs = f"{e['filas_s']:,.0f} filas/s" if e["filas_s"] else "-"
+            print(f"  {nombre:<26} {e['segundos'] * 1000:10.1f} ms  {fs:>20}  pico py {e['pico_py_mb']:8.1f} MB")
+    return resultados
+
+
+def comparar(actual, anterior_path):
+    with open(anterior_path, encoding="utf-8") as f:
+        anterior = json.load(f)["resultados"]
+    print(f"\n== Comparación con {anterior_path} ==")
+    regresiones = 0
+    for caso, r in actual.items():
+        if caso not in anterior:
+            continue
+        for etapa, e in r["etapas"].items():
+            prev = anterior[caso]["etapas"].get(etapa)
+            if not prev or not prev["segundos"]:
+                continue
+            ratio = e["segundos"] / prev["segundos"]
+            marca = "  <-- REGRESIÓN" if ratio > UMBRAL_REGRESION else ""
+            regresiones += bool(marca)
+            print(f"  {caso:<10} {etapa:<26} x{ratio:5.2f}{marca}")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark descarga -> almacenamiento")
+    parser.add_argument("--casos", nargs="+", choices=list(CASOS), default=list(CASOS))
+    parser.add_argument("--xlsx", action="store_true", help="medir también la exportación XLSX (lenta)")
+    parser.add_argument("--salida", default=DIR_RESULTADOS)
+    parser.add_argument("--comparar", help="JSON de una ejecución anterior")
+    args = parser.parse_args()
+
+    try:
+        resultados = ejecutar(args.casos, args.xlsx, _TMP.name)
+    finally:
+        _TMP.cleanup()
+
+    os.makedirs(args.salida, exist_ok=True)
+    commit = _commit()
+    fichero = os.path.join(args.salida, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{commit}.json")
+    with open(fichero, "w", encoding="utf-8") as f:
+        json.dump({"commit": commit, "fecha": datetime.now().isoformat(),
+                   "python": sys.version.split()[0], "pandas": pd.__version__,
+                   "resultados": resultados}, f, indent=2)
+    print(f"\nResultados en {fichero}")
+
+    if args.comparar:
+        sys.exit(1 if comparar(resultados, args.comparar) else 0)
+
+
+if __name__ == "__main__":
+    main()
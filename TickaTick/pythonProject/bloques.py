@@ -0,0 +1,165 @@
+'''
+Tabla de troceo de peticiones reqHistoricalData por tipo de barra.
+
+parametros_barra devolvía timedelta(30) (30 días, no 30 minutos) para todas las barras y
+emparejaba mal durationStr / barSizeSetting (BarsD pedía "1 secs", Tick2Tick "5 Y").
+Aquí cada barra tiene su barSizeSetting y la duración máxima que admite IB
+(tabla "Historical Data Limitations"):
+
+    1 secs  -> 1800 S          15 mins -> 1 W
+    1 hour  -> 1 M             1 day   -> 1 Y
+
+y el rango se cubre con el menor número de bloques de ese tamaño. Tick2Tick no es una barra:
+va por reqHistoricalTicks (páginas de 1000 ticks).
+
+PlanBloques aprende de lo que observa: si las respuestas tardan más de LATENCIA_MAX_SG,
+fallan o llegan cortadas, el bloque de esa barra se reduce a la mitad; cuando vuelven a ser
+rápidas y completas, crece de nuevo hasta el máximo. El estado se guarda en JSON entre ejecuciones.
+'''
+
+import json
+import math
+import os
+import threading
+from collections import namedtuple
+from datetime import timedelta
+
+import logging
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+Barra = namedtuple("Barra", ["tamaño", "segundos", "max_sg", "min_sg"])
+
+# barSizeSetting, segundos por barra, duración máxima y mínima de una petición (segundos)
+TABLA_BARRAS = {
+    "Bars1s": Barra("1 secs", 1, 1800, 60),
+    "Bars15m": Barra("15 mins", 15 * 60, 7 * 86400, 3600),
+    "Bars1h": Barra("1 hour", 3600, 30 * 86400, 3600),
+    "BarsD": Barra("1 day", 86400, 365 * 86400, 86400),
+}
+
+LATENCIA_OBJETIVO_SG = 5.0          # por debajo, si la respuesta viene completa, el bloque puede crecer
+LATENCIA_MAX_SG = 30.0              # por encima el bloque se reduce a la mitad
+COMPLETITUD_MIN = 0.5               # fracción del bloque cubierta por debajo de la cual la respuesta "llega cortada"
+ALFA_EWMA = 0.3
+
+
+def duracion_str(segundos):
+    """Segundos -> durationStr de IB ("N S" por debajo de un día, "N D" a partir de un día)."""
+    segundos = max(1, int(math.ceil(segundos)))
+    if segundos < 86400:
+        return f"{segundos} S"
+    return f"{int(math.ceil(segundos / 86400))} D"
+
+
+class PlanBloques:
+    """Tamaño de bloque por barra, ajustado con la latencia y la cobertura de cada respuesta."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloque = {b: t.max_sg for b, t in TABLA_BARRAS.items()}
+        self._latencia = {}             # barra -> EWMA de segundos por petición
+        self.peticiones = 0
+        self.reducciones = 0
+
+    # ----------------------------
+    # Persistencia
+    # ----------------------------
+    def cargar(self, path):
+        """Recupera los tamaños aprendidos en ejecuciones anteriores (si existe el JSON)."""
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                datos = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"No se pudo leer el plan de bloques {path}: {e}")
+            return
+        with self._lock:
+            for barra, sg in datos.get("bloque", {}).items():
+                if barra in TABLA_BARRAS:
+                    t = TABLA_BARRAS[barra]
+                    self._bloque[barra] = min(t.max_sg, max(t.min_sg, int(sg)))
+            self._latencia.update(datos.get("latencia", {}))
+
+    def guardar(self, path):
+        with self._lock:
+            datos = {"bloque": dict(self._bloque), "latencia": dict(self._latencia)}
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(datos, f, indent=2)
+        os.replace(tmp, path)
+
+    # ----------------------------
+    # Planificación
+    # ----------------------------
+    def bloque_sg(self, barra):
+        if barra not in TABLA_BARRAS:
+            raise ValueError(f"Tipo de barra no soportado por reqHistoricalData: {barra}")
+        return self._bloque[barra]
+
+    def bloques(self, barra, inicio, fin):
+        """
+        Bloques que cubren [inicio, fin): lista de (block_end, durationStr, barSizeSetting).
+        Cada bloque pide exactamente su tramo (el último no se alarga hasta el tamaño completo),
+        pero nunca menos que la duración mínima de la barra.
+        """
+        t = TABLA_BARRAS.get(barra)
+        if t is None:
+            raise ValueError(f"Tipo de barra no soportado por reqHistoricalData: {barra}")
+        paso = timedelta(seconds=self.bloque_sg(barra))
+        salida = []
+        block_start = inicio
+        while block_start < fin:
+            block_end = min(block_start + paso, fin)
+            segundos = max((block_end - block_start).total_seconds(), t.min_sg)
+            salida.append((block_end, duracion_str(segundos), t.tamaño))
+            block_start = block_end
+        return salida
+
+    def observar(self, barra, segundos, cubiertos, latencia, error=False):
+        """
+        Registra una respuesta: segundos pedidos, segundos cubiertos (de la primera barra
+        recibida al final del bloque; None si no llegó nada) y latencia.
+        error=True para timeouts / fallos que no son de pacing (el pacing lo lleva el gobernador).
+        Se mira la cobertura y no el nº de filas: un valor poco líquido deja segundos sin barra.
+        """
+        t = TABLA_BARRAS.get(barra)
+        if t is None:
+            return
+        with self._lock:
+            self.peticiones += 1
+            previa = self._latencia.get(barra, latencia)
+            self._latencia[barra] = ALFA_EWMA * latencia + (1 - ALFA_EWMA) * previa
+            cortada = cubiertos is not None and cubiertos < segundos * COMPLETITUD_MIN
+            actual = self._bloque[barra]
+            if error or latencia > LATENCIA_MAX_SG:
+                nuevo = max(t.min_sg, actual // 2)
+            elif cortada:
+                # IB devolvió menos de lo pedido: el siguiente bloque no más grande que lo que cubrió
+                nuevo = max(t.min_sg, min(actual, int(cubiertos)))
+            elif self._latencia[barra] < LATENCIA_OBJETIVO_SG and segundos >= actual:
+                nuevo = min(t.max_sg, actual * 2)
+            else:
+                nuevo = actual
+            if nuevo != actual:
+                self.reducciones += nuevo < actual
+                logger.debug(f"Bloque {barra}: {actual} sg -> {nuevo} sg (latencia {latencia:.1f} sg)")
+                self._bloque[barra] = nuevo
+
+    def latencia(self, barra, defecto):
+        """Latencia observada (EWMA) de las peticiones de la barra, o defecto si no hay."""
+        with self._lock:
+            return self._latencia.get(barra, defecto)
+
+    def resumen(self):
+        return (f"{self.peticiones} peticiones de barras, {self.reducciones} reducciones de bloque, "
+                f"bloques {self._bloque}")
+
+
+# Instancia compartida por los descargadores del proceso
+plan_bloques = PlanBloques()
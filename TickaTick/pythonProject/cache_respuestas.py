@@ -0,0 +1,247 @@
+'''
+Caché en disco de las respuestas crudas de reqHistoricalData / reqHistoricalTicks.
+
+Si save_session_df (o cualquier paso posterior) falla, al relanzar ib_downloader se vuelven a
+pedir exactamente las mismas páginas: gastan cupo de pacing y caen en la penalización de
+petición idéntica. Aquí cada respuesta se guarda tal cual llega (lista de BarData /
+HistoricalTick*, con pickle), direccionada por el hash de su firma:
+
+    barras: (conId, whatToShow, endDateTime, durationStr, barSizeSetting, useRTH)
+    ticks:  (conId, whatToShow, endDateTime, numberOfTicks, useRth)
+
+    <dir>/ab/abcdef....pkl      la respuesta
+    <dir>/respuestas.sqlite     índice: bytes, creación, último uso y caducidad de cada firma
+
+Las páginas de días pasados no cambian y no caducan. Las que solapan el día en curso (IB aún
+puede completarlas o corregirlas) caducan a los TTL_HOY_SG. Si la caché pasa de MAX_BYTES se
+borran las respuestas usadas hace más tiempo (LRU) hasta bajar a FRACCION_TRAS_PURGA.
+No se guardan respuestas vacías: ib_insync también devuelve [] cuando la petición falla.
+
+Como las firmas incluyen endDateTime y durationStr, una reejecución sólo acierta si trocea la
+sesión igual; el plan de bloques se guarda entre ejecuciones (plan_bloques.json), así que lo
+normal es que sí.
+
+Uso (inspeccionar / vaciar la caché):
+    python cache_respuestas.py E:/DATOSBOLSA/cache_ib
+    python cache_respuestas.py E:/DATOSBOLSA/cache_ib --vaciar
+'''
+
+import argparse
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import pandas as pd
+import pytz
+
+import logging
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+MAX_BYTES = 2 * 1024 ** 3           # tamaño máximo de la caché (2 GB)
+FRACCION_TRAS_PURGA = 0.9           # al pasarse, se purga hasta esta fracción de MAX_BYTES
+TTL_HOY_SG = 15 * 60                # caducidad de las páginas que solapan el día en curso
+INDICE_DB = "respuestas.sqlite"
+NY_TZ = pytz.timezone("America/New_York")
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS respuestas (
+    clave    TEXT PRIMARY KEY,
+    firma    TEXT NOT NULL,
+    bytes    INTEGER NOT NULL,
+    creado   REAL NOT NULL,
+    usado    REAL NOT NULL,
+    expira   REAL
+);
+CREATE INDEX IF NOT EXISTS idx_respuestas_usado ON respuestas (usado);
+"""
+
+Firma = namedtuple("Firma", ["tipo", "con_id", "what_to_show", "fin", "duracion", "tamaño", "rth"])
+
+
+def _utc(ts):
+    ts = pd.Timestamp(ts)
+    return ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+
+
+def firma_barras(contract, what_to_show, end, duracion, tamaño, rth):
+    """Firma de una petición reqHistoricalData."""
+    return Firma("barras", contract.conId, what_to_show, _utc(end), duracion, tamaño, bool(rth))
+
+
+def firma_ticks(contract, what_to_show, end, n_ticks, rth):
+    """Firma de una página de reqHistoricalTicks."""
+    return Firma("ticks", contract.conId, what_to_show, _utc(end), int(n_ticks), None, bool(rth))
+
+
+def clave_firma(firma):
+    texto = "|".join(str(v) for v in firma._replace(fin=firma.fin.isoformat()))
+    return hashlib.sha1(texto.encode("utf-8")).hexdigest()
+
+
+class CacheRespuestas:
+    """
+    Caché de respuestas (ver docstring del módulo). Sin abrir() no hace nada: obtener()
+    devuelve siempre None y guardar() no guarda, así los scripts que no la usan no cambian.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl_hoy=TTL_HOY_SG, reloj=time.time):
+        self.max_bytes = max_bytes
+        self.ttl_hoy = ttl_hoy
+        self.reloj = reloj
+        self.dir = None
+        self._con = None
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def abrir(self, directorio):
+        os.makedirs(directorio, exist_ok=True)
+        self.dir = directorio
+        self._con = sqlite3.connect(os.path.join(directorio, INDICE_DB), check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.executescript(_ESQUEMA)
+        self._con.commit()
+        return self
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+    @property
+    def abierta(self):
+        return self._con is not None
+
+    def _ruta(self, clave):
+        return os.path.join(self.dir, clave[:2], clave + ".pkl")
+
+    # ----------------------------
+    # Lectura / escritura
+    # ----------------------------
+    def obtener(self, firma):
+        """Respuesta guardada para la firma, o None si no está o ha caducado."""
+        if not self.abierta:
+            return None
+        clave = clave_firma(firma)
+        ahora = self.reloj()
+        with self._lock:
+            fila = self._con.execute("SELECT expira FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+            if fila is None or (fila[0] is not None and fila[0] <= ahora):
+                if fila is not None:
+                    self._borrar([clave])
+                self.fallos += 1
+                return None
+            try:
+                with open(self._ruta(clave), "rb") as f:
+                    respuesta = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                logger.warning(f"Caché de respuestas: {clave} ilegible ({e}), se descarta")
+                self._borrar([clave])
+                self.fallos += 1
+                return None
+            self._con.execute("UPDATE respuestas SET usado = ? WHERE clave = ?", (ahora, clave))
+            self._con.commit()
+        self.aciertos += 1
+        return respuesta
+
+    def guardar(self, firma, respuesta):
+        """Guarda la respuesta cruda de la firma (las vacías no)."""
+        if not self.abierta or not respuesta:
+            return
+        clave = clave_firma(firma)
+        datos = pickle.dumps(list(respuesta), protocol=pickle.HIGHEST_PROTOCOL)
+        ruta = self._ruta(clave)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tmp = ruta + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(datos)
+        os.replace(tmp, ruta)
+
+        ahora = self.reloj()
+        expira = ahora + self.ttl_hoy if self._solapa_hoy(firma, ahora) else None
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO respuestas VALUES (?, ?, ?, ?, ?, ?)",
+                (clave, "|".join(str(v) for v in firma), len(datos), ahora, ahora, expira)
+            )
+            self._con.commit()
+            self._purgar()
+
+    @staticmethod
+    def _solapa_hoy(firma, ahora):
+        """True si la página termina en el día en curso (NY) o después."""
+        hoy = datetime.fromtimestamp(ahora, pytz.utc).astimezone(NY_TZ).date()
+        return firma.fin.tz_convert(NY_TZ).date() >= hoy
+
+    # ----------------------------
+    # Purga
+    # ----------------------------
+    def _borrar(self, claves):
+        for clave in claves:
+            try:
+                os.remove(self._ruta(clave))
+            except FileNotFoundError:
+                pass
+        self._con.executemany("DELETE FROM respuestas WHERE clave = ?", [(c,) for c in claves])
+        self._con.commit()
+
+    def _purgar(self):
+        """Caducadas fuera y, si se pasa de max_bytes, LRU hasta FRACCION_TRAS_PURGA."""
+        caducadas = [c for (c,) in self._con.execute(
+            "SELECT clave FROM respuestas WHERE expira IS NOT NULL AND expira <= ?", (self.reloj(),))]
+        if caducadas:
+            self._borrar(caducadas)
+        total = self._con.execute("SELECT COALESCE(SUM(bytes), 0) FROM respuestas").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        objetivo = total - FRACCION_TRAS_PURGA * self.max_bytes
+        fuera, liberados = [], 0
+        for clave, n in self._con.execute("SELECT clave, bytes FROM respuestas ORDER BY usado").fetchall():
+            if liberados >= objetivo:
+                break
+            fuera.append(clave)
+            liberados += n
+        self._borrar(fuera)
+        logger.info(f"Caché de respuestas: {len(fuera)} respuestas purgadas ({liberados / 1024 ** 2:.1f} MB)")
+
+    def vaciar(self):
+        with self._lock:
+            self._borrar([c for (c,) in self._con.execute("SELECT clave FROM respuestas")])
+
+    def resumen(self):
+        if not self.abierta:
+            return "caché de respuestas desactivada"
+        n, total = self._con.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM respuestas").fetchone()
+        return (f"{self.aciertos} aciertos, {self.fallos} fallos; "
+                f"{n} respuestas, {total / 1024 ** 2:.1f} MB en disco")
+
+
+# instancia compartida por los descargadores (la abre cada main)
+cache_respuestas = CacheRespuestas()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caché de respuestas crudas de IB")
+    parser.add_argument("directorio")
+    parser.add_argument("--vaciar", action="store_true", help="borrar todas las respuestas")
+    args = parser.parse_args()
+
+    cache = CacheRespuestas().abrir(args.directorio)
+    if args.vaciar:
+        cache.vaciar()
+    print(cache.resumen())
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
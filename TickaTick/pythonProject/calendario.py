@@ -0,0 +1,272 @@
+'''
+Calendario de mercado: festivos, cierres anticipados y horario de sesión por tipo de activo.
+
+next_business_day / prev_business_day / is_market_open sólo saltaban fines de semana y la
+sesión era siempre 9:30–16:00 NY. Con esto:
+
+1.- Los festivos de NYSE (y los cierres extraordinarios) no se piden a IB.
+2.- Los días de cierre anticipado (3 de julio, viernes de Acción de Gracias, 24 de diciembre)
+    se piden con el cierre real (13:00).
+3.- Cada tipo de activo usa su calendario: stock/index -> NYSE, future -> CME Globex
+    (18:00 del día anterior a 17:00, sesión completa), forex -> 17:00 a 17:00.
+
+Las reglas se calculan una vez por año y se guardan en una tabla compacta (ordinal del día,
+apertura y cierre en ns UTC como arrays NumPy); las consultas son búsquedas binarias.
+Las reglas de CME y FX son una aproximación (CME: cerrado en Año Nuevo, Viernes Santo y
+Navidad; el resto de festivos de EEUU cierra a las 13:00).
+'''
+
+from datetime import date, datetime, timedelta, time as dtime
+
+import numpy as np
+import pandas as pd
+import pytz
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+NY_TZ = pytz.timezone("America/New_York")
+
+# Horario de cada calendario (hora de Nueva York). dia_anterior: la sesión del día d abre la
+# víspera (futuros y divisas). rth: useRTH que hay que pasar a IB para obtener esa sesión.
+MERCADOS = {
+    "NYSE": {"apertura": dtime(9, 30), "cierre": dtime(16, 0), "cierre_anticipado": dtime(13, 0),
+             "dia_anterior": False, "rth": True},
+    "CME": {"apertura": dtime(18, 0), "cierre": dtime(17, 0), "cierre_anticipado": dtime(13, 0),
+            "dia_anterior": True, "rth": False},
+    "FX": {"apertura": dtime(17, 0), "cierre": dtime(17, 0), "cierre_anticipado": None,
+           "dia_anterior": True, "rth": False},
+}
+
+# Tipo de activos.xlsx / secType de IB -> calendario
+CALENDARIO_POR_TIPO = {"stock": "NYSE", "index": "NYSE", "future": "CME", "forex": "FX"}
+CALENDARIO_POR_SECTYPE = {"STK": "NYSE", "IND": "NYSE", "FUT": "CME", "CASH": "FX"}
+
+# Cierres extraordinarios de NYSE (duelos nacionales, 11-S, huracán Sandy)
+CIERRES_EXTRA = {
+    date(2001, 9, 11), date(2001, 9, 12), date(2001, 9, 13), date(2001, 9, 14),
+    date(2004, 6, 11), date(2007, 1, 2), date(2012, 10, 29), date(2012, 10, 30),
+    date(2018, 12, 5), date(2025, 1, 9),
+}
+
+
+# ----------------------------
+# REGLAS DE FESTIVOS
+# ----------------------------
+def _domingo_pascua(año):
+    """Algoritmo anónimo gregoriano (Meeus/Jones/Butcher)."""
+    a, b, c = año % 19, año // 100, año % 100
+    d, e = b // 4, b % 4
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    mes = (h + l - 7 * m + 114) // 31
+    dia = (h + l - 7 * m + 114) % 31 + 1
+    return date(año, mes, dia)
+
+
+def _enesimo_dia_semana(año, mes, dia_semana, n):
+    """n-ésimo lunes/martes/... del mes (n=-1: el último)."""
+    if n > 0:
+        d = date(año, mes, 1)
+        d += timedelta(days=(dia_semana - d.weekday()) % 7)
+        return d + timedelta(weeks=n - 1)
+    siguiente = date(año + (mes == 12), mes % 12 + 1, 1)
+    d = siguiente - timedelta(days=1)
+    return d - timedelta(days=(d.weekday() - dia_semana) % 7)
+
+
+def _observado(d):
+    """Festivo en sábado -> viernes anterior; en domingo -> lunes siguiente."""
+    if d.weekday() == 5:
+        return d - timedelta(days=1)
+    if d.weekday() == 6:
+        return d + timedelta(days=1)
+    return d
+
+
+def _observados(año, mes, dia):
+    """
+    Días observados de un festivo de fecha fija que caen en el año: el 1 de enero en sábado
+    se observa el 31 de diciembre del año anterior (las tablas se construyen por año).
+    """
+    return {o for o in (_observado(date(a, mes, dia)) for a in (año, año + 1)) if o.year == año}
+
+
+def festivos_nyse(año):
+    """Días sin sesión en NYSE ese año (sin contar fines de semana)."""
+    dias = set()
+    año_nuevo = date(año, 1, 1)
+    if año_nuevo.weekday() != 5:            # en sábado no se traslada al viernes (regla NYSE)
+        dias.add(_observado(año_nuevo))
+    if año >= 1998:
+        dias.add(_enesimo_dia_semana(año, 1, 0, 3))      # Martin Luther King
+    dias.add(_enesimo_dia_semana(año, 2, 0, 3))          # Presidents Day
+    dias.add(_domingo_pascua(año) - timedelta(days=2))   # Viernes Santo
+    dias.add(_enesimo_dia_semana(año, 5, 0, -1))         # Memorial Day
+    if año >= 2022:
+        dias.add(_observado(date(año, 6, 19)))           # Juneteenth
+    dias.add(_observado(date(año, 7, 4)))                # Independence Day
+    dias.add(_enesimo_dia_semana(año, 9, 0, 1))          # Labor Day
+    dias.add(_enesimo_dia_semana(año, 11, 3, 4))         # Acción de Gracias
+    dias.add(_observado(date(año, 12, 25)))              # Navidad
+    dias |= {d for d in CIERRES_EXTRA if d.year == año}
+    return dias
+
+
+def cierres_anticipados_nyse(año):
+    """Días con cierre a las 13:00 en NYSE."""
+    dias = set()
+    julio3 = date(año, 7, 3)
+    if julio3.weekday() < 4:                 # lunes-jueves (en viernes el 3 es el festivo observado)
+        dias.add(julio3)
+    dias.add(_enesimo_dia_semana(año, 11, 3, 4) + timedelta(days=1))
+    nochebuena = date(año, 12, 24)
+    if nochebuena.weekday() < 4:
+        dias.add(nochebuena)
+    return dias - festivos_nyse(año)
+
+
+def _reglas(mercado, año):
+    """(cerrados, cierre_anticipado) del mercado para ese año."""
+    nyse = festivos_nyse(año)
+    if mercado == "NYSE":
+        return nyse, cierres_anticipados_nyse(año)
+    if mercado == "CME":
+        cerrados = _observados(año, 1, 1) | _observados(año, 12, 25) | {_domingo_pascua(año) - timedelta(days=2)}
+        return cerrados, (nyse | cierres_anticipados_nyse(año)) - cerrados
+    if mercado == "FX":
+        return {date(año, 1, 1), date(año, 12, 25)}, set()
+    raise ValueError(f"Calendario no soportado: {mercado}")
+
+
+# ----------------------------
+# CALENDARIO
+# ----------------------------
+class Calendario:
+    """
+    Sesiones de un mercado. La tabla de cada año (ordinal del día, apertura y cierre en
+    ns UTC) se construye la primera vez que se consulta ese año.
+    """
+
+    def __init__(self, mercado="NYSE"):
+        self.mercado = mercado
+        self._horario = MERCADOS[mercado]
+        self.rth = self._horario["rth"]
+        self._tablas = {}
+
+    def _tabla(self, año):
+        tabla = self._tablas.get(año)
+        if tabla is None:
+            tabla = self._tablas[año] = self._construir(año)
+        return tabla
+
+    def _construir(self, año):
+        cerrados, anticipados = _reglas(self.mercado, año)
+        h = self._horario
+        ordinales, aperturas, cierres = [], [], []
+        d = date(año, 1, 1)
+        while d.year == año:
+            if d.weekday() < 5 and d not in cerrados:
+                dia_apertura = d - timedelta(days=1) if h["dia_anterior"] else d
+                cierre = h["cierre_anticipado"] if d in anticipados else h["cierre"]
+                ordinales.append(d.toordinal())
+                aperturas.append(NY_TZ.localize(datetime.combine(dia_apertura, h["apertura"])))
+                cierres.append(NY_TZ.localize(datetime.combine(d, cierre)))
+            d += timedelta(days=1)
+        return (np.array(ordinales, dtype=np.int32),
+                pd.DatetimeIndex(aperturas).tz_convert("UTC").astype("datetime64[ns, UTC]").asi8,
+                pd.DatetimeIndex(cierres).tz_convert("UTC").astype("datetime64[ns, UTC]").asi8)
+
+    def _posicion(self, d):
+        ordinales = self._tabla(d.year)[0]
+        i = int(np.searchsorted(ordinales, d.toordinal()))
+        return i, i < len(ordinales) and ordinales[i] == d.toordinal()
+
+    def es_habil(self, d):
+        return self._posicion(d)[1]
+
+    def sesion(self, d):
+        """(apertura, cierre) tz-aware NY de la sesión del día d, o None si no hay sesión."""
+        i, hay = self._posicion(d)
+        if not hay:
+            return None
+        _, aperturas, cierres = self._tabla(d.year)
+        return (pd.Timestamp(int(aperturas[i]), tz="UTC").tz_convert(NY_TZ).to_pydatetime(),
+                pd.Timestamp(int(cierres[i]), tz="UTC").tz_convert(NY_TZ).to_pydatetime())
+
+    def siguiente(self, d):
+        """Primer día con sesión posterior a d."""
+        i, hay = self._posicion(d)
+        i += hay
+        año = d.year
+        while True:
+            ordinales = self._tabla(año)[0]
+            if i < len(ordinales):
+                return date.fromordinal(int(ordinales[i]))
+            año, i = año + 1, 0
+
+    def anterior(self, d):
+        """Último día con sesión anterior a d."""
+        i, _ = self._posicion(d)
+        i -= 1
+        año = d.year
+        while i < 0:
+            año -= 1
+            i = len(self._tabla(año)[0]) - 1
+        return date.fromordinal(int(self._tabla(año)[0][i]))
+
+    def sesiones(self, desde, hasta):
+        """Días con sesión en [desde, hasta]."""
+        dias = []
+        for año in range(desde.year, hasta.year + 1):
+            ordinales = self._tabla(año)[0]
+            sel = ordinales[(ordinales >= desde.toordinal()) & (ordinales <= hasta.toordinal())]
+            dias.extend(date.fromordinal(int(o)) for o in sel)
+        return dias
+
+    def retroceder(self, d, n):
+        """El n-ésimo día con sesión contando hacia atrás desde d (d incluido si tiene sesión)."""
+        if self.es_habil(d):
+            n -= 1
+        for _ in range(n):
+            d = self.anterior(d)
+        return d if self.es_habil(d) else self.siguiente(d)
+
+    def abierto(self, ahora=None):
+        """True si 'ahora' cae dentro de alguna sesión (la de hoy o, en futuros, la de mañana)."""
+        ahora = ahora or datetime.now(pytz.utc)
+        ns = pd.Timestamp(ahora).tz_convert("UTC").value
+        hoy = pd.Timestamp(ahora).tz_convert(NY_TZ).date()
+        for d in (hoy, hoy + timedelta(days=1)):
+            i, hay = self._posicion(d)
+            if hay:
+                _, aperturas, cierres = self._tabla(d.year)
+                if aperturas[i] <= ns <= cierres[i]:
+                    return True
+        return False
+
+
+_CALENDARIOS = {}
+
+
+def calendario(mercado="NYSE"):
+    """Instancia compartida del calendario de un mercado (la tabla se construye una vez)."""
+    cal = _CALENDARIOS.get(mercado)
+    if cal is None:
+        cal = _CALENDARIOS[mercado] = Calendario(mercado)
+    return cal
+
+
+def calendario_tipo(tipo):
+    """Calendario para el Tipo de activos.xlsx (stock, future, forex, index)."""
+    return calendario(CALENDARIO_POR_TIPO.get(str(tipo).lower(), "NYSE"))
+
+
+def calendario_contrato(contract):
+    """Calendario para un contrato de IB según su secType."""
+    return calendario(CALENDARIO_POR_SECTYPE.get(getattr(contract, "secType", ""), "NYSE"))
@@ -0,0 +1,211 @@
+'''
+Pool de conexiones a TWS / Gateway con varios clientId.
+
+Cada script abría un único IB() con un clientId fijo (ib_downloader 1, CollectOI 19,
+Ordenes_IB 0): todo el histórico, el market data y las ejecuciones iban por el mismo socket
+y el mismo bucle, y una respuesta histórica grande frenaba al resto. El pool abre varias
+conexiones al mismo gateway, cada una de un tipo:
+
+    historico     reqHistoricalData / reqHistoricalTicks / qualifyContracts
+    mercado       reqMktData (snapshots, griegas, open interest), reqContractDetails
+    ejecuciones   execDetails / commissionReport / orderStatus (clientId 0 = todas las órdenes)
+
+1.- elegir(tipo) / usar(tipo) dan la conexión viva de ese tipo con menos peticiones en vuelo.
+    Si no queda ninguna viva se usa otra de otro tipo, nunca una de ejecuciones (su flujo
+    de eventos no debe esperar detrás de descargas).
+2.- Salud: comprobar_async hace un ping (reqCurrentTime) a cada conexión; la que no responde
+    en TIMEOUT_PING_SG se desconecta. Las caídas se reconectan con espera exponencial
+    (RECONEXION_MIN_SG, el doble cada fallo, hasta RECONEXION_MAX_SG). vigilar_async lo repite
+    cada INTERVALO_SALUD_SG; los scripts síncronos llaman a comprobar() entre sesiones.
+3.- suscribir(evento, handler) engancha el handler en todas las conexiones (o sólo en las de
+    un tipo). Se mantiene al reconectar porque se reutiliza el mismo objeto IB.
+
+El pacing de IB es por cuenta, no por conexión: el gobernador (pacing.py) sigue siendo uno
+solo y el pool no aumenta el cupo de peticiones históricas, sólo aísla unos flujos de otros.
+'''
+
+import asyncio
+import time
+from contextlib import contextmanager
+
+import logging
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+TIPO_HISTORICO = "historico"
+TIPO_MERCADO = "mercado"
+TIPO_EJECUCIONES = "ejecuciones"
+TIPOS = (TIPO_HISTORICO, TIPO_MERCADO, TIPO_EJECUCIONES)
+
+TIMEOUT_CONEXION_SG = 10
+TIMEOUT_PING_SG = 5                 # sin respuesta a reqCurrentTime en este tiempo: conexión colgada
+INTERVALO_SALUD_SG = 30             # cada cuánto revisa vigilar_async
+RECONEXION_MIN_SG = 1.0
+RECONEXION_MAX_SG = 60.0
+
+
+class Conexion:
+    """Una conexión del pool: el IB, su tipo y clientId y su estado de reconexión."""
+
+    def __init__(self, ib, tipo, client_id):
+        self.ib = ib
+        self.tipo = tipo
+        self.client_id = client_id
+        self.en_vuelo = 0
+        self.reconexiones = 0
+        self.fallos = 0
+        self._espera = RECONEXION_MIN_SG
+        self._proximo_intento = 0.0
+
+    @property
+    def viva(self):
+        return self.ib.isConnected()
+
+    def __repr__(self):
+        return f"{self.tipo}#{self.client_id}"
+
+
+class PoolConexiones:
+
+    def __init__(self, clientes, host, port, fabrica, reloj=time.monotonic):
+        """
+        clientes: {tipo: [clientId, ...]}; fabrica: crea un IB sin conectar (IB, FakeIB...).
+        """
+        ids = [cid for lista in clientes.values() for cid in lista]
+        if len(ids) != len(set(ids)):
+            raise ValueError(f"clientId repetidos en el pool: {clientes}")
+        desconocidos = set(clientes) - set(TIPOS)
+        if desconocidos:
+            raise ValueError(f"Tipos de conexión no soportados: {sorted(desconocidos)}")
+        self.host = host
+        self.port = port
+        self.reloj = reloj
+        self.conexiones = [Conexion(fabrica(), tipo, cid) for tipo, lista in clientes.items() for cid in lista]
+
+    # ----------------------------
+    # Eventos
+    # ----------------------------
+    def suscribir(self, evento, handler, tipo=None):
+        """Engancha handler a ib.<evento> de todas las conexiones (o sólo las del tipo)."""
+        for c in self.conexiones:
+            if tipo is None or c.tipo == tipo:
+                ev = getattr(c.ib, evento)
+                ev += handler
+
+    # ----------------------------
+    # Conexión
+    # ----------------------------
+    def _exito(self, c, reconexion):
+        c.reconexiones += reconexion
+        c._espera = RECONEXION_MIN_SG
+        logger.info(f"** Conectado a IB {c} en {self.host}:{self.port}" + (" (reconexión)" if reconexion else ""))
+
+    def _fallo(self, c, e):
+        c.fallos += 1
+        c._proximo_intento = self.reloj() + c._espera
+        logger.warning(f"⚠️ Conexión IB {c} caída o sin respuesta ({e}); reintento en {c._espera:.0f} sg")
+        c._espera = min(RECONEXION_MAX_SG, c._espera * 2)
+        try:
+            c.ib.disconnect()
+        except Exception:
+            pass
+
+    def _toca_intento(self, c):
+        return not c.viva and self.reloj() >= c._proximo_intento
+
+    def conectar(self):
+        """Conecta todas (síncrono). Error si no se ha podido conectar ninguna."""
+        for c in self.conexiones:
+            self._conectar(c, reconexion=False)
+        self._alguna_viva()
+        return self
+
+    async def conectar_async(self):
+        await asyncio.gather(*(self._conectar_async(c, reconexion=False) for c in self.conexiones))
+        self._alguna_viva()
+        return self
+
+    def _conectar(self, c, reconexion):
+        try:
+            c.ib.connect(self.host, self.port, clientId=c.client_id, timeout=TIMEOUT_CONEXION_SG)
+            self._exito(c, reconexion)
+        except Exception as e:
+            self._fallo(c, e)
+
+    async def _conectar_async(self, c, reconexion):
+        try:
+            await c.ib.connectAsync(self.host, self.port, clientId=c.client_id, timeout=TIMEOUT_CONEXION_SG)
+            self._exito(c, reconexion)
+        except Exception as e:
+            self._fallo(c, e)
+
+    def _alguna_viva(self):
+        if not any(c.viva for c in self.conexiones):
+            raise ConnectionError(f"❌ No se pudo conectar a TWS/Gateway en {self.host}:{self.port}")
+
+    def desconectar(self):
+        for c in self.conexiones:
+            c.ib.disconnect()
+
+    # ----------------------------
+    # Salud
+    # ----------------------------
+    def comprobar(self):
+        """Reconecta las conexiones caídas a las que ya les toque (sin ping: para scripts síncronos)."""
+        for c in self.conexiones:
+            if self._toca_intento(c):
+                self._conectar(c, reconexion=True)
+
+    async def comprobar_async(self):
+        """Ping a las vivas y reconexión de las caídas a las que ya les toque."""
+        async def revisar(c):
+            if c.viva:
+                try:
+                    await asyncio.wait_for(c.ib.reqCurrentTimeAsync(), TIMEOUT_PING_SG)
+                except Exception as e:
+                    self._fallo(c, str(e) or "timeout")
+            elif self._toca_intento(c):
+                await self._conectar_async(c, reconexion=True)
+
+        await asyncio.gather(*(revisar(c) for c in self.conexiones))
+
+    async def vigilar_async(self, intervalo=INTERVALO_SALUD_SG):
+        """Bucle de salud (lanzarlo con create_task y cancelarlo al terminar)."""
+        while True:
+            await asyncio.sleep(intervalo)
+            await self.comprobar_async()
+
+    # ----------------------------
+    # Enrutado
+    # ----------------------------
+    def elegir(self, tipo):
+        """Conexión viva del tipo con menos peticiones en vuelo (o de otro tipo si no hay)."""
+        candidatas = [c for c in self.conexiones if c.tipo == tipo and c.viva]
+        if not candidatas:
+            candidatas = [c for c in self.conexiones
+                          if c.viva and (c.tipo != TIPO_EJECUCIONES or tipo == TIPO_EJECUCIONES)]
+            if not candidatas:
+                raise ConnectionError(f"Sin conexión viva a IB para {tipo}")
+        return min(candidatas, key=lambda c: c.en_vuelo)
+
+    def ib(self, tipo):
+        """IB de la conexión elegida, para llamadas sueltas."""
+        return self.elegir(tipo).ib
+
+    @contextmanager
+    def usar(self, tipo):
+        """with pool.usar(tipo) as ib: cuenta la petición en vuelo mientras dura el bloque."""
+        c = self.elegir(tipo)
+        c.en_vuelo += 1
+        try:
+            yield c.ib
+        finally:
+            c.en_vuelo -= 1
+
+    def resumen(self):
+        return ", ".join(f"{c} {'ok' if c.viva else 'caída'} ({c.reconexiones} reconexiones)"
+                         for c in self.conexiones)
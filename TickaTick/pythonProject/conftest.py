@@ -0,0 +1,11 @@
+'''
+Configuración común de las pruebas (pytest, sin TWS).
+
+ib_downloader crea LOG_DIR bajo BASE_DIR al importarse: antes de importar nada se apunta
+DATOSBOLSA_DIR a un directorio temporal para no tocar E:/DATOSBOLSA.
+'''
+
+import os
+import tempfile
+
+os.environ.setdefault("DATOSBOLSA_DIR", tempfile.mkdtemp(prefix="pruebas_ib_"))
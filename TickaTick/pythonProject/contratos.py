@@ -0,0 +1,224 @@
+'''
+Caché persistente de contratos cualificados (contratos.sqlite junto a BASE_DIR).
+
+ib_downloader, motor_async, CollectOI y Ordenes_IB hacen un qualifyContracts (o un
+reqContractDetails) por cada acción y cada opción en cada ejecución, aunque el conId casi
+nunca cambia. Aquí se guarda, por contrato, lo que rellena qualifyContracts (conId,
+localSymbol, tradingClass, multiplier, primaryExchange, vencimiento completo):
+
+    clave: (symbol, secType, exchange, currency, vencimiento, strike, right)
+
+1.- Un contrato cualificado hoy (día de NY) sale de la caché sin ir a IB.
+2.- Los que no están o se cualificaron otro día se piden a IB todos juntos, en una sola
+    llamada a qualifyContracts por lote: el refresco diario se hace de golpe la primera vez
+    que cada script pide su lista de contratos.
+3.- Opciones y futuros se borran al día siguiente de su vencimiento.
+4.- existe_async recuerda también los contratos que NO existen (strikes no listados), para
+    que filtra_strikes_validos no vuelva a preguntar por ellos en el día.
+
+Sin abrir() la caché no hace nada y todo va directo a IB.
+'''
+
+import json
+import os
+import sqlite3
+import threading
+from calendar import monthrange
+from datetime import date, datetime
+
+import pytz
+
+import logging
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+CONTRATOS_DB = os.path.join(os.environ.get("DATOSBOLSA_DIR", "E:/DATOSBOLSA"), "contratos.sqlite")
+NY_TZ = pytz.timezone("America/New_York")
+
+# atributos que rellena qualifyContracts y se copian al contrato desde la caché
+CAMPOS_CUALIFICADOS = ["conId", "localSymbol", "tradingClass", "multiplier", "primaryExchange",
+                       "lastTradeDateOrContractMonth"]
+SECTYPES_CON_VENCIMIENTO = {"OPT", "FUT", "FOP"}
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS contratos (
+    clave      TEXT PRIMARY KEY,
+    symbol     TEXT NOT NULL,
+    sec_type   TEXT NOT NULL,
+    existe     INTEGER NOT NULL,
+    campos     TEXT,
+    dia        TEXT NOT NULL,
+    caduca     TEXT
+);
+"""
+
+
+def _hoy():
+    return datetime.now(pytz.utc).astimezone(NY_TZ).date()
+
+
+def clave_contrato(contract):
+    """(symbol, secType, exchange, currency, vencimiento, strike, right) como texto."""
+    strike = float(getattr(contract, "strike", 0) or 0)
+    partes = [getattr(contract, "symbol", ""), getattr(contract, "secType", ""),
+              getattr(contract, "exchange", ""), getattr(contract, "currency", ""),
+              getattr(contract, "lastTradeDateOrContractMonth", ""), f"{strike:g}",
+              getattr(contract, "right", "")]
+    return "|".join(str(p or "") for p in partes)
+
+
+def vencimiento(contract):
+    """Último día de vida de una opción / futuro (AAAAMMDD o AAAAMM: fin de mes), o None."""
+    if getattr(contract, "secType", "") not in SECTYPES_CON_VENCIMIENTO:
+        return None
+    texto = str(getattr(contract, "lastTradeDateOrContractMonth", "") or "")[:8]
+    try:
+        if len(texto) == 8:
+            return datetime.strptime(texto, "%Y%m%d").date()
+        if len(texto) == 6:
+            año, mes = int(texto[:4]), int(texto[4:])
+            return date(año, mes, monthrange(año, mes)[1])
+    except ValueError:
+        pass
+    return None
+
+
+class CacheContratos:
+
+    def __init__(self):
+        self._con = None
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.peticiones = 0
+
+    def abrir(self, path=CONTRATOS_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.executescript(_ESQUEMA)
+        self._con.commit()
+        self.purgar_vencidos()
+        return self
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+    @property
+    def abierta(self):
+        return self._con is not None
+
+    # ----------------------------
+    # Filas
+    # ----------------------------
+    def _buscar(self, clave, hoy):
+        """(existe, campos) si el contrato se cualificó hoy y no ha vencido; si no, None."""
+        with self._lock:
+            fila = self._con.execute("SELECT existe, campos, dia, caduca FROM contratos WHERE clave = ?",
+                                     (clave,)).fetchone()
+        if fila is None or fila[2] != hoy.isoformat() or (fila[3] and fila[3] < hoy.isoformat()):
+            return None
+        return bool(fila[0]), json.loads(fila[1]) if fila[1] else None
+
+    def _anotar(self, clave, contract, existe, hoy):
+        campos = {c: getattr(contract, c, None) for c in CAMPOS_CUALIFICADOS} if existe else None
+        caduca = vencimiento(contract)
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO contratos VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (clave, getattr(contract, "symbol", ""), getattr(contract, "secType", ""),
+                 int(existe), json.dumps(campos) if campos else None, hoy.isoformat(),
+                 caduca.isoformat() if caduca else None)
+            )
+            self._con.commit()
+
+    @staticmethod
+    def _aplicar(contract, campos):
+        for c, v in campos.items():
+            if v not in (None, ""):
+                setattr(contract, c, v)
+
+    def purgar_vencidos(self, hoy=None):
+        """Borra opciones y futuros ya vencidos. Devuelve cuántos."""
+        hoy = hoy or _hoy()
+        with self._lock:
+            n = self._con.execute("DELETE FROM contratos WHERE caduca IS NOT NULL AND caduca < ?",
+                                  (hoy.isoformat(),)).rowcount
+            self._con.commit()
+        if n:
+            logger.info(f"Caché de contratos: {n} contratos vencidos borrados")
+        return n
+
+    # ----------------------------
+    # Cualificación
+    # ----------------------------
+    def _separar(self, contracts, hoy):
+        """
+        Aplica los aciertos y devuelve [(clave, contrato)] de los que hay que pedir a IB.
+        La clave se calcula antes de cualificar: IB completa el vencimiento (AAAAMM -> AAAAMMDD).
+        """
+        pendientes = []
+        for c in contracts:
+            clave = clave_contrato(c)
+            fila = self._buscar(clave, hoy) if self.abierta else None
+            if fila is not None and fila[0]:
+                self._aplicar(c, fila[1])
+                self.aciertos += 1
+            else:
+                pendientes.append((clave, c))
+        return pendientes
+
+    def _registrar(self, pendientes, hoy):
+        self.peticiones += bool(pendientes)
+        if self.abierta:
+            for clave, c in pendientes:
+                if getattr(c, "conId", 0):
+                    self._anotar(clave, c, True, hoy)
+
+    def cualificar(self, ib, *contracts):
+        """Como ib.qualifyContracts: rellena los contratos y devuelve los cualificados."""
+        hoy = _hoy()
+        pendientes = self._separar(contracts, hoy)
+        if pendientes:
+            ib.qualifyContracts(*[c for _, c in pendientes])
+            self._registrar(pendientes, hoy)
+        return [c for c in contracts if getattr(c, "conId", 0)]
+
+    async def cualificar_async(self, ib, *contracts):
+        """Como ib.qualifyContractsAsync, con la caché delante."""
+        hoy = _hoy()
+        pendientes = self._separar(contracts, hoy)
+        if pendientes:
+            await ib.qualifyContractsAsync(*[c for _, c in pendientes])
+            self._registrar(pendientes, hoy)
+        return [c for c in contracts if getattr(c, "conId", 0)]
+
+    async def existe_async(self, ib, contract):
+        """True si IB lista el contrato (reqContractDetails); recuerda también los que no existen."""
+        hoy = _hoy()
+        clave = clave_contrato(contract)
+        fila = self._buscar(clave, hoy) if self.abierta else None
+        if fila is not None:
+            self.aciertos += 1
+            if fila[0]:
+                self._aplicar(contract, fila[1])
+            return fila[0]
+        cds = await ib.reqContractDetailsAsync(contract)
+        self.peticiones += 1
+        if cds:
+            self._aplicar(contract, {c: getattr(cds[0].contract, c, None) for c in CAMPOS_CUALIFICADOS})
+        if self.abierta:
+            self._anotar(clave, contract, bool(cds), hoy)
+        return bool(cds)
+
+    def resumen(self):
+        return f"{self.aciertos} contratos desde caché, {self.peticiones} peticiones a IB"
+
+
+# instancia compartida por los scripts (la abre cada main)
+cache_contratos = CacheContratos()
@@ -0,0 +1,511 @@
+'''
+Sustituto local de TWS/Gateway para pruebas y benchmarks sin conexión.
+
+FakeIB implementa la parte de la API de ib_insync / ib_async que usan los scripts
+(ib_downloader, motor_async, CollectOI, Ordenes_IB, AutoIB):
+
+    connect / connectAsync / isConnected / disconnect / sleep / run / reqCurrentTime(Async)
+    qualifyContracts(Async), reqContractDetailsAsync
+    reqHistoricalData(Async), reqHistoricalTicks(Async)
+    reqMktData (ticks 100/101: volumen y open interest de opciones), cancelMktData, reqMarketDataType
+    reqTickByTickData / cancelTickByTickData (ticks sintéticos que se emiten en cada sleep)
+    reqSecDefOptParams(Async)
+    errorEvent, execDetailsEvent, commissionReportEvent, orderStatusEvent, disconnectedEvent
+
+Los datos se reproducen desde un directorio de grabación con la misma estructura que BASE_DIR:
+
+    <grabacion>/Bars1s/<SYMBOL>/YYYY-MM-DD.parquet      (también Bars15m, Bars1h, BarsD)
+    <grabacion>/Tick2Tick/<SYMBOL>/YYYY-MM-DD.parquet
+    <grabacion>/fake_ib.json                            (contratos, cadenas, market data, ejecuciones)
+
+Si no hay grabación para lo que se pide se generan datos sintéticos deterministas (semilla).
+Se puede configurar latencia por petición e inyectar errores de pacing (código 162).
+
+Uso en los descargadores: exportar IB_FAKE=<directorio de grabación> antes de lanzarlos.
+'''
+
+import asyncio
+import inspect
+import json
+import os
+import random
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import logging
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+LATENCIA_SG = 0.05                  # latencia media por petición
+JITTER_SG = 0.02                    # +- aleatorio sobre la latencia
+PROB_ERROR_PACING = 0.0             # probabilidad de devolver violación de pacing
+ERROR_PACING_CADA = 0               # si > 0, fuerza el error cada N peticiones históricas
+SEMILLA = 1234
+
+MENSAJE_PACING = ("Historical Market Data Service error message:"
+                  "API historical data query cancelled: pacing violation")
+
+BARSIZE_A_BARRA = {
+    "1 secs": "Bars1s",
+    "15 mins": "Bars15m",
+    "1 hour": "Bars1h",
+    "1 day": "BarsD",
+}
+SEGUNDOS_BARSIZE = {
+    "secs": 1, "sec": 1,
+    "min": 60, "mins": 60,
+    "hour": 3600, "hours": 3600,
+    "day": 86400, "days": 86400,
+    "week": 7 * 86400, "month": 30 * 86400,
+}
+SEGUNDOS_DURACION = {"S": 1, "D": 86400, "W": 7 * 86400, "M": 30 * 86400, "Y": 365 * 86400}
+
+
+class Evento:
+    """Evento mínimo compatible con `ib.xxxEvent += handler` (acepta handlers async)."""
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self._handlers = []
+
+    def __iadd__(self, handler):
+        self._handlers.append(handler)
+        return self
+
+    def __isub__(self, handler):
+        self._handlers.remove(handler)
+        return self
+
+    def emit(self, *args):
+        for h in list(self._handlers):
+            res = h(*args)
+            if inspect.isawaitable(res):
+                asyncio.ensure_future(res)
+
+
+def parse_duracion(durationStr):
+    n, unidad = durationStr.split()
+    return timedelta(seconds=int(n) * SEGUNDOS_DURACION[unidad.upper()])
+
+
+def parse_barsize(barSizeSetting):
+    n, unidad = barSizeSetting.split()
+    return timedelta(seconds=int(n) * SEGUNDOS_BARSIZE[unidad.lower()])
+
+
+def _utc(dt):
+    if isinstance(dt, str):
+        dt = datetime.strptime(dt[:17], "%Y%m%d %H:%M:%S") if dt else datetime.now(timezone.utc)
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+class FakeIB:
+
+    def __init__(self, grabacion=None, latencia=LATENCIA_SG, jitter=JITTER_SG,
+                 prob_error_pacing=PROB_ERROR_PACING, error_pacing_cada=ERROR_PACING_CADA,
+                 semilla=SEMILLA):
+        self.grabacion = grabacion
+        self.latencia = latencia
+        self.jitter = jitter
+        self.prob_error_pacing = prob_error_pacing
+        self.error_pacing_cada = error_pacing_cada
+        self._rnd = random.Random(semilla)
+        self._semilla = semilla
+        self._conectado = False
+        self._req_id = 0
+        self._historicas = 0
+        self.peticiones = []            # (tipo, símbolo, instante) para inspeccionar en tests
+
+        self.errorEvent = Evento("errorEvent")
+        self.execDetailsEvent = Evento("execDetailsEvent")
+        self.commissionReportEvent = Evento("commissionReportEvent")
+        self.orderStatusEvent = Evento("orderStatusEvent")
+        self.disconnectedEvent = Evento("disconnectedEvent")
+
+        self._tick_by_tick = []        # (ticker, tickType, último instante emitido, precio)
+
+        self._meta = {}
+        if grabacion and os.path.exists(os.path.join(grabacion, "fake_ib.json")):
+            with open(os.path.join(grabacion, "fake_ib.json"), encoding="utf-8") as f:
+                self._meta = json.load(f)
+
+    # ----------------------------
+    # Conexión
+    # ----------------------------
+    def connect(self, host="127.0.0.1", port=7496, clientId=1, timeout=10, **kwargs):
+        self._conectado = True
+        self.clientId = clientId
+        logger.info(f"FakeIB conectado (clientId={clientId}, grabación={self.grabacion})")
+        return self
+
+    async def connectAsync(self, host="127.0.0.1", port=7496, clientId=1, timeout=10, **kwargs):
+        return self.connect(host, port, clientId, timeout)
+
+    def isConnected(self):
+        return self._conectado
+
+    def disconnect(self):
+        if self._conectado:
+            self._conectado = False
+            self.disconnectedEvent.emit()
+
+    def reqCurrentTime(self):
+        time.sleep(self._espera())
+        return datetime.now(timezone.utc)
+
+    async def reqCurrentTimeAsync(self):
+        await asyncio.sleep(self._espera())
+        return datetime.now(timezone.utc)
+
+    def sleep(self, segundos=0):
+        time.sleep(segundos)
+        self._emitir_tick_by_tick()
+        return True
+
+    def run(self, *awaitables):
+        """Como IB.run: ejecuta las corrutinas hasta que terminan y devuelve su resultado."""
+        async def _todas():
+            return await asyncio.gather(*awaitables)
+
+        resultados = asyncio.run(_todas())
+        return resultados[0] if len(resultados) == 1 else resultados
+
+    def reqMarketDataType(self, tipo):
+        self.marketDataType = tipo
+
+    # ----------------------------
+    # Latencia y errores inyectados
+    # ----------------------------
+    def _espera(self):
+        return max(0.0, self.latencia + self._rnd.uniform(-self.jitter, self.jitter))
+
+    def _siguiente_id(self, tipo, contract):
+        self._req_id += 1
+        self.peticiones.append((tipo, getattr(contract, "symbol", None), time.monotonic()))
+        return self._req_id
+
+    def _inyectar_pacing(self, req_id, contract):
+        self._historicas += 1
+        forzado = self.error_pacing_cada and self._historicas % self.error_pacing_cada == 0
+        if forzado or (self.prob_error_pacing and self._rnd.random() < self.prob_error_pacing):
+            self.errorEvent.emit(req_id, 162, MENSAJE_PACING, contract)
+            return True
+        return False
+
+    # ----------------------------
+    # Contratos
+    # ----------------------------
+    def _con_id(self, contract):
+        contratos = self._meta.get("contratos", {})
+        clave = getattr(contract, "localSymbol", "") or getattr(contract, "symbol", "")
+        if clave in contratos:
+            return contratos[clave]
+        partes = [str(getattr(contract, a, "")) for a in
+                  ("symbol", "secType", "lastTradeDateOrContractMonth", "strike", "right")]
+        return zlib.crc32("|".join(partes).encode()) & 0x7FFFFFFF
+
+    def qualifyContracts(self, *contracts):
+        time.sleep(self._espera())
+        for c in contracts:
+            self._siguiente_id("qualify", c)
+            c.conId = self._con_id(c)
+        return list(contracts)
+
+    async def qualifyContractsAsync(self, *contracts):
+        await asyncio.sleep(self._espera())
+        for c in contracts:
+            self._siguiente_id("qualify", c)
+            c.conId = self._con_id(c)
+        return list(contracts)
+
+    async def reqContractDetailsAsync(self, contract):
+        await asyncio.sleep(self._espera())
+        self._siguiente_id("details", contract)
+        strike = getattr(contract, "strike", 0)
+        if strike:
+            cadena = self._cadena(contract.symbol)
+            if float(strike) not in cadena.strikes:
+                return []
+        contract.conId = self._con_id(contract)
+        return [SimpleNamespace(contract=contract)]
+
+    # ----------------------------
+    # Históricos
+    # ----------------------------
+    def _leer_grabacion(self, barra, symbol, desde, hasta, incluir_fin=False):
+        """
+        Filas grabadas en [desde, hasta) (UTC) o None si no hay grabación.
+        Las barras se etiquetan por su inicio; para ticks se usa incluir_fin=True.
+        """
+        if not self.grabacion:
+            return None
+        from almacen import find_session_file, read_session_range
+
+        ruta = os.path.join(self.grabacion, barra, symbol)
+        if not os.path.isdir(ruta):
+            return None
+        import pandas as pd
+
+        partes = []
+        d = desde.date()
+        while d <= hasta.date():
+            fichero = find_session_file(ruta, d)
+            if fichero:
+                fin = pd.Timestamp(hasta) + pd.Timedelta(1, "ns") if incluir_fin else hasta
+                partes.append(read_session_range(fichero, desde, fin))
+            d += timedelta(days=1)
+        if not partes:
+            return None
+        return pd.concat(partes, ignore_index=True).sort_values("time")
+
+    def _barras_sinteticas(self, contract, desde, hasta, paso):
+        rnd = random.Random(self._semilla ^ self._con_id(contract))
+        precio = 50.0 + rnd.random() * 200
+        barras = []
+        if paso >= timedelta(days=1):
+            # barras diarias: IB las fecha con date (sin hora), una por día laborable
+            d = (desde + timedelta(days=1)).date()
+            while d <= hasta.date():
+                if d.weekday() < 5:
+                    o = precio
+                    c = max(0.01, o + rnd.gauss(0, 1.0))
+                    barras.append(SimpleNamespace(
+                        date=d, open=o, high=max(o, c) + 0.5, low=min(o, c) - 0.5, close=c,
+                        volume=float(rnd.randint(10**6, 10**7)), average=(o + c) / 2, barCount=rnd.randint(10**4, 10**5)
+                    ))
+                    precio = c
+                d += timedelta(days=1)
+            return barras
+        t = desde
+        while t < hasta:
+            # sólo horario regular de NY (aprox. 14:30-21:00 UTC) y días laborables
+            if t.weekday() < 5 and (14 * 60 + 30) <= t.hour * 60 + t.minute < 21 * 60:
+                o = precio
+                c = max(0.01, o + rnd.gauss(0, 0.02))
+                barras.append(SimpleNamespace(
+                    date=t, open=o, high=max(o, c) + 0.01, low=min(o, c) - 0.01, close=c,
+                    volume=float(rnd.randint(0, 500)), average=(o + c) / 2, barCount=rnd.randint(0, 20)
+                ))
+                precio = c
+            t += paso
+        return barras
+
+    def _historico(self, contract, endDateTime, durationStr, barSizeSetting):
+        fin = _utc(endDateTime)
+        inicio = fin - parse_duracion(durationStr)
+        barra = BARSIZE_A_BARRA.get(barSizeSetting)
+        df = self._leer_grabacion(barra, contract.symbol, inicio, fin) if barra else None
+        if df is None:
+            return self._barras_sinteticas(contract, inicio, fin, parse_barsize(barSizeSetting))
+        return [
+            SimpleNamespace(date=r.time.to_pydatetime(), open=r.open, high=r.high, low=r.low,
+                            close=r.close, volume=r.volume, average=(r.open + r.close) / 2, barCount=0)
+            for r in df.itertuples(index=False)
+        ]
+
+    def reqHistoricalData(self, contract, endDateTime, durationStr, barSizeSetting,
+                          whatToShow="TRADES", useRTH=True, formatDate=1, keepUpToDate=False, **kwargs):
+        req_id = self._siguiente_id("historical", contract)
+        time.sleep(self._espera())
+        if self._inyectar_pacing(req_id, contract):
+            return []
+        return self._historico(contract, endDateTime, durationStr, barSizeSetting)
+
+    async def reqHistoricalDataAsync(self, contract, endDateTime, durationStr, barSizeSetting,
+                                     whatToShow="TRADES", useRTH=True, formatDate=1,
+                                     keepUpToDate=False, **kwargs):
+        req_id = self._siguiente_id("historical", contract)
+        await asyncio.sleep(self._espera())
+        if self._inyectar_pacing(req_id, contract):
+            return []
+        return self._historico(contract, endDateTime, durationStr, barSizeSetting)
+
+    def _ticks(self, contract, endDateTime, numberOfTicks, whatToShow):
+        fin = _utc(endDateTime)
+        df = self._leer_grabacion("Tick2Tick", contract.symbol, fin - timedelta(days=1), fin, incluir_fin=True)
+        bid_ask = str(whatToShow).lower() == "bid_ask"
+        if df is None:
+            rnd = random.Random(self._semilla ^ self._con_id(contract) ^ int(fin.timestamp()))
+            precio = 50.0 + rnd.random() * 200
+            filas = []
+            t = fin
+            for _ in range(numberOfTicks):
+                t -= timedelta(milliseconds=rnd.randint(1, 800))
+                precio = max(0.01, precio + rnd.gauss(0, 0.01))
+                filas.append(SimpleNamespace(time=t, price=precio, size=float(rnd.randint(1, 300)),
+                                             bid=precio - 0.01, ask=precio + 0.01,
+                                             bid_size=float(rnd.randint(1, 50)),
+                                             ask_size=float(rnd.randint(1, 50))))
+            filas.reverse()
+        else:
+            filas = [SimpleNamespace(**r._asdict()) for r in df.tail(numberOfTicks).itertuples(index=False)]
+            for f in filas:
+                f.time = f.time.to_pydatetime()
+
+        if bid_ask:
+            return [SimpleNamespace(time=f.time, priceBid=getattr(f, "bid", None),
+                                    priceAsk=getattr(f, "ask", None),
+                                    sizeBid=getattr(f, "bid_size", None),
+                                    sizeAsk=getattr(f, "ask_size", None)) for f in filas]
+        return [SimpleNamespace(time=f.time, price=getattr(f, "price", None),
+                                size=getattr(f, "size", None)) for f in filas]
+
+    def reqHistoricalTicks(self, contract, startDateTime, endDateTime, numberOfTicks,
+                           whatToShow, useRth=True, ignoreSize=False, **kwargs):
+        req_id = self._siguiente_id("ticks", contract)
+        time.sleep(self._espera())
+        if self._inyectar_pacing(req_id, contract):
+            return []
+        return self._ticks(contract, endDateTime, numberOfTicks, whatToShow)
+
+    async def reqHistoricalTicksAsync(self, contract, startDateTime, endDateTime, numberOfTicks,
+                                      whatToShow, useRth=True, ignoreSize=False, **kwargs):
+        req_id = self._siguiente_id("ticks", contract)
+        await asyncio.sleep(self._espera())
+        if self._inyectar_pacing(req_id, contract):
+            return []
+        return self._ticks(contract, endDateTime, numberOfTicks, whatToShow)
+
+    # ----------------------------
+    # Market data y opciones
+    # ----------------------------
+    def _spot(self, symbol):
+        spots = self._meta.get("spot", {})
+        if symbol in spots:
+            return spots[symbol]
+        return float(50 + zlib.crc32(symbol.encode()) % 400)
+
+    def _cadena(self, symbol):
+        cadenas = self._meta.get("cadenas", {})
+        if symbol in cadenas:
+            c = cadenas[symbol]
+            return SimpleNamespace(exchange="SMART", underlyingConId=0, tradingClass=symbol,
+                                   multiplier="100", expirations=c["expirations"], strikes=c["strikes"])
+        spot = self._spot(symbol)
+        strikes = [float(k) for k in range(int(spot * 0.5), int(spot * 1.5) + 1)]
+        hoy = datetime.now(timezone.utc).date()
+        expiraciones = [(hoy + timedelta(days=7 * i + (4 - hoy.weekday()) % 7)).strftime("%Y%m%d")
+                        for i in range(12)]
+        return SimpleNamespace(exchange="SMART", underlyingConId=0, tradingClass=symbol,
+                               multiplier="100", expirations=expiraciones, strikes=strikes)
+
+    def reqSecDefOptParams(self, underlyingSymbol, futFopExchange, underlyingSecType, underlyingConId):
+        time.sleep(self._espera())
+        return [self._cadena(underlyingSymbol)]
+
+    async def reqSecDefOptParamsAsync(self, underlyingSymbol, futFopExchange, underlyingSecType,
+                                      underlyingConId):
+        await asyncio.sleep(self._espera())
+        return [self._cadena(underlyingSymbol)]
+
+    def reqMktData(self, contract, genericTickList="", snapshot=False, regulatorySnapshot=False,
+                   mktDataOptions=None):
+        self._siguiente_id("mktdata", contract)
+        datos = self._meta.get("mktdata", {}).get(
+            getattr(contract, "localSymbol", "") or contract.symbol, {})
+        spot = self._spot(contract.symbol)
+        rnd = random.Random(self._semilla ^ self._con_id(contract))
+        ticker = SimpleNamespace(contract=contract, last=datos.get("last", spot),
+                                 close=datos.get("close", spot), lastGreeks=None,
+                                 callOpenInterest=None, putOpenInterest=None,
+                                 callVolume=None, putVolume=None,
+                                 updateEvent=Evento("updateEvent"))
+        ticks = {t.strip() for t in str(genericTickList).split(",") if t.strip()}
+        if getattr(contract, "secType", "") == "OPT":
+            if "101" in ticks:
+                ticker.callOpenInterest = datos.get("callOpenInterest", float(rnd.randint(0, 50000)))
+                ticker.putOpenInterest = datos.get("putOpenInterest", float(rnd.randint(0, 50000)))
+            if "100" in ticks:
+                ticker.callVolume = datos.get("callVolume", float(rnd.randint(0, 5000)))
+                ticker.putVolume = datos.get("putVolume", float(rnd.randint(0, 5000)))
+            griegas = datos.get("greeks", {})
+            ticker.last = datos.get("last", round(rnd.uniform(0.05, 20), 2))
+            ticker._griegas = SimpleNamespace(
+                delta=griegas.get("delta", rnd.uniform(-1, 1)), gamma=griegas.get("gamma", rnd.uniform(0, 0.1)),
+                theta=griegas.get("theta", -rnd.uniform(0, 0.5)), vega=griegas.get("vega", rnd.uniform(0, 0.5)),
+                impliedVol=griegas.get("impliedVol", rnd.uniform(0.1, 0.8)))
+
+            # Las griegas llegan "más tarde", como en IB
+            def _publicar():
+                ticker.lastGreeks = ticker._griegas
+                ticker.updateEvent.emit(ticker)
+            try:
+                asyncio.get_running_loop().call_later(self._espera(), _publicar)
+            except RuntimeError:
+                _publicar()
+        return ticker
+
+    def cancelMktData(self, contract):
+        pass
+
+    def reqTickByTickData(self, contract, tickType, numberOfTicks=0, ignoreSize=False):
+        self._siguiente_id("tickbytick", contract)
+        ticker = SimpleNamespace(contract=contract, tickByTicks=[], updateEvent=Evento("updateEvent"))
+        self._tick_by_tick.append([ticker, tickType, datetime.now(timezone.utc), self._spot(contract.symbol)])
+        return ticker
+
+    def cancelTickByTickData(self, contract, tickType):
+        self._tick_by_tick = [s for s in self._tick_by_tick
+                              if not (s[0].contract is contract and s[1] == tickType)]
+
+    def _emitir_tick_by_tick(self):
+        """Genera los ticks de cada suscripción desde la última emisión hasta ahora."""
+        ahora = datetime.now(timezone.utc)
+        for sub in self._tick_by_tick:
+            ticker, tipo, t, precio = sub
+            ticks = []
+            while True:
+                t += timedelta(milliseconds=self._rnd.randint(1, 800))
+                if t > ahora:
+                    break
+                precio = max(0.01, precio + self._rnd.gauss(0, 0.01))
+                if tipo == "BidAsk":
+                    ticks.append(SimpleNamespace(time=t, bidPrice=round(precio - 0.01, 2),
+                                                 askPrice=round(precio + 0.01, 2),
+                                                 bidSize=float(self._rnd.randint(1, 50)),
+                                                 askSize=float(self._rnd.randint(1, 50))))
+                else:
+                    ticks.append(SimpleNamespace(time=t, price=round(precio, 2),
+                                                 size=float(self._rnd.randint(1, 300))))
+            sub[2], sub[3] = (ticks[-1].time if ticks else sub[2]), precio
+            if ticks:
+                ticker.tickByTicks = ticks
+                ticker.updateEvent.emit(ticker)
+
+    # ----------------------------
+    # Ejecuciones grabadas
+    # ----------------------------
+    def reproducir_ejecuciones(self):
+        """
+        Emite execDetailsEvent, orderStatusEvent y commissionReportEvent para cada ejecución
+        de fake_ib.json["ejecuciones"] (campos: symbol, secType, right, strike, expiry, side,
+        shares, price, commission, time ISO). Devuelve el nº de ejecuciones emitidas.
+        """
+        n = 0
+        for e in self._meta.get("ejecuciones", []):
+            contract = SimpleNamespace(symbol=e["symbol"], secType=e.get("secType", "OPT"),
+                                       right=e.get("right", ""), strike=e.get("strike", 0.0),
+                                       lastTradeDateOrContractMonth=e.get("expiry", ""),
+                                       localSymbol=e.get("localSymbol", ""), currency="USD")
+            contract.conId = self._con_id(contract)
+            execution = SimpleNamespace(execId=e.get("execId", f"fake.{n}"), orderId=e.get("orderId", n),
+                                        time=datetime.fromisoformat(e["time"]), side=e["side"],
+                                        shares=e["shares"], price=e["price"])
+            fill = SimpleNamespace(contract=contract, execution=execution)
+            trade = SimpleNamespace(contract=contract, fills=[fill],
+                                    orderStatus=SimpleNamespace(status="Filled", filled=e["shares"]))
+            report = SimpleNamespace(execId=execution.execId, commission=e.get("commission", 0.0),
+                                     currency="USD")
+            self.execDetailsEvent.emit(trade, fill)
+            self.orderStatusEvent.emit(trade)
+            self.commissionReportEvent.emit(trade, fill, report)
+            n += 1
+        return n
@@ -4,7 +4,7 @@ Este script descarga datos en barras en 1sg de Interactivebrokers.
 Características principales del script:
 
 1.- Un directorio por activo (ejemplo: ./data/AAPL/).
-2.- Un fichero XLS por cada sesión de Wall Street (ejemplo: 2025-09-25.xls).
+2.- Un fichero por cada sesión de Wall Street (ejemplo: 2025-09-25.parquet). XLSX queda como exportación opcional (ver almacen.py).
 3.- La primera vez que se ejecuta para un activo:
     Crea el directorio si no existe.
     Intentará bajar el máximo histórico permitido
@@ -12,6 +12,7 @@ Características principales del script:
 4.- Ejecuciones posteriores:
     Si estás en sesión (NY 9:30–16:00), solo baja los días anteriores que falten.
     Si estás fuera de sesión, baja el día en curso y los días anteriores faltantes.
+    La sesión en curso se puede capturar en vivo con tiempo_real.py: esta pasada sólo rellena sus huecos.
 
 se cambia del script DescargaTick.py la función fetch_ticks_for_session por fetch_bars_for_session
 
@@ -26,16 +27,57 @@ import time
 from datetime import datetime, timedelta, time as dtime
 import pytz
 import pandas as pd
-from ib_insync import IB, Stock, Future
+from ib_insync import IB, Stock, Future, Forex, Index
 
 import logging
 from logging.handlers import TimedRotatingFileHandler
 
+# Guardado/lectura de sesiones (parquet por defecto, XLSX opcional)
+from almacen import save_session_df, read_session_df, StagingSesion
+
+# Manifiesto SQLite de sesiones (completa / parcial / vacía)
+from manifiesto import Manifiesto, filas_esperadas, ESTADO_COMPLETA, ESTADO_PARCIAL
+
+# Barras de 15m / 1h / diarias construidas a partir de las de 1 sg
+from remuestreo import es_derivable, derivar_sesion, BARRA_ORIGEN
+
+# Conversión de páginas de IB a columnas NumPy (sin dict por fila)
+from ingesta import (bars_to_frame, ticks_to_frame, concat_frames, columnas_ticks, diaria_a_sesion,
+                     COLUMNAS_BARRAS, DedupeFrontera)
+
+# Tamaño de bloque por barra (duración máxima de IB, ajustada con lo observado)
+from bloques import plan_bloques, duracion_str, TABLA_BARRAS
+
+# Pacing compartido con el resto de descargadores (sustituye a los sleeps fijos)
+from pacing import gobernador, clave_contrato
+
+# Respuestas crudas ya recibidas: una reejecución no vuelve a pedirlas a IB
+from cache_respuestas import cache_respuestas, firma_barras, firma_ticks
+
+# Contratos ya cualificados hoy: sin qualifyContracts por fila en cada ejecución
+from contratos import cache_contratos
+
+# Tareas pendientes (activos.xlsx contra el manifiesto) calculadas de una vez antes de descargar
+from planificador import cargar_config, planificar
+
+# Puesta al día de todos primero; backfill por turnos y con presupuesto de tiempo
+from programador import Programa
+
+# Conexiones a TWS por tipo de tráfico, con comprobación de salud y reconexión
+from conexiones import PoolConexiones, TIPO_HISTORICO
+
+# Festivos, cierres anticipados y horario por tipo de activo
+from calendario import calendario, calendario_contrato
+
+# Huecos / duplicados / filas fuera de sesión y plan mínimo de peticiones para rellenarlos
+from validacion import validar_sesion, limpiar_sesion, planificar_peticiones, VENTANA_MAX_SG
+
 
 
 # === CONFIGURACIÓN GLOBAL ===
-BASE_DIR = "E:/DATOSBOLSA"
+BASE_DIR = os.environ.get("DATOSBOLSA_DIR", "E:/DATOSBOLSA")   # override para pruebas/benchmarks
 EXCEL_CONFIG = os.path.join(BASE_DIR, "activos.xlsx")
+MANIFIESTO_DB = os.path.join(BASE_DIR, "manifiesto.sqlite")
 LOG_DIR = os.path.join(BASE_DIR, "logs")
 os.makedirs(LOG_DIR, exist_ok=True)
 
@@ -53,8 +95,26 @@ INIT_DAYS_BACK = 5                  # si no existe historial, intentamos éste n
 IB_HOST = "127.0.0.1"
 IB_PORT = 7496
 IB_CLIENTID = 1
-
-# Timezone / horario mercado
+IB_FAKE = os.environ.get("IB_FAKE")     # directorio de grabación: usa FakeIB en vez de TWS (pruebas/benchmarks)
+TICKS_POR_PAGINA = 1000             # máximo de reqHistoricalTicks
+PLAN_BLOQUES_JSON = os.path.join(BASE_DIR, "plan_bloques.json")   # tamaños de bloque aprendidos
+CACHE_RESPUESTAS_DIR = os.path.join(BASE_DIR, "cache_ib")       # respuestas crudas de IB (cache_respuestas.py)
+CONTRATOS_DB = os.path.join(BASE_DIR, "contratos.sqlite")       # contratos cualificados (contratos.py)
+REINTENTOS_BLOQUE = 3               # intentos por bloque; después queda como hueco y lo rellena completar_sesion
+MAX_PETICIONES_RELLENO = 20         # con más huecos que esto la sesión se vuelve a pedir entera
+PRESUPUESTO_BACKFILL_SG = None      # segundos por ejecución para sesiones antiguas (None = sin límite; ver programador.py)
+
+# Columnas del Excel que generan descarga (Bars1s primero: el resto se deriva de ella)
+BARRAS = ["Bars1s", "Bars15m", "Bars1h", "BarsD", "Tick2Tick"]
+DESCRIPCION_BARRA = {
+    "Bars1s": "barras de 1 sg",
+    "Bars15m": "barras de 15 minutos",
+    "Bars1h": "barras de 1 hora",
+    "BarsD": "barras diarias",
+    "Tick2Tick": "tick a tick",
+}
+
+# Timezone / horario mercado (sesión regular NYSE; festivos y cierres anticipados en calendario.py)
 NY_TZ = pytz.timezone("America/New_York")
 SESSION_OPEN = dtime(9, 30)
 SESSION_CLOSE = dtime(16, 0)
@@ -96,8 +156,15 @@ logger.addHandler(file_handler)
 # ----------------------------
 # UTILIDADES
 # ----------------------------
+def nuevo_ib():
+    """IB real o, si IB_FAKE está definido, el sustituto local que reproduce la grabación."""
+    if IB_FAKE:
+        from fake_ib import FakeIB
+        return FakeIB(IB_FAKE)
+    return IB()
+
 def connect_ib():
-    ib = IB()
+    ib = nuevo_ib()
     logger.info(f"Conectando a IB en {IB_HOST}:{IB_PORT} (clientId={IB_CLIENTID})...")
 
     try:
@@ -108,6 +175,8 @@ def connect_ib():
         raise
     if not ib.isConnected():
         raise RuntimeError("❌ No se pudo establecer conexión con TWS/Gateway")
+    # Los errores de pacing (162/420) activan el backoff del gobernador
+    ib.errorEvent += gobernador.on_error
 
     return ib
 
@@ -117,23 +186,6 @@ def ensure_symbol_dir(raiz, directorio, symbol):
     os.makedirs(d, exist_ok=True)
     return d
 
-def list_downloaded_dates(symbol_dir):
-    """Devuelve set de fechas descargadas en formato date (YYYY-MM-DD.xlsx)"""
-    if not os.path.exists(symbol_dir):
-        return set()
-    names = os.listdir(symbol_dir)
-    dates = set()
-    for n in names:
-        # aceptar .xlsx o .xls
-        if n.lower().endswith(".xlsx") or n.lower().endswith(".xls"):
-            base = os.path.splitext(n)[0]
-            try:
-                dt = datetime.strptime(base, "%Y-%m-%d").date()
-                dates.add(dt)
-            except Exception:
-                continue
-    return dates
-
 def build_contract(ticker: str, tipo: str):
     """Crea contrato IB según tipo indicado en Excel."""
     tipo = tipo.lower()
@@ -150,23 +202,20 @@ def build_contract(ticker: str, tipo: str):
 
 
 
-def is_market_open(now=None):
-    """True si ahora (NY) está entre 9:30 y 16:00 (sesión regular)."""
-    now = now or datetime.now(pytz.utc).astimezone(NY_TZ)
-    tod = now.time()
-    return (tod >= SESSION_OPEN) and (tod <= SESSION_CLOSE) and (now.weekday() < 5)
+def is_market_open(now=None, cal=None):
+    """True si ahora está dentro de una sesión del calendario (NYSE por defecto: festivos y medias sesiones incluidos)."""
+    return (cal or calendario()).abierto(now)
 
-def next_business_day(date):
-    d = date + timedelta(days=1)
-    while d.weekday() >= 5:
-        d += timedelta(days=1)
-    return d
+def next_business_day(date, cal=None):
+    return (cal or calendario()).siguiente(date)
 
-def prev_business_day(date):
-    d = date - timedelta(days=1)
-    while d.weekday() >= 5:
-        d -= timedelta(days=1)
-    return d
+def prev_business_day(date, cal=None):
+    return (cal or calendario()).anterior(date)
+
+def sesion_ny(d, contract=None):
+    """(apertura, cierre) tz-aware NY de la sesión d según el calendario del contrato, o None si es festivo."""
+    cal = calendario_contrato(contract) if contract is not None else calendario()
+    return cal.sesion(d)
 
 # Helper robusto para extraer campos de ticks (bid/ask)
 def _get_attr(obj, names):
@@ -383,140 +432,191 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny):
 # ----------------------------
 # DESCARGA DE BARRAS 1 SEGUNDO
 # ----------------------------
-def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny, barra):
+def parametros_barra(barra):
+    """
+    Devuelve (bloque, durationStr, barSizeSetting) para el tipo de barra del Excel según la
+    tabla de bloques.py. bloque es el timedelta que cubre cada petición (ajustado por lo observado).
+    Tick2Tick no es una barra de reqHistoricalData: se descarga con fetch_ticks_tick2tick.
+    """
+    if barra not in TABLA_BARRAS:
+        raise ValueError(f"Tipo de barra no soportado: {barra}")
+    segundos = plan_bloques.bloque_sg(barra)
+    return timedelta(seconds=segundos), duracion_str(segundos), TABLA_BARRAS[barra].tamaño
+
+def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny, barra, staging=None):
     """
-    Descarga todos los datos de 1 segundo de la sesión [session_start_ny, session_end_ny],
-    troceando en bloques de 30 minutos (IB solo permite 1s con duraciones <= 1h).
+    Descarga todas las barras de la sesión [session_start_ny, session_end_ny], troceando con
+    la tabla de bloques.py (1 sg: bloques de hasta 30 minutos; 15m / 1h / diario: una petición).
+    Cada bloque pide sólo su tramo y el tamaño del siguiente se ajusta con la latencia observada.
+    Si se pasa staging (StagingSesion) cada bloque se guarda al llegar y, si la sesión
+    se quedó a medias en una ejecución anterior, se reanuda desde el último bloque hecho.
     Devuelve DataFrame con columnas: time, open, high, low, close, volume.
     """
 
     start_utc = session_start_ny.astimezone(pytz.utc)
     end_utc = session_end_ny.astimezone(pytz.utc)
 
-    rows = []
+    frames = []
     block_start = start_utc
     iteration = 0
+    fallos = 0
+    rth = calendario_contrato(contract).rth
 
-    # 1s
-    if barra == "Bars1s":
-        tiempo = 30 #30 minutos
-        duracion= "1800 S"
-        tamaño= "1 secs"
-    # 15m
-    if barra == "Bars15m":
-        tiempo = 30  # 30 minutos
-        duracion= "1 W"
-        tamaño= "15 mins"
-    # 1h
-    if barra == "Bars1h":
-        tiempo = 30  # 30 minutos
-        duracion= "1 M"
-        tamaño= "1 hour"
-    # Diario
-    if barra == "BarsD":
-        tiempo = 30  # 30 minutos
-        duracion= "1800 S"
-        tamaño= "1 secs"
-    # Tick a Tick
-    if barra == "Tick2Tick":
-        tiempo = 30  # 30 minutos
-        duracion= "1800 S"
-        tamaño= "5 Y"
-
-
+    hechos = staging.bloques_completados() if staging is not None else set()
+    if hechos:
+        logger.info(f"Reanudando sesión: {len(hechos)} bloques ya descargados en staging")
+        frames.append(staging.leer_bloques())
+        # los bloques se piden en orden: se sigue desde el último hecho (si quedó algún hueco
+        # de una descarga en paralelo, lo rellena completar_sesion)
+        block_start = max(block_start, max(pd.Timestamp(h) for h in hechos).to_pydatetime())
 
     while block_start < end_utc:
         iteration += 1
-        block_end = min(block_start + timedelta(tiempo), end_utc)
-        logger.debug(f"Iteración {iteration}: {block_start} → {block_end}")
+        block_end, duracion, tamaño = plan_bloques.bloques(barra, block_start, end_utc)[0]
+        logger.debug(f"Iteración {iteration}: {block_start} → {block_end} ({duracion})")
+
+        firma = firma_barras(contract, WHAT_TO_SHOW, block_end, duracion, tamaño, rth)
+        bars = cache_respuestas.obtener(firma)
+        if bars is not None:
+            # respuesta ya recibida en una ejecución anterior: ni pacing ni plan de bloques
+            frames.append(_bloque_barras(bars, barra, session_end_ny, start_utc, end_utc, block_end, staging))
+            block_start = block_end
+            continue
 
+        gobernador.adquirir(clave_contrato(contract, WHAT_TO_SHOW),
+                            firma=(contract.conId, WHAT_TO_SHOW, block_end, duracion, tamaño))
+        t0 = time.monotonic()
+        marca = gobernador.marca()
         try:
             bars = ib.reqHistoricalData(
                 contract,
                 endDateTime=block_end,
-                durationStr=duracion,       # 30 minutos = 1800 segundos
-                barSizeSetting=tamaño,    # barras de 1 segundo
+                durationStr=duracion,
+                barSizeSetting=tamaño,
                 whatToShow=WHAT_TO_SHOW,
-                useRTH=True,
+                useRTH=rth,                 # futuros/divisas: sesión completa
                 formatDate=1,
                 keepUpToDate=False
             )
-            logger.debug(f"Recibidas {len(bars)} barras de 1s en iter {iteration}")
+            # [] tras un error de IB (pacing, timeout del HMDS...) es un fallo, no un bloque sin datos
+            gobernador.verificar_respuesta(marca, contract, bars)
+            logger.debug(f"Recibidas {len(bars)} barras en iter {iteration}")
+            gobernador.notificar_exito()
+            cache_respuestas.guardar(firma, bars)
+            fallos = 0
         except Exception as e:
-            logger.error(f"⚠️ reqHistoricalData fallo en iter {iteration}: {e}")
-            time.sleep(1.0)
+            plan_bloques.observar(barra, (block_end - block_start).total_seconds(), None,
+                                  time.monotonic() - t0, error=True)
+            fallos += 1
+            logger.error(f"⚠️ reqHistoricalData fallo en iter {iteration} ({fallos}/{REINTENTOS_BLOQUE}): {e}")
+            if fallos < REINTENTOS_BLOQUE:
+                # el reintento espera en el gobernador y va con el bloque ya reducido
+                continue
+            # no reintentar para siempre: el bloque queda como hueco y se rellena al validar
+            logger.error(f"⚠️ Bloque {block_start} → {block_end} abandonado tras {fallos} intentos")
+            fallos = 0
+            block_start = block_end
             continue
 
         if not bars:
             logger.info(f"Sin datos en iter {iteration}")
+            plan_bloques.observar(barra, (block_end - block_start).total_seconds(), None, time.monotonic() - t0)
+            if staging is not None:
+                staging.guardar_bloque(block_end.isoformat(), [])
             block_start = block_end
             continue
 
-        for b in bars:
-            ttime = b.date
-            if ttime.tzinfo is None:
-                ttime = pytz.utc.localize(ttime)
-            else:
-                ttime = ttime.astimezone(pytz.utc)
-
-            if ttime < start_utc or ttime > end_utc:
-                continue
-
-            rows.append({
-                "time": ttime,
-                "open": b.open,
-                "high": b.high,
-                "low": b.low,
-                "close": b.close,
-                "volume": b.volume
-            })
+        block_df = _bloque_barras(bars, barra, session_end_ny, start_utc, end_utc, block_end, staging)
+        cubiertos = (block_end - block_df["time"].min()).total_seconds() if not block_df.empty else None
+        plan_bloques.observar(barra, (block_end - block_start).total_seconds(), cubiertos, time.monotonic() - t0)
+        frames.append(block_df)
 
         block_start = block_end
-        time.sleep(0.5)
-
-    if rows:
-        df = pd.DataFrame(rows)
-        df.sort_values("time", inplace=True)
-    else:
-        df = pd.DataFrame(columns=["time", "open", "high", "low", "close", "volume"])
-
-    return df
 
+    return concat_frames(frames, ["time"] + COLUMNAS_BARRAS)
 
+def _bloque_barras(bars, barra, session_end_ny, start_utc, end_utc, block_end, staging):
+    """Respuesta de un bloque -> DataFrame de la sesión (y al staging, si lo hay)."""
+    if barra == "BarsD":
+        block_df = diaria_a_sesion(bars_to_frame(bars), session_end_ny.date(), start_utc)
+    else:
+        block_df = bars_to_frame(bars, start_utc, end_utc)
+    if staging is not None:
+        staging.guardar_bloque(block_end.isoformat(), block_df)
+    return block_df
 
-# ----------------------------
-# GUARDADO por DÍA (XLSX)
-# ----------------------------
-def save_session_df(symbol_dir, date_obj, df):
+def fetch_ticks_tick2tick(ib, contract, session_start_ny, session_end_ny, staging=None):
     """
-    Guarda dataframe de sesión en symbol_dir/YYYY-MM-DD.xlsx
-    Convierte time a tz-naive UTC antes de escribir y crea formato de columna.
+    Tick2Tick: reqHistoricalTicks hacia atrás en páginas de TICKS_POR_PAGINA desde el cierre.
+    Las páginas se solapan en el segundo frontera (DedupeFrontera). Con staging cada página
+    se guarda al llegar y una sesión interrumpida se reanuda desde el cursor.
+    Devuelve DataFrame con time (UTC) y price/size o bid/ask según WHAT_TO_SHOW.
     """
-    from openpyxl import load_workbook
+    start_utc = session_start_ny.astimezone(pytz.utc)
+    end_utc = session_end_ny.astimezone(pytz.utc)
 
-    filename = os.path.join(symbol_dir, f"{date_obj.strftime('%Y-%m-%d')}.xlsx")
-    if df.empty:
-        print(f"    (vacío) No se guarda {filename}")
-        return
+    frames = []
+    dedupe = DedupeFrontera()
+    current_end = end_utc
+    fallos = 0
+    rth = calendario_contrato(contract).rth
 
-    # convertir time tz-aware UTC -> tz-naive (Excel no acepta tz-aware)
-    df_to_write = df.copy()
-    df_to_write["time"] = pd.to_datetime(df_to_write["time"]).dt.tz_convert(pytz.utc).dt.tz_localize(None)
+    if staging is not None and staging.reanudada:
+        previos = staging.leer_bloques()
+        frames.append(previos)
+        dedupe.cargar(previos)
+        current_end = pd.Timestamp(staging.cursor).to_pydatetime()
+        logger.info(f"Reanudando ticks desde {current_end} ({len(previos)} ticks en staging)")
 
-    # Guardar con pandas (openpyxl) y luego aplicar formato a columna A
-    df_to_write.to_excel(filename, index=False)
+    while current_end >= start_utc:
+        firma = firma_ticks(contract, WHAT_TO_SHOW, current_end, TICKS_POR_PAGINA, rth)
+        ticks = cache_respuestas.obtener(firma)
+        if ticks is None:
+            gobernador.adquirir(clave_contrato(contract, WHAT_TO_SHOW),
+                                firma=(contract.conId, WHAT_TO_SHOW, current_end, TICKS_POR_PAGINA))
+            marca = gobernador.marca()
+            try:
+                ticks = ib.reqHistoricalTicks(
+                    contract,
+                    startDateTime="",
+                    endDateTime=current_end,
+                    numberOfTicks=TICKS_POR_PAGINA,
+                    whatToShow=WHAT_TO_SHOW,
+                    useRth=rth,
+                    ignoreSize=False
+                )
+                gobernador.verificar_respuesta(marca, contract, ticks)
+                gobernador.notificar_exito()
+                cache_respuestas.guardar(firma, ticks)
+                fallos = 0
+            except Exception as e:
+                fallos += 1
+                logger.error(f"⚠️ reqHistoricalTicks fallo hasta {current_end} ({fallos}/{REINTENTOS_BLOQUE}): {e}")
+                if fallos < REINTENTOS_BLOQUE:
+                    continue
+                break   # lo que falta queda como hueco para completar_sesion
+
+        page_ib = ticks_to_frame(ticks, WHAT_TO_SHOW, start_utc, end_utc)
+        page = dedupe.filtrar(page_ib)
+        if page.empty:
+            if page_ib.empty or len(ticks) < TICKS_POR_PAGINA:
+                break
+            # la página entera es el segundo frontera ya visto (>= TICKS_POR_PAGINA ticks en ese
+            # segundo): IB sólo entiende segundos, así que se sigue desde el anterior
+            logger.warning(f"    ⚠️ Página completa en el segundo de {current_end}: se sigue desde el anterior")
+            current_end -= timedelta(seconds=1)
+            continue
+        frames.append(page)
+
+        clave = current_end.isoformat()
+        earliest = page["time"].min().to_pydatetime()
+        current_end = earliest if earliest < current_end else current_end - timedelta(seconds=1)
+        if staging is not None:
+            staging.guardar_bloque(clave, page, cursor=current_end.isoformat())
+
+    return concat_frames(frames, columnas_ticks(WHAT_TO_SHOW))
 
-    # Formatear la columna A como datetime 'yyyy-mm-dd hh:mm:ss' usando openpyxl
-    try:
-        wb = load_workbook(filename)
-        ws = wb.active
-        for cell in ws["A"][2:]:  # saltar encabezado (fila 1)
-            cell.number_format = "yyyy-mm-dd hh:mm:ss"
-        wb.save(filename)
-    except Exception as e:
-        print(f"    ⚠️ No se pudo aplicar formato a {filename}: {e}")
 
-    print(f"    💾 Guardado {filename} ({len(df)} filas)")
 
 # ----------------------------
 # LÓGICA PRINCIPAL
@@ -531,127 +631,206 @@ logger.setLevel(logging.INFO)
 
 
 
-def main():
-    ib = connect_ib()
-
-    today_ny = datetime.now(pytz.utc).astimezone(NY_TZ).date()
-    market_open_now = is_market_open()
-
-    barras=""
-
-    config = pd.read_excel(EXCEL_CONFIG)
-    for _, row in config.iterrows():
-        ticker, tipo = row["Ticker"], row["Tipo"]
-        contract = build_contract(ticker, tipo)
-        logger.info(f"Procesando {ticker} ({tipo})")
-
-        # 1s
-        if row.get("Bars1s", 0) == 1:
-            ruta= ensure_symbol_dir (BASE_DIR, "Bars1s", ticker)
-            os.makedirs(ruta, exist_ok=True)
-            downloaded = list_downloaded_dates(ruta)
-            barras= "Bars1s"
-            logger.info(f"Descargando barras de 1 sg de {ticker} ")
-
-        # 15m
-        if row.get("Bars15m", 0) == 1:
-            ruta = ensure_symbol_dir(BASE_DIR, "Bars15m", ticker)
-            os.makedirs(ruta, exist_ok=True)
-            downloaded = list_downloaded_dates(ruta)
-            barras = "Bars15m"
-            logger.info(f"Descargando barras de 15 minutos de {ticker} ")
-
-        # 1h
-        if row.get("Bars1h", 0) == 1:
-            ruta = ensure_symbol_dir(BASE_DIR, "Bars1h", ticker)
-            os.makedirs(ruta, exist_ok=True)
-            downloaded = list_downloaded_dates(ruta)
-            barras = "Bars1h"
-            logger.info(f"Descargando barras de 1 hora de {ticker} ")
-
-        # Diario
-        if row.get("BarsD", 0) == 1:
-            ruta = ensure_symbol_dir(BASE_DIR, "BarsD", ticker)
-            os.makedirs(ruta, exist_ok=True)
-            downloaded = list_downloaded_dates(ruta)
-            barras = "BarsD"
-            logger.info(f"Descargando barras diarias de {ticker} ")
-
-        #Tick a Tick
-        if row.get("Tick2Tick", 0) == 1:
-            barras = "Tick2Tick"
-            logger.info(f"Tick a Tick  {ticker} ")
-
-
-
-
-        if not downloaded:
-            # primer arranque: intentamos INIT_DAYS_BACK días atrás (ajustando fines de semana)
-            end_date = today_ny
-            if market_open_now:
-                end_date = prev_business_day(today_ny)  # no descargar sesión en curso
-            # retroceder hasta obtener INIT_DAYS_BACK business days
-            start_date = end_date
-            days_added = 0
-            while days_added < INIT_DAYS_BACK:
-                if start_date.weekday() < 5:
-                    days_added += 1
-                start_date -= timedelta(days=1)
-            # after loop start_date is 1 day earlier than needed
-            start_date = next_business_day(start_date)
-
-        else:
-            last = max(downloaded)
-            start_date = next_business_day(last)
-            if market_open_now:
-                end_date = prev_business_day(today_ny)
-            else:
-                end_date = today_ny
-
-        if start_date > end_date:
-            logger.info("  ✅ No hay días nuevos que descargar")
-            continue
-
-        logger.debug(f"Descargando rango: {start_date} → {end_date} (market_open_now={market_open_now})")
-
-        # No funciona contract = Future(symbol, '202509', 'GLOBEX')
-        try:
-            ib.qualifyContracts(contract)
-        except Exception as e:
-            logger.info(f"  ⚠️ qualifyContracts fallo para {symbol}: {e}")
-
-        d = start_date
-
-
-        while d <= end_date:
-            if d.weekday() >= 5:
-                d = next_business_day(d)
+def huecos_sesion(df_day, barra, session_start, session_end):
+    """
+    Quita filas fuera de sesión y duplicados y valida la sesión. Devuelve (sesión limpia,
+    peticiones de relleno): [] si no hay huecos, None si son más de MAX_PETICIONES_RELLENO.
+    """
+    df_day = limpiar_sesion(df_day, barra, session_start, session_end)
+    informe = validar_sesion(df_day, barra, session_start, session_end)
+    if informe.correcta:
+        return df_day, []
+    logger.info(f"    🔎 {barra} {session_start.date()}: {informe.resumen()}")
+
+    peticiones = planificar_peticiones(informe, barra)
+    if len(peticiones) > MAX_PETICIONES_RELLENO:
+        logger.info(f"    {len(peticiones)} peticiones de relleno (> {MAX_PETICIONES_RELLENO}), no se rellena")
+        return df_day, None
+    return df_day, peticiones
+
+def juntar_relleno(df_day, frames, barra, session_start, session_end, sin_fallos):
+    """
+    Une los tramos pedidos a la sesión. Devuelve (sesión, revisada): revisada si IB ha
+    contestado a todo el relleno (sin_fallos) sin nada nuevo, es decir, lo que falta no existe
+    (tramos sin trades de un valor poco líquido) y no hay que volver a pedirla.
+    """
+    antes = len(df_day)
+    # ticks: las columnas de la sesión (otro WHAT_TO_SHOW si viene de DescargaTick)
+    columnas = ["time"] + COLUMNAS_BARRAS if barra in VENTANA_MAX_SG else \
+        list(df_day.columns) or columnas_ticks(WHAT_TO_SHOW)
+    df_day = limpiar_sesion(concat_frames([df_day] + frames, columnas), barra, session_start, session_end)
+    nuevas = len(df_day) - antes
+    logger.info(f"    🩹 Relleno con {len(frames)} tramos: {nuevas} filas nuevas")
+    return df_day, nuevas == 0 and sin_fallos
+
+def completar_sesion(ib, contract, barra, df_day, session_start, session_end, pedir_ticks=None):
+    """
+    Valida la sesión y pide a IB sólo los huecos (plan mínimo de validacion.planificar_peticiones).
+    Devuelve (sesión completada, revisada); revisada también si no había huecos.
+    pedir_ticks(ib, contract, inicio, fin): cadena de páginas de un hueco de ticks
+    (fetch_ticks_tick2tick por defecto; DescargaTick pasa la suya).
+    """
+    df_day, peticiones = huecos_sesion(df_day, barra, session_start, session_end)
+    if not peticiones:
+        return df_day, peticiones is not None
+
+    marca_relleno = gobernador.marca()
+    fallidas = 0
+    frames = []
+    for p in peticiones:
+        if barra not in VENTANA_MAX_SG:
+            # ticks: una cadena de páginas por hueco; los extremos son ticks que ya teníamos
+            try:
+                tramo = (pedir_ticks or fetch_ticks_tick2tick)(ib, contract, p.inicio, p.fin)
+            except Exception as e:
+                fallidas += 1
+                logger.error(f"⚠️ Relleno {p.inicio} → {p.fin} fallo: {e}")
                 continue
-            if d in downloaded:
-                logger.info (f"    {d} ya descargado se salta")
-                d = next_business_day(d)
+            frames.append(tramo[(tramo["time"] > p.inicio) & (tramo["time"] < p.fin)])
+            continue
+        rth = calendario_contrato(contract).rth
+        firma = firma_barras(contract, WHAT_TO_SHOW, p.fin, p.duracion, p.tamaño, rth)
+        bars = cache_respuestas.obtener(firma)
+        if bars is None:
+            gobernador.adquirir(clave_contrato(contract, WHAT_TO_SHOW),
+                                firma=(contract.conId, WHAT_TO_SHOW, p.fin, p.duracion, p.tamaño))
+            marca = gobernador.marca()
+            try:
+                bars = ib.reqHistoricalData(
+                    contract,
+                    endDateTime=p.fin.to_pydatetime(),
+                    durationStr=p.duracion,
+                    barSizeSetting=p.tamaño,
+                    whatToShow=WHAT_TO_SHOW,
+                    useRTH=rth,
+                    formatDate=1,
+                    keepUpToDate=False
+                )
+                gobernador.verificar_respuesta(marca, contract, bars)
+                gobernador.notificar_exito()
+                cache_respuestas.guardar(firma, bars)
+            except Exception as e:
+                fallidas += 1
+                logger.error(f"⚠️ Relleno {p.inicio} → {p.fin} fallo: {e}")
                 continue
+        frames.append(bars_to_frame(bars, p.inicio, p.fin))
 
-            logger.info (f"Descargando sesión {d}")
-            session_start = NY_TZ.localize(datetime.combine(d, SESSION_OPEN))
-            session_end = NY_TZ.localize(datetime.combine(d, SESSION_CLOSE))
-            try:
+    sin_fallos = not fallidas and gobernador.error_desde(marca_relleno, contract) is None
+    return juntar_relleno(df_day, frames, barra, session_start, session_end, sin_fallos)
 
-                df_day = fetch_ticks_for_session(ib, contract, session_start, session_end,barras )
-                if not df_day.empty:
-                    save_session_df(ruta, d, df_day)
-                    time.sleep(30.0) #Evitar el pacing
-                else:
-                    logger.info (f"    ⚠️ No hubo ticks para {ticker} {d}")
-            except Exception as e:
-                logger.info (f"    ❌ Error Descargar {ticker} {d}: {e}")
+def guardar_sesion(manifiesto, ticker, barra, ruta, d, df_day, session_start, session_end, revisada=False):
+    """
+    Guarda la sesión (si tiene datos) y la registra en el manifiesto con su estado.
+    revisada (ver completar_sesion): completa aunque no llegue a la cobertura mínima.
+    """
+    filename = save_session_df(ruta, d, df_day) if not df_day.empty else None
+    esperadas = filas_esperadas(barra, session_start.astimezone(pytz.utc),
+                                session_end.astimezone(pytz.utc))
+    return manifiesto.registrar(ticker, barra, d, df_day, ruta=filename, esperadas=esperadas,
+                                estado=ESTADO_COMPLETA if revisada else None)
 
-            d = next_business_day(d)
+def descargar_o_derivar(ib, manifiesto, contract, ticker, barra, ruta, d):
+    """
+    Obtiene la sesión d para la barra indicada. Si la barra se puede construir a partir de
+    la sesión de 1 sg ya guardada (y completa) se agrega en local; si no, se pide a IB.
+    """
+    sesion = sesion_ny(d, contract)
+    if sesion is None:
+        logger.info(f"    {d} sin sesión (festivo) para {ticker}, no se pide")
+        manifiesto.registrar(ticker, barra, d, None, con_sesion=False)
+        return
+    session_start, session_end = sesion
+
+    if es_derivable(barra):
+        sesion_1s = manifiesto.sesion(ticker, BARRA_ORIGEN, d)
+        if sesion_1s is not None and sesion_1s["estado"] == ESTADO_COMPLETA:
+            ruta_1s = ensure_symbol_dir(BASE_DIR, BARRA_ORIGEN, ticker)
+            df_day = derivar_sesion(ruta_1s, barra, d, session_start, session_end)
+            if df_day is not None:
+                # sale de una sesión de 1 sg completa: lo que falte tampoco está en IB
+                guardar_sesion(manifiesto, ticker, barra, ruta, d, df_day, session_start, session_end,
+                               revisada=True)
+                return
+
+    # sesión parcial ya guardada: pedir sólo sus huecos en vez de la sesión entera
+    previa = manifiesto.sesion(ticker, barra, d)
+    if previa is not None and previa["estado"] == ESTADO_PARCIAL:
+        df_prev = read_session_df(ruta, d)
+        if df_prev is not None and not df_prev.empty:
+            df_day, revisada = completar_sesion(ib, contract, barra, df_prev, session_start, session_end)
+            guardar_sesion(manifiesto, ticker, barra, ruta, d, df_day, session_start, session_end, revisada)
+            return
+
+    staging = StagingSesion(ruta, d)
+    if barra == "Tick2Tick":
+        df_day = fetch_ticks_tick2tick(ib, contract, session_start, session_end, staging)
+    else:
+        df_day = fetch_ticks_for_session(ib, contract, session_start, session_end, barra, staging)
+    df_day, revisada = completar_sesion(ib, contract, barra, df_day, session_start, session_end)
+    if df_day.empty:
+        logger.info (f"    ⚠️ No hubo ticks para {ticker} {d}")
+    guardar_sesion(manifiesto, ticker, barra, ruta, d, df_day, session_start, session_end, revisada)
+    staging.limpiar()  # sólo cuando la sesión ya está guardada
+
+def conectar_pool(clientes=None):
+    """Pool de conexiones (conexiones.py); por defecto una histórica con IB_CLIENTID."""
+    pool = PoolConexiones(clientes or {TIPO_HISTORICO: [IB_CLIENTID]}, IB_HOST, IB_PORT, fabrica=nuevo_ib)
+    pool.conectar()
+    # Los errores de pacing (162/420) de cualquier conexión activan el backoff del gobernador
+    pool.suscribir("errorEvent", gobernador.on_error)
+    return pool
 
-    ib.disconnect()
+def main():
+    pool = conectar_pool()
+    ib = pool.ib(TIPO_HISTORICO)
+    manifiesto = Manifiesto(MANIFIESTO_DB)
+    plan_bloques.cargar(PLAN_BLOQUES_JSON)
+    cache_respuestas.abrir(CACHE_RESPUESTAS_DIR)
+    cache_contratos.abrir(CONTRATOS_DB)
+
+    # configuración validada una sola vez y plan explícito de lo que falta (planificador.py)
+    activos = cargar_config(EXCEL_CONFIG, BARRAS)
+    contratos = {a.ticker: build_contract(a.ticker, a.tipo) for a in activos}
+    # refresco diario en un solo lote: lo que no esté cualificado hoy se pide todo junto
+    try:
+        cache_contratos.cualificar(ib, *contratos.values())
+    except Exception as e:
+        logger.info(f"  ⚠️ qualifyContracts del lote fallo: {e}")
+    for ticker, contract in contratos.items():
+        if not getattr(contract, "conId", 0):
+            logger.info(f"  ⚠️ qualifyContracts fallo para {ticker}")
+
+    plan = planificar(activos, manifiesto, init_days_back=INIT_DAYS_BACK)
+    logger.info(plan.resumen())
+    if not plan.tareas:
+        logger.info("  ✅ No hay días nuevos que descargar")
+
+    programa = Programa(plan, presupuesto_sg=PRESUPUESTO_BACKFILL_SG)
+    for turno in programa:
+        ticker, tipo, barra, d = turno.sesion
+        logger.info(f"Descargando {DESCRIPCION_BARRA[barra]} de {ticker}, sesión {d}")
+        ruta = ensure_symbol_dir(BASE_DIR, barra, ticker)
+        try:
+            # si la conexión se cayó en la sesión anterior, se reconecta (con backoff) antes de seguir
+            pool.comprobar()
+            ib = pool.ib(TIPO_HISTORICO)
+            descargar_o_derivar(ib, manifiesto, contratos[ticker], ticker, barra, ruta, d)
+        except Exception as e:
+            logger.info (f"    ❌ Error Descargar {ticker} {d}: {e}")
+
+    logger.info(f"Programa: {programa.resumen()}")
+    logger.info(f"Pacing: {gobernador.resumen()}")
+    logger.info(f"Bloques: {plan_bloques.resumen()}")
+    logger.info(f"Caché de respuestas: {cache_respuestas.resumen()}")
+    logger.info(f"Contratos: {cache_contratos.resumen()}")
+    plan_bloques.guardar(PLAN_BLOQUES_JSON)
+    cache_respuestas.close()
+    cache_contratos.close()
+    logger.info(f"Conexiones: {pool.resumen()}")
+    manifiesto.close()
+    pool.desconectar()
     logger.info ("\n  Desconectado. Proceso finalizado.")
 
 
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,365 @@
+'''
+Ingesta vectorizada de páginas de IB (BarData / HistoricalTick*).
+
+tick_obj_to_row y el bucle de barras de fetch_ticks_for_session construyen un dict por fila,
+con _get_attr sobre varios nombres, pytz.utc.localize, un closure _flt e isoformat() en cada
+una. Aquí una página entera se convierte de una pasada a columnas NumPy preasignadas:
+
+1.- time como int64 ns UTC (la zona horaria se resuelve una vez por página, no por fila).
+2.- precios y tamaños como float64 (None o valores no numéricos -> NaN).
+3.- el esquema (qué atributo trae bid/ask/size) se decide con el primer objeto de la página.
+
+Las funciones devuelven DataFrames con time datetime64[ns, UTC], listos para concat y guardar.
+
+DedupeFrontera quita los ticks repetidos entre páginas consecutivas de reqHistoricalTicks.
+FusionAsOf junta, página a página, los trades con la cotización vigente (Trades + Bid_Ask).
+'''
+
+from datetime import timezone
+from operator import attrgetter
+
+import numpy as np
+import pandas as pd
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+COLUMNAS_BARRAS = ["open", "high", "low", "close", "volume"]
+
+# Nombres posibles de cada campo según la clase de tick (HistoricalTickBidAsk / HistoricalTickLast)
+CAMPOS_BID_ASK = {
+    "bid": ["priceBid", "bidPrice", "bid"],
+    "bid_size": ["sizeBid", "bidSize", "size_bid"],
+    "ask": ["priceAsk", "askPrice", "ask"],
+    "ask_size": ["sizeAsk", "askSize", "size_ask"],
+}
+CAMPOS_TRADES = {
+    "price": ["price", "lastPrice"],
+    "size": ["size", "lastSize"],
+}
+
+# Columnas que forman la clave de un tick (además de time y la secuencia)
+COLUMNAS_CLAVE_TICK = ["bid", "bid_size", "ask", "ask_size", "price", "size"]
+NS_SEGUNDO = 1_000_000_000
+
+# Sesión Trades + Bid_Ask: cada trade con la cotización vigente y el lado (+1 compra, -1 venta)
+COLUMNAS_FUSION = ["time", "price", "size", "bid", "bid_size", "ask", "ask_size", "midpoint", "lado"]
+MAX_FILAS_ESPERA = 50_000           # filas de un flujo esperando al otro antes de frenarlo
+
+
+def _tiempos_ns(valores):
+    """
+    Lista de datetime/date (todas con la misma zona, como vienen en una página de IB)
+    -> array int64 ns UTC. Naive se interpreta como UTC, igual que tick_obj_to_row.
+    """
+    # pandas >= 2 puede inferir resolución en us: se fuerza ns antes de sacar los int64
+    return pd.to_datetime(valores, utc=True).astype("datetime64[ns, UTC]").asi8
+
+
+def _a_float(columna):
+    """Columna de objetos -> float64; None / no numéricos pasan a NaN."""
+    try:
+        return np.array(columna, dtype=np.float64)
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(columna, dtype=object), errors="coerce").to_numpy(np.float64)
+
+
+def _resolver_campos(obj, campos):
+    """Para cada columna, el primer atributo que existe en obj (o None)."""
+    return {col: next((n for n in nombres if hasattr(obj, n)), None) for col, nombres in campos.items()}
+
+
+def _ns(ts):
+    if ts is None:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return pd.Timestamp(ts).value
+
+
+def _filtrar(df, ns, start_utc, end_utc):
+    mask = np.ones(len(ns), dtype=bool)
+    if start_utc is not None:
+        mask &= ns >= _ns(start_utc)
+    if end_utc is not None:
+        mask &= ns <= _ns(end_utc)
+    if mask.all():
+        return df
+    return df[mask].reset_index(drop=True)
+
+
+def _frame(ns, columnas):
+    datos = {"time": pd.to_datetime(ns, utc=True)}
+    datos.update(columnas)
+    return pd.DataFrame(datos)
+
+
+def bars_to_frame(bars, start_utc=None, end_utc=None):
+    """
+    Página de BarData -> DataFrame (time, open, high, low, close, volume),
+    filtrando lo que queda fuera de [start_utc, end_utc].
+    """
+    if not bars:
+        return pd.DataFrame({"time": pd.Series(dtype="datetime64[ns, UTC]"),
+                             **{c: pd.Series(dtype="float64") for c in COLUMNAS_BARRAS}})
+
+    ns = _tiempos_ns([b.date for b in bars])
+    # una sola pasada para las cinco columnas
+    matriz = _a_float(list(map(attrgetter(*COLUMNAS_BARRAS), bars)))
+    columnas = {c: matriz[:, i] for i, c in enumerate(COLUMNAS_BARRAS)}
+    return _filtrar(_frame(ns, columnas), ns, start_utc, end_utc)
+
+
+def columnas_ticks(what_to_show):
+    """Columnas de una sesión de ticks según WHAT_TO_SHOW."""
+    if str(what_to_show).lower() == "trades+bid_ask":
+        return list(COLUMNAS_FUSION)
+    if str(what_to_show).lower() == "bid_ask":
+        return ["time"] + list(CAMPOS_BID_ASK) + ["midpoint"]
+    return ["time"] + list(CAMPOS_TRADES)
+
+
+def diaria_a_sesion(df, dia, apertura_utc):
+    """
+    Barras diarias de IB (fechadas con date, es decir medianoche) -> la fila del día de la
+    sesión con time = apertura, como las que construye remuestreo.resample_session.
+    """
+    if df.empty:
+        return df
+    fila = df[df["time"].dt.date == dia]
+    return fila.assign(time=pd.Timestamp(apertura_utc)).reset_index(drop=True)
+
+
+def ticks_to_frame(ticks, what_to_show, start_utc=None, end_utc=None):
+    """
+    Página de HistoricalTick* -> DataFrame con el mismo esquema que tick_obj_to_row:
+        Bid_Ask: time, bid, bid_size, ask, ask_size, midpoint
+        resto:   time, price, size
+    """
+    bid_ask = str(what_to_show).lower() == "bid_ask"
+    campos = CAMPOS_BID_ASK if bid_ask else CAMPOS_TRADES
+    if not ticks:
+        cols = list(campos) + (["midpoint"] if bid_ask else [])
+        return pd.DataFrame({"time": pd.Series(dtype="datetime64[ns, UTC]"),
+                             **{c: pd.Series(dtype="float64") for c in cols}})
+
+    ticks = [t for t in ticks if getattr(t, "time", None) is not None]
+    ns = _tiempos_ns([t.time for t in ticks])
+
+    nombres = _resolver_campos(ticks[0], campos)
+    presentes = [c for c, n in nombres.items() if n is not None]
+    columnas = {c: np.full(len(ticks), np.nan) for c in campos}
+    if presentes:
+        getter = attrgetter(*[nombres[c] for c in presentes])
+        matriz = _a_float(list(map(getter, ticks)))
+        if matriz.ndim == 1:
+            matriz = matriz[:, None]
+        for i, c in enumerate(presentes):
+            columnas[c] = matriz[:, i]
+
+    if bid_ask:
+        bid, ask = columnas["bid"], columnas["ask"]
+        # como tick_obj_to_row: sólo si hay bid y ask distintos de 0
+        valido = (bid != 0) & (ask != 0) & ~np.isnan(bid) & ~np.isnan(ask)
+        columnas["midpoint"] = np.where(valido, (bid + ask) / 2.0, np.nan)
+
+    return _filtrar(_frame(ns, columnas), ns, start_utc, end_utc)
+
+
+def concat_frames(frames, columnas):
+    """Concatena las páginas y ordena por time (estable: respeta el orden de llegada)."""
+    frames = [f for f in frames if f is not None and not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=columnas)
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values("time", kind="stable").reset_index(drop=True)
+
+
+# ----------------------------
+# DEDUPE ENTRE PÁGINAS DE TICKS
+# ----------------------------
+def _ns_columna(df):
+    return df["time"].astype("datetime64[ns, UTC]").array.asi8
+
+
+def claves_ticks(df):
+    """
+    Claves numéricas de cada tick como matriz int64: time en ns, los bits float64 de
+    precios y tamaños vistos como int64 y un número de secuencia entre ticks idénticos.
+    La secuencia hace que dos trades iguales en el mismo instante sean dos claves distintas.
+    """
+    partes = [_ns_columna(df)]
+    for c in COLUMNAS_CLAVE_TICK:
+        if c in df.columns:
+            v = df[c].to_numpy(np.float64, copy=True)
+            v[np.isnan(v)] = np.nan  # un único patrón de bits para NaN
+            partes.append(v.view(np.int64))
+    matriz = np.column_stack(partes)
+    secuencia = pd.DataFrame(matriz).groupby(list(range(matriz.shape[1])), sort=False).cumcount()
+    return np.column_stack([matriz, secuencia.to_numpy(np.int64)])
+
+
+class DedupeFrontera:
+    """
+    Quita los ticks repetidos entre páginas de reqHistoricalTicks pedidas hacia atrás.
+
+    Cada página termina en el tick más antiguo de la anterior, así que sólo se solapan en
+    el segundo frontera. Sólo se guardan las claves de ese segundo (la memoria no crece con
+    la sesión): lo posterior ya está cubierto y lo anterior es nuevo seguro.
+    """
+
+    def __init__(self):
+        self.segundo = None     # inicio (ns) del segundo frontera
+        self._claves = set()
+
+    def cargar(self, df):
+        """Prepara la frontera a partir de ticks ya descargados (staging al reanudar)."""
+        self.segundo = None
+        self._claves = set()
+        if df is not None and not df.empty:
+            self._avanzar(df, np.ones(len(df), dtype=bool))
+
+    def filtrar(self, page):
+        """Devuelve sólo los ticks nuevos de la página y mueve la frontera."""
+        if page.empty:
+            return page
+        if self.segundo is None:
+            nuevos = np.ones(len(page), dtype=bool)
+        else:
+            segundos = _ns_columna(page) // NS_SEGUNDO * NS_SEGUNDO
+            nuevos = segundos < self.segundo
+            frontera = np.flatnonzero(segundos == self.segundo)
+            if len(frontera):
+                claves = claves_ticks(page.iloc[frontera]).tolist()
+                nuevos[frontera] = [tuple(k) not in self._claves for k in claves]
+        self._avanzar(page, nuevos)
+        return page[nuevos].reset_index(drop=True)
+
+    def _avanzar(self, page, nuevos):
+        if not nuevos.any():
+            return
+        segundos = _ns_columna(page) // NS_SEGUNDO * NS_SEGUNDO
+        minimo = int(segundos[nuevos].min())
+        if minimo != self.segundo:
+            self.segundo = minimo
+            self._claves = set()
+        # claves calculadas con el contexto de la página: la secuencia sigue contando
+        # a partir de las repeticiones que ya estaban guardadas
+        en_frontera = np.flatnonzero(segundos == minimo)
+        claves = claves_ticks(page.iloc[en_frontera]).tolist()
+        self._claves.update(tuple(k) for k, n in zip(claves, nuevos[en_frontera]) if n)
+
+
+# ----------------------------
+# FUSIÓN TRADES + BID_ASK (as-of por páginas)
+# ----------------------------
+class FusionAsOf:
+    """
+    Une dos cadenas de páginas pedidas hacia atrás (Trades y Bid_Ask) dejando en cada trade
+    la última cotización con time <= el del trade (merge_asof hacia atrás).
+
+    Se trabaja por segundos: las páginas se cortan en el segundo del tick más antiguo, así
+    que ese segundo puede estar incompleto hasta que llegue la página siguiente.
+
+    1.- Un trade está listo cuando las cotizaciones ya llegan a un segundo anterior al suyo
+        (o la cadena de cotizaciones terminó).
+    2.- Las cotizaciones posteriores al segundo frontera de los trades (y al último trade
+        que espera) ya no las necesita ningún trade y se descartan.
+
+    Así en memoria sólo queda el tramo entre las dos fronteras. puede_pedir() frena al flujo
+    que va por delante cuando acumula MAX_FILAS_ESPERA filas esperando al otro.
+    """
+
+    def __init__(self, max_filas=MAX_FILAS_ESPERA):
+        self.max_filas = max_filas
+        self._trades = []           # páginas pendientes, de la más antigua a la más reciente
+        self._cotizaciones = []
+        self.frontera = {"trades": None, "cotizaciones": None}      # segundo (ns) del tick más antiguo
+        self.terminado = {"trades": False, "cotizaciones": False}
+
+    @staticmethod
+    def _filas(frames):
+        return sum(len(f) for f in frames)
+
+    def anadir(self, flujo, page):
+        """Página (ya sin duplicados) de 'trades' o 'cotizaciones'. Devuelve los trades listos."""
+        if not page.empty:
+            buffer = self._trades if flujo == "trades" else self._cotizaciones
+            buffer.insert(0, page)
+            segundo = int(_ns_columna(page).min()) // NS_SEGUNDO * NS_SEGUNDO
+            previo = self.frontera[flujo]
+            self.frontera[flujo] = segundo if previo is None else min(previo, segundo)
+        return self._listos()
+
+    def terminar(self, flujo):
+        """La cadena del flujo llegó al inicio de la sesión (o se cortó). Devuelve los trades listos."""
+        self.terminado[flujo] = True
+        return self._listos()
+
+    def necesita(self, flujo):
+        """False si ese flujo ya no tiene que pedir más páginas."""
+        if self.terminado[flujo]:
+            return False
+        if flujo == "cotizaciones" and self.terminado["trades"]:
+            return bool(self._trades)
+        return True
+
+    def puede_pedir(self, flujo):
+        """True si el flujo puede pedir otra página sin que crezca la memoria."""
+        otro = "cotizaciones" if flujo == "trades" else "trades"
+        if self.terminado[otro] or self.frontera[flujo] is None or self.frontera[otro] is None:
+            return True
+        if self.frontera[flujo] >= self.frontera[otro]:
+            return True     # va por detrás: tiene que alcanzar al otro
+        buffer = self._trades if flujo == "trades" else self._cotizaciones
+        return self._filas(buffer) < self.max_filas
+
+    def _listos(self):
+        if not self._trades:
+            return pd.DataFrame(columns=COLUMNAS_FUSION)
+        trades = pd.concat(self._trades, ignore_index=True).sort_values("time", kind="stable")
+        if self.terminado["cotizaciones"]:
+            listos, pendientes = trades, trades.iloc[:0]
+        elif self.frontera["cotizaciones"] is None:
+            return pd.DataFrame(columns=COLUMNAS_FUSION)
+        else:
+            ok = _ns_columna(trades) >= self.frontera["cotizaciones"] + NS_SEGUNDO
+            listos, pendientes = trades[ok], trades[~ok]
+        self._trades = [pendientes] if len(pendientes) else []
+        fusion = self._fusionar(listos)
+        self._podar()
+        return fusion
+
+    def _fusionar(self, trades):
+        if trades.empty:
+            return pd.DataFrame(columns=COLUMNAS_FUSION)
+        columnas = ["time", "bid", "bid_size", "ask", "ask_size", "midpoint"]
+        if self._cotizaciones:
+            cot = pd.concat(self._cotizaciones, ignore_index=True).sort_values("time", kind="stable")
+        else:
+            cot = pd.DataFrame({c: pd.Series(dtype="float64") for c in columnas})
+            cot["time"] = pd.Series(dtype="datetime64[ns, UTC]")
+        cot = cot[columnas]
+        cot["time"] = cot["time"].astype("datetime64[ns, UTC]")
+        trades = trades[["time", "price", "size"]].reset_index(drop=True)
+        trades["time"] = trades["time"].astype("datetime64[ns, UTC]")
+        df = pd.merge_asof(trades, cot, on="time", direction="backward")
+        mid = df["midpoint"].to_numpy(np.float64)
+        precio = df["price"].to_numpy(np.float64)
+        df["lado"] = np.sign(precio - mid)     # regla de la cotización: NaN si no hay cotización
+        return df[COLUMNAS_FUSION]
+
+    def _podar(self):
+        """Quita las cotizaciones que ningún trade pendiente o por llegar puede usar."""
+        if self.frontera["trades"] is None or not self._cotizaciones:
+            return
+        if self.terminado["trades"] and not self._trades:
+            self._cotizaciones = []
+            return
+        limite = self.frontera["trades"] + NS_SEGUNDO
+        if self._trades:
+            # los trades que esperan pueden ser posteriores a la frontera de los trades
+            limite = max(limite, max(int(_ns_columna(f).max()) for f in self._trades) + 1)
+        podadas = [f[_ns_columna(f) < limite] for f in self._cotizaciones]
+        self._cotizaciones = [f for f in podadas if not f.empty]
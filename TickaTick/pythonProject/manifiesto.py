@@ -0,0 +1,273 @@
+'''
+Manifiesto persistente de sesiones descargadas (SQLite junto a BASE_DIR).
+
+list_downloaded_dates hace os.listdir + strptime de cada directorio en cada ejecución y no
+distingue una sesión completa de una parcial o vacía, ni de qué barra viene el fichero.
+El manifiesto guarda una fila por (symbol, barra, fecha) con:
+
+    filas, primer/último timestamp (UTC), checksum del fichero, estado y ruta.
+
+Estados:
+    completa -> cubre al menos MIN_COBERTURA de las filas esperadas, o ya se ha revisado y IB
+                no tiene más (segundos sin trades de un valor poco líquido)
+    parcial  -> le faltan filas (o no tiene ninguna en un día de mercado: puede ser un
+                fallo de IB, p.ej. pacing): el planificador la vuelve a pedir
+    vacia    -> el calendario dice que ese día no hubo sesión
+
+Por (symbol, barra) se guarda además la frontera de backfill: última sesión hasta la que el
+historial está descargado sin huecos. El planificador revisa desde ahí, así que las sesiones
+antiguas que quedan pendientes no se pierden cuando se descarga una más reciente.
+
+La primera vez que se consulta un (symbol, barra) sin filas en el manifiesto se importan los
+ficheros que ya existan en el directorio, así los históricos antiguos no se vuelven a bajar.
+Se clasifican igual que los nuevos (filas esperadas según el calendario), así que una sesión
+antigua truncada queda parcial y se rellena.
+'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+import logging
+
+from almacen import list_downloaded_dates, find_session_file, read_session_file
+from calendario import calendario
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+MIN_COBERTURA = 0.95                # fracción de filas esperadas para dar la sesión por completa
+
+# Segundos por barra para estimar las filas esperadas de una sesión. None = no se puede estimar.
+SEGUNDOS_BARRA = {
+    "Bars1s": 1,
+    "Bars15m": 15 * 60,
+    "Bars1h": 60 * 60,
+    "BarsD": None,
+    "Tick2Tick": None,
+}
+
+ESTADO_COMPLETA = "completa"
+ESTADO_PARCIAL = "parcial"
+ESTADO_VACIA = "vacia"
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS sesiones (
+    symbol      TEXT NOT NULL,
+    barra       TEXT NOT NULL,
+    fecha       TEXT NOT NULL,
+    filas       INTEGER NOT NULL,
+    primer_ts   TEXT,
+    ultimo_ts   TEXT,
+    checksum    TEXT,
+    estado      TEXT NOT NULL,
+    ruta        TEXT,
+    actualizado TEXT NOT NULL,
+    PRIMARY KEY (symbol, barra, fecha)
+);
+CREATE TABLE IF NOT EXISTS fronteras (
+    symbol      TEXT NOT NULL,
+    barra       TEXT NOT NULL,
+    fecha       TEXT NOT NULL,
+    PRIMARY KEY (symbol, barra)
+);
+"""
+
+
+def filas_esperadas(barra, start_utc, end_utc):
+    """Nº de barras que debería tener la sesión o None si no se puede estimar (ticks, diario)."""
+    paso = SEGUNDOS_BARRA.get(barra)
+    if paso is None:
+        return None
+    segundos = (end_utc - start_utc).total_seconds()
+    return int(-(-segundos // paso))  # techo
+
+
+def checksum_fichero(path, bloque=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for trozo in iter(lambda: f.read(bloque), b""):
+            h.update(trozo)
+    return h.hexdigest()
+
+
+def _iso(ts):
+    if ts is None:
+        return None
+    return ts.isoformat()
+
+
+class Manifiesto:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.executescript(_ESQUEMA)
+        self._con.commit()
+
+    def close(self):
+        self._con.close()
+
+    # ----------------------------
+    # Escritura
+    # ----------------------------
+    def registrar(self, symbol, barra, fecha, df, ruta=None, esperadas=None, estado=None, con_sesion=True):
+        """
+        Registra (o actualiza) la sesión a partir del DataFrame guardado.
+        estado: si se indica (p.ej. parcial porque se sabe que tiene huecos), no se deduce
+        de la cobertura. con_sesion=False: el calendario dice que ese día no hubo sesión.
+        Devuelve el estado asignado.
+        """
+        forzado = estado
+        filas = 0 if df is None else len(df)
+        if filas == 0:
+            # sin filas en un día de mercado no es "vacía": se vuelve a pedir
+            estado = ESTADO_PARCIAL if con_sesion else ESTADO_VACIA
+            primer = ultimo = None
+        else:
+            primer, ultimo = df["time"].min(), df["time"].max()
+            if esperadas and filas < MIN_COBERTURA * esperadas:
+                estado = ESTADO_PARCIAL
+            else:
+                estado = ESTADO_COMPLETA
+        if con_sesion:
+            estado = forzado or estado
+
+        checksum = checksum_fichero(ruta) if ruta and os.path.exists(ruta) else None
+        ahora = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO sesiones VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (symbol, barra, fecha.isoformat(), filas, _iso(primer), _iso(ultimo),
+                 checksum, estado, ruta, ahora)
+            )
+            self._con.commit()
+        if estado != ESTADO_COMPLETA:
+            logger.info(f"    Manifiesto: {symbol} {barra} {fecha} -> {estado} ({filas} filas)")
+        return estado
+
+    def importar_directorio(self, symbol, barra, symbol_dir, cal=None):
+        """
+        Da de alta en el manifiesto los ficheros ya existentes en symbol_dir (una sola vez).
+        cal: calendario del activo (NYSE por defecto) para calcular las filas esperadas.
+        """
+        cal = cal or calendario()
+        n = 0
+        for fecha in sorted(list_downloaded_dates(symbol_dir)):
+            ruta = find_session_file(symbol_dir, fecha)
+            try:
+                df = read_session_file(ruta, columns=["time"])
+            except Exception as e:
+                logger.warning(f"    ⚠️ No se pudo leer {ruta} al importar: {e}")
+                continue
+            # mismas reglas que una sesión recién descargada: truncada -> parcial
+            sesion = cal.sesion(fecha)
+            esperadas = filas_esperadas(barra, *(s.astimezone(timezone.utc) for s in sesion)) if sesion else None
+            self.registrar(symbol, barra, fecha, df, ruta=ruta, esperadas=esperadas,
+                           con_sesion=sesion is not None)
+            n += 1
+        if n:
+            logger.info(f"Manifiesto: importadas {n} sesiones existentes de {symbol} {barra}")
+        return n
+
+    def fijar_frontera(self, symbol, barra, fecha):
+        """Última sesión hasta la que el historial de (symbol, barra) no tiene huecos."""
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO fronteras VALUES (?, ?, ?)", (symbol, barra, fecha.isoformat())
+            )
+            self._con.commit()
+
+    def actualizar_ruta(self, symbol, barra, fecha, ruta):
+        """Apunta la sesión a otro fichero con los mismos datos (migración de formato)."""
+        checksum = checksum_fichero(ruta)
+        with self._lock:
+            self._con.execute(
+                "UPDATE sesiones SET ruta=?, checksum=?, actualizado=? WHERE symbol=? AND barra=? AND fecha=?",
+                (ruta, checksum, datetime.now(timezone.utc).isoformat(), symbol, barra, fecha.isoformat())
+            )
+            self._con.commit()
+
+    # ----------------------------
+    # Consultas
+    # ----------------------------
+    def _fechas(self, symbol, barra, estados, desde=None):
+        marcas = ",".join("?" * len(estados))
+        with self._lock:
+            cur = self._con.execute(
+                f"SELECT fecha FROM sesiones WHERE symbol=? AND barra=? AND estado IN ({marcas}) AND fecha >= ?",
+                (symbol, barra, *estados, desde.isoformat() if desde else "")
+            )
+            return {datetime.strptime(r[0], "%Y-%m-%d").date() for r in cur.fetchall()}
+
+    def tiene_entradas(self, symbol, barra):
+        with self._lock:
+            cur = self._con.execute(
+                "SELECT 1 FROM sesiones WHERE symbol=? AND barra=? LIMIT 1", (symbol, barra)
+            )
+            return cur.fetchone() is not None
+
+    def fechas_descargadas(self, symbol, barra, symbol_dir=None, desde=None):
+        """
+        Fechas que no hay que volver a pedir (completas o vacías), desde la fecha indicada.
+        Si se pasa symbol_dir y el manifiesto aún no conoce el activo, importa el directorio.
+        """
+        if symbol_dir is not None and not self.tiene_entradas(symbol, barra):
+            self.importar_directorio(symbol, barra, symbol_dir)
+        return self._fechas(symbol, barra, (ESTADO_COMPLETA, ESTADO_VACIA), desde)
+
+    def ultima_descargada(self, symbol, barra):
+        """Última fecha completa o vacía (None si no hay ninguna), sin cargar todo el historial."""
+        with self._lock:
+            cur = self._con.execute(
+                "SELECT MAX(fecha) FROM sesiones WHERE symbol=? AND barra=? AND estado IN (?, ?)",
+                (symbol, barra, ESTADO_COMPLETA, ESTADO_VACIA)
+            )
+            fecha = cur.fetchone()[0]
+        return datetime.strptime(fecha, "%Y-%m-%d").date() if fecha else None
+
+    def frontera(self, symbol, barra):
+        """Frontera de backfill guardada con fijar_frontera (None si aún no hay)."""
+        with self._lock:
+            cur = self._con.execute(
+                "SELECT fecha FROM fronteras WHERE symbol=? AND barra=?", (symbol, barra)
+            )
+            fila = cur.fetchone()
+        return datetime.strptime(fila[0], "%Y-%m-%d").date() if fila else None
+
+    def fechas_incompletas(self, symbol, barra, limite=None):
+        """Sesiones parciales: hay que volver a pedirlas. Con limite, sólo las más recientes."""
+        with self._lock:
+            cur = self._con.execute(
+                "SELECT fecha FROM sesiones WHERE symbol=? AND barra=? AND estado=? ORDER BY fecha DESC LIMIT ?",
+                (symbol, barra, ESTADO_PARCIAL, -1 if limite is None else limite)
+            )
+            return {datetime.strptime(r[0], "%Y-%m-%d").date() for r in cur.fetchall()}
+
+    def filas_medias(self, symbol, barra, ultimas=20):
+        """Filas medias de las últimas sesiones con datos (None si no hay ninguna)."""
+        with self._lock:
+            cur = self._con.execute(
+                "SELECT AVG(filas) FROM (SELECT filas FROM sesiones WHERE symbol=? AND barra=? AND filas > 0 "
+                "ORDER BY fecha DESC LIMIT ?)", (symbol, barra, ultimas)
+            )
+            return cur.fetchone()[0]
+
+    def sesion(self, symbol, barra, fecha):
+        """Fila del manifiesto como dict, o None."""
+        with self._lock:
+            cur = self._con.execute(
+                "SELECT * FROM sesiones WHERE symbol=? AND barra=? AND fecha=?",
+                (symbol, barra, fecha.isoformat())
+            )
+            fila = cur.fetchone()
+            if fila is None:
+                return None
+            return dict(zip([c[0] for c in cur.description], fila))
@@ -0,0 +1,205 @@
+'''
+Variables de microestructura a partir de las sesiones Bid_Ask (time, bid, bid_size, ask,
+ask_size, midpoint), materializadas por símbolo y día.
+
+Por cada intervalo de RESOLUCION (1 sg por defecto) de la sesión:
+
+    ofi             order-flow imbalance (Cont, Kukanov y Stoikov): suma de los cambios de
+                    profundidad en el mejor bid menos los del mejor ask
+    spread          spread cotizado (ask - bid) al final del intervalo; spread_rel = spread / mid
+    spread_efectivo 2 * |precio - mid| medio de los trades del intervalo (sólo si se pasa la
+                    sesión Trades del mismo día; si no, NaN)
+    mid, ret_mid    mid al final del intervalo y su rendimiento logarítmico
+    microprice      (bid * ask_size + ask * bid_size) / (bid_size + ask_size)
+    cotizaciones    nº de cambios de cotización (tasa de llegada por intervalo)
+    vol_realizada   sqrt(suma de ret_mid^2) en una ventana móvil de VENTANA_VOL intervalos
+
+Cada día es independiente (las ventanas no cruzan sesiones), así que es incremental: en
+<destino>/<SYMBOL>/cache.json se guarda, por día, el checksum del fichero de origen y la
+VERSION_FEATURES con que se calculó. Sólo se recalculan los días nuevos, los que cambiaron
+en origen y todos si cambia la versión.
+
+Uso:
+    python microestructura.py E:/DATOSBOLSA/datatick/AAPL
+    python microestructura.py E:/DATOSBOLSA/datatick/AAPL --trades E:/DATOSBOLSA/Tick2Tick/AAPL
+'''
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import logging
+
+from almacen import BASE_DIR, find_session_file, list_downloaded_dates, read_session_file, save_session_df
+from manifiesto import checksum_fichero
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+RESOLUCION = "1s"                   # rejilla temporal de las variables
+VENTANA_VOL = 300                   # intervalos de la ventana de volatilidad realizada
+VERSION_FEATURES = 1                # subir al cambiar el cálculo: invalida la caché
+DIR_FEATURES = "Microestructura"    # BASE_DIR/<DIR_FEATURES>/<SYMBOL>
+FICHERO_CACHE = "cache.json"
+
+COLUMNAS_FEATURES = [
+    "time", "ofi", "spread", "spread_rel", "spread_efectivo", "mid", "ret_mid",
+    "microprice", "cotizaciones", "vol_realizada",
+]
+
+
+def _cotizaciones(df):
+    """Arrays ordenados de la sesión Bid_Ask, sin filas sin bid/ask válidos."""
+    df = df.sort_values("time", kind="stable")
+    bid = df["bid"].to_numpy(np.float64)
+    ask = df["ask"].to_numpy(np.float64)
+    ok = (bid > 0) & (ask > 0) & ~np.isnan(bid) & ~np.isnan(ask)
+    ns = pd.to_datetime(df["time"], utc=True).astype("datetime64[ns, UTC]").array.asi8[ok]
+    qb = np.nan_to_num(df["bid_size"].to_numpy(np.float64)[ok])
+    qa = np.nan_to_num(df["ask_size"].to_numpy(np.float64)[ok])
+    return ns, bid[ok], ask[ok], qb, qa
+
+
+def ofi_ticks(bid, ask, qb, qa):
+    """OFI de cada cotización respecto a la anterior (la primera aporta 0)."""
+    e = np.zeros(len(bid))
+    if len(bid) < 2:
+        return e
+    b0, b1, a0, a1 = bid[:-1], bid[1:], ask[:-1], ask[1:]
+    e[1:] = ((b1 >= b0) * qb[1:] - (b1 <= b0) * qb[:-1]
+             - (a1 <= a0) * qa[1:] + (a1 >= a0) * qa[:-1])
+    return e
+
+
+def calcular_features(df_bid_ask, df_trades=None, resolucion=RESOLUCION, ventana=VENTANA_VOL):
+    """Sesión Bid_Ask (y opcionalmente Trades) -> DataFrame COLUMNAS_FEATURES en la rejilla."""
+    ns, bid, ask, qb, qa = _cotizaciones(df_bid_ask)
+    if len(ns) == 0:
+        return pd.DataFrame(columns=COLUMNAS_FEATURES)
+
+    paso = pd.Timedelta(resolucion).value
+    celda = ns // paso
+    inicios = np.flatnonzero(np.r_[True, celda[1:] != celda[:-1]])
+    finales = np.r_[inicios[1:], len(ns)] - 1
+
+    mid = (bid + ask) / 2.0
+    profundidad = qb + qa
+    with np.errstate(invalid="ignore", divide="ignore"):
+        micro = np.where(profundidad > 0, (bid * qa + ask * qb) / profundidad, mid)
+    # se cuenta como cotización nueva sólo si cambia algo del mejor nivel
+    cambio = np.r_[True, (np.diff(bid) != 0) | (np.diff(ask) != 0) | (np.diff(qb) != 0) | (np.diff(qa) != 0)]
+
+    out = pd.DataFrame({
+        "time": pd.to_datetime(celda[inicios] * paso, utc=True),
+        "ofi": np.add.reduceat(ofi_ticks(bid, ask, qb, qa), inicios),
+        "spread": ask[finales] - bid[finales],
+        "mid": mid[finales],
+        "microprice": micro[finales],
+        "cotizaciones": np.add.reduceat(cambio.astype(np.int64), inicios),
+    })
+    out["spread_rel"] = out["spread"] / out["mid"]
+    out["ret_mid"] = np.log(out["mid"]).diff()
+    # ventana en intervalos de la rejilla (los intervalos sin cotizaciones no cuentan)
+    out["vol_realizada"] = np.sqrt((out["ret_mid"] ** 2).rolling(ventana, min_periods=2).sum())
+    out["spread_efectivo"] = _spread_efectivo(df_trades, ns, mid, paso, out["time"])
+    return out[COLUMNAS_FEATURES]
+
+
+def _spread_efectivo(df_trades, ns, mid, paso, tiempos):
+    """2 * |price - mid vigente| medio por intervalo (as-of hacia atrás sobre las cotizaciones)."""
+    if df_trades is None or df_trades.empty or "price" not in df_trades.columns:
+        return np.full(len(tiempos), np.nan)
+    t_ns = pd.to_datetime(df_trades["time"], utc=True).astype("datetime64[ns, UTC]").array.asi8
+    precio = df_trades["price"].to_numpy(np.float64)
+    j = np.searchsorted(ns, t_ns, side="right") - 1
+    ok = (j >= 0) & ~np.isnan(precio)
+    efectivo = pd.Series(2.0 * np.abs(precio[ok] - mid[j[ok]])).groupby(t_ns[ok] // paso).mean()
+    rejilla = tiempos.astype("datetime64[ns, UTC]").array.asi8 // paso
+    return efectivo.reindex(rejilla).to_numpy(np.float64)
+
+
+# ----------------------------
+# CACHÉ INCREMENTAL POR DÍA
+# ----------------------------
+class CacheFeatures:
+    """cache.json del directorio de salida: fecha -> {checksum, version, filas}."""
+
+    def __init__(self, directorio):
+        self.dir = directorio
+        self._path = os.path.join(directorio, FICHERO_CACHE)
+        self._datos = {}
+        if os.path.exists(self._path):
+            with open(self._path, encoding="utf-8") as f:
+                self._datos = json.load(f)
+
+    def vigente(self, d, checksum):
+        e = self._datos.get(d.isoformat())
+        return (e is not None and e["checksum"] == checksum and e["version"] == VERSION_FEATURES
+                and find_session_file(self.dir, d) is not None)
+
+    def apuntar(self, d, checksum, filas):
+        self._datos[d.isoformat()] = {"checksum": checksum, "version": VERSION_FEATURES, "filas": filas}
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = self._path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._datos, f, indent=1)
+        os.replace(tmp, self._path)
+
+
+def _checksum_origen(fichero_ba, fichero_tr):
+    partes = [checksum_fichero(fichero_ba)]
+    if fichero_tr:
+        partes.append(checksum_fichero(fichero_tr))
+    return "+".join(partes)
+
+
+def actualizar_symbol(dir_bid_ask, destino=None, dir_trades=None):
+    """
+    Calcula las variables de los días de dir_bid_ask que no están en caché o cambiaron.
+    Devuelve (días calculados, días en caché).
+    """
+    symbol = os.path.basename(os.path.normpath(dir_bid_ask))
+    salida = os.path.join(destino or os.path.join(BASE_DIR, DIR_FEATURES), symbol)
+    cache = CacheFeatures(salida)
+    calculados = en_cache = 0
+    for d in sorted(list_downloaded_dates(dir_bid_ask)):
+        fichero_ba = find_session_file(dir_bid_ask, d)
+        fichero_tr = find_session_file(dir_trades, d) if dir_trades else None
+        checksum = _checksum_origen(fichero_ba, fichero_tr)
+        if cache.vigente(d, checksum):
+            en_cache += 1
+            continue
+        df_ba = read_session_file(fichero_ba)
+        if "bid" not in df_ba.columns:
+            logger.warning(f"    {fichero_ba} no es una sesión Bid_Ask: se salta")
+            continue
+        df_tr = read_session_file(fichero_tr) if fichero_tr else None
+        features = calcular_features(df_ba, df_tr)
+        os.makedirs(salida, exist_ok=True)
+        save_session_df(salida, d, features)
+        cache.apuntar(d, checksum, len(features))
+        calculados += 1
+    logger.info(f"Microestructura {symbol}: {calculados} días calculados, {en_cache} en caché")
+    return calculados, en_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Variables de microestructura desde sesiones Bid_Ask")
+    parser.add_argument("directorio", help="sesiones Bid_Ask de un símbolo")
+    parser.add_argument("--trades", help="sesiones Trades del mismo símbolo (spread efectivo)")
+    parser.add_argument("--destino", default=os.path.join(BASE_DIR, DIR_FEATURES))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    calculados, en_cache = actualizar_symbol(args.directorio, args.destino, args.trades)
+    print(f"{calculados} días calculados, {en_cache} en caché")
+
+
+if __name__ == "__main__":
+    main()
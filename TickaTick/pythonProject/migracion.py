@@ -0,0 +1,261 @@
+'''
+Migración del histórico en XLSX (<BASE_DIR>/<barra>/<SYMBOL>/YYYY-MM-DD.xlsx) al almacén parquet.
+
+Leer XLSX con openpyxl es lento y va a un solo núcleo, así que cada fichero se convierte en
+un proceso aparte (ProcessPoolExecutor). Por fichero:
+
+1.- Se lee con BackendXlsx (el formato que escribía save_session_df) y se guarda con
+    BackendParquet junto al original (escritura atómica: nunca queda un parquet a medias).
+2.- Se relee el parquet y se comparan filas y primer/último timestamp con el origen.
+    Si no cuadran se borra el parquet y se marca como discrepancia.
+3.- El resultado se apunta en migracion.sqlite (en la raíz). Al relanzar se saltan los
+    ficheros ya migrados cuyo origen no ha cambiado (tamaño y fecha de modificación),
+    así que se puede parar con Ctrl+C y seguir más tarde.
+
+El XLSX original no se toca: find_session_file ya prefiere el parquet. Si ya hay un parquet
+de ese día que no viene de la migración (descargado después), se deja y no se convierte. Si existe el manifiesto
+de sesiones (manifiesto.sqlite) se actualiza la ruta y el checksum de las sesiones migradas.
+
+Uso:
+    python migracion.py E:/DATOSBOLSA
+    python migracion.py E:/DATOSBOLSA --barras Bars1s --procesos 6
+    python migracion.py E:/DATOSBOLSA --reintentar      # vuelve a probar los que fallaron
+'''
+
+import argparse
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import pandas as pd
+
+import logging
+
+from almacen import BackendParquet, BackendXlsx
+from manifiesto import Manifiesto
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+RAIZ_POR_DEFECTO = os.environ.get("DATOSBOLSA_DIR", "E:/DATOSBOLSA")
+MIGRACION_DB = "migracion.sqlite"               # en la raíz migrada
+MANIFIESTO_SESIONES = "manifiesto.sqlite"       # el de ib_downloader, si existe
+BARRAS_MIGRABLES = ["Bars1s", "Bars15m", "Bars1h", "BarsD", "Tick2Tick"]
+PROCESOS = max(1, (os.cpu_count() or 2) - 1)
+INFORME_CADA = 50                               # ficheros entre líneas de progreso
+
+ESTADO_OK = "ok"
+ESTADO_DISCREPANCIA = "discrepancia"
+ESTADO_ERROR = "error"
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS migraciones (
+    origen      TEXT PRIMARY KEY,
+    destino     TEXT,
+    barra       TEXT NOT NULL,
+    symbol      TEXT NOT NULL,
+    fecha       TEXT NOT NULL,
+    bytes       INTEGER NOT NULL,
+    mtime       REAL NOT NULL,
+    filas       INTEGER,
+    primer_ts   TEXT,
+    ultimo_ts   TEXT,
+    estado      TEXT NOT NULL,
+    error       TEXT,
+    segundos    REAL,
+    actualizado TEXT NOT NULL
+);
+"""
+
+Tarea = namedtuple("Tarea", ["origen", "destino", "barra", "symbol", "fecha", "bytes", "mtime"])
+Resultado = namedtuple("Resultado", ["tarea", "filas", "primer_ts", "ultimo_ts", "estado", "error", "segundos"])
+
+
+# ----------------------------
+# CONVERSIÓN (se ejecuta en los procesos del pool)
+# ----------------------------
+def _extremos(df):
+    """(filas, primer, último) de la columna time, en ns para comparar sin redondeos."""
+    if df.empty or "time" not in df.columns:
+        return len(df), None, None
+    ns = pd.to_datetime(df["time"], utc=True).astype("datetime64[ns, UTC]").array.asi8
+    return len(df), int(ns.min()), int(ns.max())
+
+
+def _iso_ns(ns):
+    return None if ns is None else pd.Timestamp(ns, tz="UTC").isoformat()
+
+
+def convertir(tarea):
+    """XLSX -> parquet verificado. Devuelve Resultado (nunca lanza: el error va en el resultado)."""
+    t0 = time.perf_counter()
+    try:
+        df = BackendXlsx().leer(tarea.origen)
+        origen = _extremos(df)
+        BackendParquet().guardar(tarea.destino, df)
+        destino = _extremos(BackendParquet().leer(tarea.destino, columns=["time"] if "time" in df.columns else None))
+        if destino != origen:
+            os.remove(tarea.destino)
+            error = f"origen {origen[0]} filas [{_iso_ns(origen[1])}, {_iso_ns(origen[2])}] != " \
+                    f"parquet {destino[0]} filas [{_iso_ns(destino[1])}, {_iso_ns(destino[2])}]"
+            return Resultado(tarea, origen[0], _iso_ns(origen[1]), _iso_ns(origen[2]),
+                             ESTADO_DISCREPANCIA, error, time.perf_counter() - t0)
+        return Resultado(tarea, origen[0], _iso_ns(origen[1]), _iso_ns(origen[2]),
+                         ESTADO_OK, None, time.perf_counter() - t0)
+    except Exception as e:
+        return Resultado(tarea, None, None, None, ESTADO_ERROR, f"{type(e).__name__}: {e}",
+                         time.perf_counter() - t0)
+
+
+# ----------------------------
+# MANIFIESTO DE LA MIGRACIÓN
+# ----------------------------
+class RegistroMigracion:
+    """migracion.sqlite: una fila por XLSX de origen. Sólo escribe el proceso principal."""
+
+    def __init__(self, path):
+        self._con = sqlite3.connect(path)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.executescript(_ESQUEMA)
+        self._con.commit()
+
+    def close(self):
+        self._con.close()
+
+    def hechos(self, reintentar=False):
+        """origen -> (bytes, mtime) de lo que no hay que volver a convertir."""
+        estados = (ESTADO_OK,) if reintentar else (ESTADO_OK, ESTADO_DISCREPANCIA, ESTADO_ERROR)
+        marcas = ",".join("?" * len(estados))
+        cur = self._con.execute(f"SELECT origen, bytes, mtime FROM migraciones WHERE estado IN ({marcas})",
+                                estados)
+        return {o: (b, m) for o, b, m in cur.fetchall()}
+
+    def registrar(self, r):
+        t = r.tarea
+        self._con.execute(
+            "INSERT OR REPLACE INTO migraciones VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (t.origen, t.destino if r.estado == ESTADO_OK else None, t.barra, t.symbol, t.fecha,
+             t.bytes, t.mtime, r.filas, r.primer_ts, r.ultimo_ts, r.estado, r.error,
+             round(r.segundos, 3), datetime.now(timezone.utc).isoformat())
+        )
+        self._con.commit()
+
+    def resumen(self):
+        cur = self._con.execute("SELECT estado, COUNT(*), COALESCE(SUM(filas), 0) FROM migraciones GROUP BY estado")
+        return {e: (n, filas) for e, n, filas in cur.fetchall()}
+
+
+# ----------------------------
+# RECORRIDO
+# ----------------------------
+def buscar_tareas(raiz, barras, hechos):
+    """XLSX de raiz/<barra>/<SYMBOL>/ pendientes de migrar (no entra en _staging)."""
+    tareas = []
+    for barra in barras:
+        dir_barra = os.path.join(raiz, barra)
+        if not os.path.isdir(dir_barra):
+            continue
+        for symbol in sorted(os.listdir(dir_barra)):
+            symbol_dir = os.path.join(dir_barra, symbol)
+            if not os.path.isdir(symbol_dir):
+                continue
+            for nombre in sorted(os.listdir(symbol_dir)):
+                base, ext = os.path.splitext(nombre)
+                if ext.lower() != ".xlsx":
+                    continue
+                try:
+                    fecha = datetime.strptime(base, "%Y-%m-%d").date()
+                except ValueError:
+                    continue
+                origen = os.path.join(symbol_dir, nombre)
+                st = os.stat(origen)
+                if hechos.get(origen) == (st.st_size, st.st_mtime):
+                    continue
+                destino = os.path.join(symbol_dir, base + BackendParquet.extension)
+                if origen not in hechos and os.path.exists(destino):
+                    # parquet escrito por el descargador (EXPORTAR_XLSX): ése manda
+                    continue
+                tareas.append(Tarea(origen, destino,
+                                    barra, symbol, fecha.isoformat(), st.st_size, st.st_mtime))
+    return tareas
+
+
+def _limpiar_temporales(tareas):
+    """Parquets .tmp que quedaron de una ejecución interrumpida."""
+    for t in tareas:
+        tmp = t.destino + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def migrar(raiz, barras=None, procesos=PROCESOS, reintentar=False):
+    """Convierte todo el árbol. Devuelve el resumen por estado {estado: (ficheros, filas)}."""
+    registro = RegistroMigracion(os.path.join(raiz, MIGRACION_DB))
+    ruta_manifiesto = os.path.join(raiz, MANIFIESTO_SESIONES)
+    manifiesto = Manifiesto(ruta_manifiesto) if os.path.exists(ruta_manifiesto) else None
+    try:
+        tareas = buscar_tareas(raiz, barras or BARRAS_MIGRABLES, registro.hechos(reintentar))
+        # primero los ficheros grandes: el pool no se queda esperando a uno lento al final
+        tareas.sort(key=lambda t: t.bytes, reverse=True)
+        _limpiar_temporales(tareas)
+        logger.info(f"Migración: {len(tareas)} ficheros XLSX pendientes con {procesos} procesos")
+
+        t0 = time.perf_counter()
+        hechos = filas = 0
+        with ProcessPoolExecutor(max_workers=procesos) as pool:
+            futuros = [pool.submit(convertir, t) for t in tareas]
+            try:
+                for fut in as_completed(futuros):
+                    r = fut.result()
+                    registro.registrar(r)
+                    hechos += 1
+                    if r.estado == ESTADO_OK:
+                        filas += r.filas
+                        if manifiesto is not None:
+                            manifiesto.actualizar_ruta(r.tarea.symbol, r.tarea.barra,
+                                                       datetime.strptime(r.tarea.fecha, "%Y-%m-%d").date(),
+                                                       r.tarea.destino)
+                    else:
+                        logger.warning(f"  ⚠️ {r.tarea.origen}: {r.estado} ({r.error})")
+                    if hechos % INFORME_CADA == 0 or hechos == len(tareas):
+                        transcurrido = time.perf_counter() - t0
+                        logger.info(f"  {hechos}/{len(tareas)} ficheros, {filas} filas, "
+                                    f"{hechos / transcurrido:.1f} ficheros/s")
+            except KeyboardInterrupt:
+                # lo ya registrado queda hecho; lo pendiente se retoma al relanzar
+                for fut in futuros:
+                    fut.cancel()
+                logger.warning(f"Migración interrumpida tras {hechos} ficheros: relanzar para continuar")
+                raise
+        return registro.resumen()
+    finally:
+        registro.close()
+        if manifiesto is not None:
+            manifiesto.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migra el histórico XLSX al almacén parquet")
+    parser.add_argument("raiz", nargs="?", default=RAIZ_POR_DEFECTO, help="BASE_DIR del almacén")
+    parser.add_argument("--barras", nargs="+", choices=BARRAS_MIGRABLES, default=BARRAS_MIGRABLES)
+    parser.add_argument("--procesos", type=int, default=PROCESOS)
+    parser.add_argument("--reintentar", action="store_true", help="volver a convertir los que fallaron")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    try:
+        resumen = migrar(args.raiz, args.barras, args.procesos, args.reintentar)
+    except KeyboardInterrupt:
+        return
+    for estado, (n, filas) in sorted(resumen.items()):
+        print(f"{estado:<13} {n:>8} ficheros {filas:>14} filas")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,459 @@
+'''
+Motor de descarga asíncrono para IB.
+
+ib_downloader.main recorre activos.xlsx fila a fila y baja cada símbolo/día en serie con la
+API bloqueante. Este motor usa reqHistoricalDataAsync / reqHistoricalTicksAsync y planifica
+trabajos (símbolo, tipo de barra, día, bloque) en paralelo:
+
+1.- CONCURRENCIA limita cuántas peticiones están en vuelo a la vez (semáforo).
+2.- Cada petición pasa antes por el gobernador de pacing (pacing.py).
+3.- En cuanto llegan todos los bloques de una sesión se guarda (en un hilo, sin frenar el loop).
+4.- Todas las barras marcadas en el Excel (Bars1s, Bars15m, ...) se procesan, no sólo la última.
+5.- Las barras de 15m / 1h / diarias se derivan de la sesión de 1 sg cuando está marcada:
+    esperan a que termine la descarga de 1 sg del mismo día en vez de pedir a IB.
+6.- Las sesiones siguen el programa (programador.py): la puesta al día va toda a la vez y el
+    backfill después, de CONCURRENCIA en CONCURRENCIA sesiones y hasta PRESUPUESTO_BACKFILL_SG.
+7.- Las peticiones se reparten entre las conexiones históricas del pool (CLIENTES), con
+    ping periódico y reconexión de las que se caen.
+8.- Como en ib_downloader: staging por bloque / página (una sesión interrumpida se reanuda),
+    los bloques que agotan los REINTENTOS quedan como hueco, cada sesión se valida y se piden
+    sólo sus huecos (huecos_sesion / juntar_relleno), y una sesión parcial ya guardada sólo
+    pide lo que le falta.
+
+Uso:
+    python motor_async.py
+'''
+
+import asyncio
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+import pandas as pd
+import pytz
+from ib_downloader import (
+    logger, BASE_DIR, EXCEL_CONFIG, MANIFIESTO_DB, PLAN_BLOQUES_JSON, BARRAS, INIT_DAYS_BACK, WHAT_TO_SHOW,
+    NY_TZ, IB_HOST, IB_PORT, IB_CLIENTID, CACHE_RESPUESTAS_DIR, CONTRATOS_DB, PRESUPUESTO_BACKFILL_SG, nuevo_ib,
+    build_contract, ensure_symbol_dir, sesion_ny, guardar_sesion, huecos_sesion, juntar_relleno,
+)
+from planificador import cargar_config, planificar as planificar_tareas
+from programador import Programa, COLA_RECIENTE
+from conexiones import PoolConexiones, TIPO_HISTORICO
+from bloques import plan_bloques
+from calendario import calendario_contrato
+from ingesta import (bars_to_frame, ticks_to_frame, concat_frames, columnas_ticks, diaria_a_sesion,
+                     COLUMNAS_BARRAS, DedupeFrontera)
+from manifiesto import Manifiesto, ESTADO_COMPLETA, ESTADO_PARCIAL
+from almacen import StagingSesion, read_session_df
+from validacion import VENTANA_MAX_SG
+from remuestreo import es_derivable, derivar_sesion, BARRA_ORIGEN
+from pacing import gobernador, clave_contrato
+from cache_respuestas import cache_respuestas, firma_barras, firma_ticks
+from contratos import cache_contratos
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+CONCURRENCIA = 8                    # peticiones simultáneas contra IB
+TICKS_POR_PAGINA = 1000             # máximo de reqHistoricalTicks
+TIMEOUT_PETICION = 120              # segundos antes de dar por perdida una petición
+REINTENTOS = 3
+# clientIds del pool (conexiones.py): varias conexiones históricas para repartir las peticiones
+CLIENTES = {TIPO_HISTORICO: [IB_CLIENTID, IB_CLIENTID + 1, IB_CLIENTID + 2]}
+
+# Un trabajo = una sesión de un símbolo para un tipo de barra (cola: ver programador.py)
+Trabajo = namedtuple("Trabajo", ["ticker", "contract", "barra", "ruta", "dia", "cola"])
+
+
+class MotorDescarga:
+
+    def __init__(self, pool, manifiesto, concurrencia=CONCURRENCIA, gobernador=gobernador):
+        self.pool = pool                # PoolConexiones: cada petición va por la conexión histórica menos cargada
+        self.manifiesto = manifiesto
+        self.gobernador = gobernador
+        self._sem = asyncio.Semaphore(concurrencia)
+        self._concurrencia = concurrencia
+        self.guardadas = 0
+        self.fallidas = 0
+        self.derivadas = 0
+        self._origen_listo = {}         # (ticker, dia) -> Event de la sesión de 1 sg
+
+    # ----------------------------
+    # Peticiones individuales
+    # ----------------------------
+    async def _pedir_bloque(self, contract, barra, block_start, block_end, duracion, tamaño):
+        """
+        Una petición reqHistoricalDataAsync con pacing, concurrencia y reintentos.
+        Devuelve (bars, latencia); latencia None si la respuesta sale de cache_respuestas.
+        Los fallos se anotan en el plan de bloques.
+        """
+        clave = clave_contrato(contract, WHAT_TO_SHOW)
+        firma = (contract.conId, WHAT_TO_SHOW, block_end, duracion, tamaño)
+        firma_cache = firma_barras(contract, WHAT_TO_SHOW, block_end, duracion, tamaño,
+                                   calendario_contrato(contract).rth)
+        bars = cache_respuestas.obtener(firma_cache)
+        if bars is not None:
+            return bars, None
+        segundos = (block_end - block_start).total_seconds()
+        for intento in range(1, REINTENTOS + 1):
+            await self.gobernador.adquirir_async(clave, firma)
+            async with self._sem:
+                t0 = time.monotonic()
+                marca = self.gobernador.marca()
+                try:
+                    with self.pool.usar(TIPO_HISTORICO) as ib:
+                        bars = await asyncio.wait_for(
+                            ib.reqHistoricalDataAsync(
+                                contract,
+                                endDateTime=block_end,
+                                durationStr=duracion,
+                                barSizeSetting=tamaño,
+                                whatToShow=WHAT_TO_SHOW,
+                                useRTH=calendario_contrato(contract).rth,
+                                formatDate=1,
+                                keepUpToDate=False
+                            ),
+                            timeout=TIMEOUT_PETICION
+                        )
+                    # [] tras un error de IB del mismo contrato: se reintenta, no es "sin datos"
+                    self.gobernador.verificar_respuesta(marca, contract, bars)
+                    self.gobernador.notificar_exito()
+                    cache_respuestas.guardar(firma_cache, bars)
+                    return bars or [], time.monotonic() - t0
+                except Exception as e:
+                    plan_bloques.observar(barra, segundos, None, time.monotonic() - t0, error=True)
+                    logger.error(f"⚠️ reqHistoricalDataAsync fallo {contract.symbol} {block_end} "
+                                 f"(intento {intento}/{REINTENTOS}): {e}")
+        raise RuntimeError(f"Bloque {block_end} de {contract.symbol} sin datos tras {REINTENTOS} intentos")
+
+    async def _pedir_pagina_ticks(self, contract, current_end):
+        clave = clave_contrato(contract, WHAT_TO_SHOW)
+        firma = (contract.conId, WHAT_TO_SHOW, current_end, TICKS_POR_PAGINA)
+        firma_cache = firma_ticks(contract, WHAT_TO_SHOW, current_end, TICKS_POR_PAGINA,
+                                  calendario_contrato(contract).rth)
+        ticks = cache_respuestas.obtener(firma_cache)
+        if ticks is not None:
+            return ticks
+        for intento in range(1, REINTENTOS + 1):
+            await self.gobernador.adquirir_async(clave, firma)
+            async with self._sem:
+                marca = self.gobernador.marca()
+                try:
+                    with self.pool.usar(TIPO_HISTORICO) as ib:
+                        ticks = await asyncio.wait_for(
+                            ib.reqHistoricalTicksAsync(
+                                contract,
+                                startDateTime="",
+                                endDateTime=current_end,
+                                numberOfTicks=TICKS_POR_PAGINA,
+                                whatToShow=WHAT_TO_SHOW,
+                                useRth=calendario_contrato(contract).rth,
+                                ignoreSize=False
+                            ),
+                            timeout=TIMEOUT_PETICION
+                        )
+                    self.gobernador.verificar_respuesta(marca, contract, ticks)
+                    self.gobernador.notificar_exito()
+                    cache_respuestas.guardar(firma_cache, ticks)
+                    return ticks or []
+                except Exception as e:
+                    logger.error(f"⚠️ reqHistoricalTicksAsync fallo {contract.symbol} {current_end} "
+                                 f"(intento {intento}/{REINTENTOS}): {e}")
+        raise RuntimeError(f"Página {current_end} de {contract.symbol} sin datos tras {REINTENTOS} intentos")
+
+    # ----------------------------
+    # Sesiones
+    # ----------------------------
+    async def _barras_sesion(self, contract, barra, start_utc, end_utc, staging):
+        """
+        Lanza todos los bloques de la sesión a la vez y junta el resultado.
+        Cada bloque se deja en staging al llegar; los ya hechos en una ejecución anterior se saltan.
+        El troceo se guarda en el staging al empezar: plan_bloques cambia entre ejecuciones y,
+        al reanudar, los bloques hechos tienen que ser los mismos que los del plan.
+        """
+        plan = staging.plan
+        if plan is None:
+            plan = [(e.isoformat(), d, t) for e, d, t in plan_bloques.bloques(barra, start_utc, end_utc)]
+            staging.guardar_plan(plan)
+        hechos = staging.bloques_completados()
+        pendientes = []
+        block_start = start_utc
+        for fin, duracion, tamaño in plan:
+            block_end = pd.Timestamp(fin).to_pydatetime()
+            if fin not in hechos:
+                pendientes.append((block_start, block_end, duracion, tamaño))
+            block_start = block_end
+
+        async def _bloque(block_start, block_end, duracion, tamaño):
+            try:
+                bars, latencia = await self._pedir_bloque(contract, barra, block_start, block_end, duracion, tamaño)
+            except RuntimeError as e:
+                # no se deja en staging: queda como hueco y lo rellena _completar
+                logger.error(f"⚠️ {e}: queda como hueco")
+                return None
+            if barra == "BarsD":
+                dia = end_utc.astimezone(NY_TZ).date()
+                block_df = diaria_a_sesion(bars_to_frame(bars), dia, start_utc)
+            else:
+                block_df = bars_to_frame(bars, start_utc, end_utc)
+            if latencia is not None:    # None: respuesta de la caché, no dice nada de IB
+                cubiertos = (block_end - block_df["time"].min()).total_seconds() if not block_df.empty else None
+                plan_bloques.observar(barra, (block_end - block_start).total_seconds(), cubiertos, latencia)
+            staging.guardar_bloque(block_end.isoformat(), block_df)
+            return block_df
+
+        frames = [f for f in await asyncio.gather(*(_bloque(*p) for p in pendientes)) if f is not None]
+        if hechos:
+            frames.append(staging.leer_bloques())
+        df = concat_frames(frames, ["time"] + COLUMNAS_BARRAS)
+        return df.drop_duplicates("time", keep="last").reset_index(drop=True)
+
+    async def _ticks_sesion(self, contract, start_utc, end_utc, staging=None):
+        """
+        Las páginas de ticks se encadenan hacia atrás (cada una depende de la anterior),
+        así que dentro de una sesión van en serie; el paralelismo está entre sesiones.
+        Con staging cada página se guarda al llegar y una sesión interrumpida sigue desde el cursor.
+        """
+        frames = []
+        dedupe = DedupeFrontera()
+        current_end = end_utc
+        if staging is not None and staging.reanudada:
+            previos = staging.leer_bloques()
+            frames.append(previos)
+            dedupe.cargar(previos)
+            current_end = pd.Timestamp(staging.cursor).to_pydatetime()
+            logger.info(f"Reanudando ticks desde {current_end} ({len(previos)} ticks en staging)")
+
+        while current_end >= start_utc:
+            try:
+                ticks = await self._pedir_pagina_ticks(contract, current_end)
+            except RuntimeError as e:
+                logger.error(f"⚠️ {e}: lo que falta queda como hueco")
+                break
+            page_ib = ticks_to_frame(ticks, WHAT_TO_SHOW, start_utc, end_utc)
+            page = dedupe.filtrar(page_ib)
+            if page.empty:
+                if page_ib.empty or len(ticks) < TICKS_POR_PAGINA:
+                    break
+                # página entera del segundo frontera ya visto: seguir desde el segundo anterior
+                current_end -= timedelta(seconds=1)
+                continue
+            frames.append(page)
+            clave = current_end.isoformat()
+            earliest = page["time"].min().to_pydatetime()
+            current_end = earliest if earliest < current_end else current_end - timedelta(seconds=1)
+            if staging is not None:
+                staging.guardar_bloque(clave, page, cursor=current_end.isoformat())
+
+        return concat_frames(frames, columnas_ticks(WHAT_TO_SHOW))
+
+    async def _completar(self, contract, barra, df_day, session_start, session_end):
+        """
+        ib_downloader.completar_sesion con las peticiones del motor: sólo se piden los huecos
+        (las de barras a la vez). Devuelve (sesión, revisada).
+        """
+        df_day, peticiones = huecos_sesion(df_day, barra, session_start, session_end)
+        if not peticiones:
+            return df_day, peticiones is not None
+
+        marca = self.gobernador.marca()
+        fallidas = 0
+
+        async def _tramo(p):
+            nonlocal fallidas
+            inicio, fin = p.inicio.to_pydatetime(), p.fin.to_pydatetime()
+            if barra not in VENTANA_MAX_SG:
+                # ticks: una cadena de páginas por hueco; los extremos son ticks que ya teníamos
+                tramo = await self._ticks_sesion(contract, inicio, fin)
+                return tramo[(tramo["time"] > p.inicio) & (tramo["time"] < p.fin)]
+            try:
+                bars, _ = await self._pedir_bloque(contract, barra, inicio, fin, p.duracion, p.tamaño)
+            except RuntimeError as e:
+                fallidas += 1
+                logger.error(f"⚠️ Relleno {p.inicio} → {p.fin} fallo: {e}")
+                return None
+            return bars_to_frame(bars, p.inicio, p.fin)
+
+        if barra in VENTANA_MAX_SG:
+            frames = await asyncio.gather(*(_tramo(p) for p in peticiones))
+        else:
+            frames = [await _tramo(p) for p in peticiones]
+        sin_fallos = not fallidas and self.gobernador.error_desde(marca, contract) is None
+        return juntar_relleno(df_day, [f for f in frames if f is not None], barra,
+                              session_start, session_end, sin_fallos)
+
+    async def _derivar(self, trabajo, session_start, session_end):
+        """
+        Intenta construir la sesión desde la de 1 sg. Si la descarga de 1 sg del mismo día
+        está planificada, espera a que termine. Devuelve True si se ha derivado.
+        """
+        evento = self._origen_listo.get((trabajo.ticker, trabajo.dia))
+        if evento is not None:
+            await evento.wait()
+        sesion_1s = self.manifiesto.sesion(trabajo.ticker, BARRA_ORIGEN, trabajo.dia)
+        if sesion_1s is None or sesion_1s["estado"] != ESTADO_COMPLETA:
+            return False
+        ruta_1s = ensure_symbol_dir(BASE_DIR, BARRA_ORIGEN, trabajo.ticker)
+        df_day = await asyncio.to_thread(derivar_sesion, ruta_1s, trabajo.barra, trabajo.dia,
+                                         session_start, session_end)
+        if df_day is None:
+            return False
+        await asyncio.to_thread(guardar_sesion, self.manifiesto, trabajo.ticker, trabajo.barra,
+                                trabajo.ruta, trabajo.dia, df_day, session_start, session_end, True)
+        self.guardadas += 1
+        self.derivadas += 1
+        return True
+
+    async def descargar_sesion(self, trabajo):
+        d = trabajo.dia
+        sesion = sesion_ny(d, trabajo.contract)
+        if sesion is None:
+            logger.info(f"    {d} sin sesión (festivo) para {trabajo.ticker}, no se pide")
+            self.manifiesto.registrar(trabajo.ticker, trabajo.barra, d, None, con_sesion=False)
+            evento = self._origen_listo.get((trabajo.ticker, d))
+            if trabajo.barra == BARRA_ORIGEN and evento is not None:
+                evento.set()
+            return
+        session_start, session_end = sesion
+        start_utc = session_start.astimezone(pytz.utc)
+        end_utc = session_end.astimezone(pytz.utc)
+
+        if es_derivable(trabajo.barra) and await self._derivar(trabajo, session_start, session_end):
+            return
+
+        try:
+            await self._descargar(trabajo, session_start, session_end, start_utc, end_utc)
+        finally:
+            evento = self._origen_listo.get((trabajo.ticker, d))
+            if trabajo.barra == BARRA_ORIGEN and evento is not None:
+                evento.set()
+
+    async def _descargar(self, trabajo, session_start, session_end, start_utc, end_utc):
+        d = trabajo.dia
+        staging = StagingSesion(trabajo.ruta, d)
+        try:
+            # sesión parcial ya guardada: pedir sólo sus huecos en vez de la sesión entera
+            previa = self.manifiesto.sesion(trabajo.ticker, trabajo.barra, d)
+            df_prev = None
+            if previa is not None and previa["estado"] == ESTADO_PARCIAL:
+                df_prev = await asyncio.to_thread(read_session_df, trabajo.ruta, d)
+            if df_prev is not None and not df_prev.empty:
+                df_day = df_prev
+            elif trabajo.barra == "Tick2Tick":
+                df_day = await self._ticks_sesion(trabajo.contract, start_utc, end_utc, staging)
+            else:
+                df_day = await self._barras_sesion(trabajo.contract, trabajo.barra, start_utc, end_utc, staging)
+            df_day, revisada = await self._completar(trabajo.contract, trabajo.barra, df_day,
+                                                     session_start, session_end)
+        except Exception as e:
+            self.fallidas += 1
+            logger.info(f"    ❌ Error Descargar {trabajo.ticker} {trabajo.barra} {d}: {e}")
+            return
+
+        if df_day.empty:
+            logger.info(f"    ⚠️ No hubo datos para {trabajo.ticker} {trabajo.barra} {d}")
+
+        # Guardar en un hilo: el resto de descargas sigue mientras se escribe a disco
+        await asyncio.to_thread(guardar_sesion, self.manifiesto, trabajo.ticker, trabajo.barra,
+                                trabajo.ruta, d, df_day, session_start, session_end, revisada)
+        staging.limpiar()
+        self.guardadas += 1
+
+    async def _backfill(self, trabajos, programa):
+        """
+        Sesiones de backfill en orden, como mucho concurrencia a la vez: en cuanto se agota el
+        presupuesto del programa no se empieza ninguna más.
+        """
+        pendientes = iter(trabajos)
+
+        async def trabajador():
+            for t in pendientes:
+                if programa.agotado():
+                    programa.aplazar(t)
+                    evento = self._origen_listo.get((t.ticker, t.dia))
+                    if t.barra == BARRA_ORIGEN and evento is not None:
+                        evento.set()    # sus derivadas no esperan: se piden o se aplazan también
+                    continue
+                await self.descargar_sesion(t)
+
+        await asyncio.gather(*(trabajador() for _ in range(self._concurrencia)))
+
+    async def ejecutar(self, trabajos, programa=None):
+        """Puesta al día toda a la vez; el backfill (si se pasa programa) con su presupuesto."""
+        for t in trabajos:
+            if t.barra == BARRA_ORIGEN:
+                self._origen_listo[(t.ticker, t.dia)] = asyncio.Event()
+        recientes = [t for t in trabajos if programa is None or t.cola == COLA_RECIENTE]
+        await asyncio.gather(*(self.descargar_sesion(t) for t in recientes))
+        if programa is not None:
+            await self._backfill([t for t in trabajos if t.cola != COLA_RECIENTE], programa)
+        logger.info(f"Motor: {self.guardadas} sesiones guardadas ({self.derivadas} derivadas de 1 sg), "
+                    f"{self.fallidas} fallidas. Pacing: {self.gobernador.resumen()}")
+
+
+# ----------------------------
+# PLANIFICACIÓN
+# ----------------------------
+async def planificar(ib, activos, manifiesto):
+    """
+    Convierte el plan de planificador.py en la lista de trabajos (una sesión por barra marcada),
+    en el orden del programa (puesta al día primero). Devuelve (trabajos, programa).
+    """
+    contratos = {a.ticker: build_contract(a.ticker, a.tipo) for a in activos}
+    # refresco diario de contratos en un solo lote (los de hoy salen de la caché)
+    try:
+        await cache_contratos.cualificar_async(ib, *contratos.values())
+    except Exception as e:
+        logger.info(f"  ⚠️ qualifyContracts del lote fallo: {e}")
+
+    plan = planificar_tareas(activos, manifiesto, init_days_back=INIT_DAYS_BACK)
+    logger.info(plan.resumen(CONCURRENCIA))
+    programa = Programa(plan, presupuesto_sg=PRESUPUESTO_BACKFILL_SG)
+    trabajos = []
+    for turno in programa.turnos:
+        ticker, tipo, barra, d = turno.sesion
+        contract = contratos[ticker]
+        if not getattr(contract, "conId", 0):
+            logger.info(f"  ⚠️ qualifyContracts fallo para {ticker}: se salta {barra} {d}")
+            continue
+        ruta = ensure_symbol_dir(BASE_DIR, barra, ticker)
+        trabajos.append(Trabajo(ticker, contract, barra, ruta, d, turno.cola))
+
+    logger.info(f"Planificados {len(trabajos)} trabajos de sesión")
+    return trabajos, programa
+
+
+async def main():
+    pool = PoolConexiones(CLIENTES, IB_HOST, IB_PORT, fabrica=nuevo_ib)
+    logger.info(f"Conectando a IB en {IB_HOST}:{IB_PORT} (clientIds={CLIENTES})...")
+    await pool.conectar_async()
+    pool.suscribir("errorEvent", gobernador.on_error)
+    vigilancia = asyncio.create_task(pool.vigilar_async())
+
+    manifiesto = Manifiesto(MANIFIESTO_DB)
+    plan_bloques.cargar(PLAN_BLOQUES_JSON)
+    cache_respuestas.abrir(CACHE_RESPUESTAS_DIR)
+    cache_contratos.abrir(CONTRATOS_DB)
+    activos = cargar_config(EXCEL_CONFIG, BARRAS)
+    trabajos, programa = await planificar(pool.ib(TIPO_HISTORICO), activos, manifiesto)
+
+    motor = MotorDescarga(pool, manifiesto)
+    await motor.ejecutar(trabajos, programa)
+    logger.info(f"Programa: {programa.resumen()}")
+
+    vigilancia.cancel()
+    logger.info(f"Bloques: {plan_bloques.resumen()}")
+    logger.info(f"Caché de respuestas: {cache_respuestas.resumen()}")
+    plan_bloques.guardar(PLAN_BLOQUES_JSON)
+    logger.info(f"Contratos: {cache_contratos.resumen()}")
+    logger.info(f"Conexiones: {pool.resumen()}")
+    cache_respuestas.close()
+    cache_contratos.close()
+    manifiesto.close()
+    pool.desconectar()
+    logger.info("Desconectado. Proceso finalizado.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
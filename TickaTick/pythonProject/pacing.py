@@ -0,0 +1,249 @@
+'''
+Gobernador de pacing para las peticiones históricas a IB.
+
+Sustituye a los time.sleep fijos de los descargadores (30 s por día guardado, 80 s en
+Descarga1sg, 0.2-0.5 s entre bloques). Modela los límites de IB para datos históricos:
+
+1.- Como máximo MAX_PETICIONES_VENTANA peticiones en VENTANA_SG (60 cada 10 minutos).
+2.- No repetir una petición idéntica antes de IDENTICA_SG (15 s).
+3.- No más de MAX_POR_CONTRATO peticiones para el mismo contrato/exchange/tick type en
+    VENTANA_CONTRATO_SG (IB penaliza seis o más en 2 s: se admiten 5).
+
+Los descargadores llaman a adquirir() (o adquirir_async()) antes de cada petición: sólo se
+espera lo imprescindible. Si IB devuelve un error de pacing se aplica un backoff exponencial.
+
+ib_insync no lanza excepción cuando una petición histórica falla: avisa por errorEvent y
+devuelve []. on_error anota esos errores (reqId, contrato, código) y verificar_respuesta
+convierte una respuesta vacía que llega tras un error del mismo contrato en ErrorPeticionIB,
+para que el descargador la reintente en vez de darla por "sin datos".
+Se acumula cuánto se ha esperado (total, máxima) para ver cuánto frena el pacing.
+'''
+
+import asyncio
+import threading
+import time
+from collections import deque
+
+import logging
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+MAX_PETICIONES_VENTANA = 60
+VENTANA_SG = 600.0
+IDENTICA_SG = 15.0
+MAX_POR_CONTRATO = 5
+VENTANA_CONTRATO_SG = 2.0
+
+# Margen para no ir justo al límite (IB cuenta en su reloj, no en el nuestro)
+MARGEN_SG = 0.25
+
+# Códigos de error de IB que indican violación de pacing
+#   162: "Historical Market Data Service error message: ... pacing violation"
+#   420: "Invalid real-time query: ... pacing violation"
+CODIGOS_PACING = {162, 420}
+BACKOFF_INICIAL_SG = 15.0
+BACKOFF_MAX_SG = 600.0
+
+# 162 también es la respuesta legítima de "no hay datos" para el tramo pedido
+MENSAJE_SIN_DATOS = "returned no data"
+# 2100-2199 son avisos (granjas de datos conectadas, zona horaria...), no fallos de una petición
+AVISOS_IB = range(2100, 2200)
+MAX_ERRORES_ANOTADOS = 1000
+
+
+class ErrorPeticionIB(RuntimeError):
+    """IB contestó con error (y una respuesta vacía) a una petición histórica."""
+
+    def __init__(self, codigo, mensaje):
+        super().__init__(f"error {codigo} de IB: {mensaje}")
+        self.codigo = codigo
+        self.mensaje = mensaje
+
+
+class GobernadorPacing:
+    """
+    Cubo de tokens con las tres reglas de IB. Seguro para hilos; la versión async no
+    bloquea el event loop.
+    """
+
+    def __init__(self, max_peticiones=MAX_PETICIONES_VENTANA, ventana=VENTANA_SG,
+                 identica=IDENTICA_SG, max_por_contrato=MAX_POR_CONTRATO,
+                 ventana_contrato=VENTANA_CONTRATO_SG, reloj=time.monotonic):
+        self.max_peticiones = max_peticiones
+        self.ventana = ventana
+        self.identica = identica
+        self.max_por_contrato = max_por_contrato
+        self.ventana_contrato = ventana_contrato
+        self.reloj = reloj
+
+        self._lock = threading.Lock()
+        self._global = deque()          # instantes de las últimas peticiones
+        self._por_contrato = {}         # clave -> deque de instantes
+        self._firmas = {}               # firma -> último instante
+        self._bloqueo_hasta = 0.0       # backoff tras error de pacing
+        self._backoff = BACKOFF_INICIAL_SG
+        self._errores = deque(maxlen=MAX_ERRORES_ANOTADOS)   # (nº, reqId, conId, código, mensaje)
+        self._n_errores = 0
+
+        # agregados de espera (sin guardar cada petición: el proceso puede durar días)
+        self.peticiones = 0
+        self.espera_total = 0.0
+        self.espera_max = 0.0
+
+    # ----------------------------
+    # Cálculo de espera
+    # ----------------------------
+    def _purgar(self, ahora):
+        while self._global and ahora - self._global[0] >= self.ventana:
+            self._global.popleft()
+        for clave in list(self._por_contrato):
+            cola = self._por_contrato[clave]
+            while cola and ahora - cola[0] >= self.ventana_contrato:
+                cola.popleft()
+            if not cola:
+                del self._por_contrato[clave]
+        for firma in [f for f, t in self._firmas.items() if ahora - t >= self.identica]:
+            del self._firmas[firma]
+
+    def _espera_necesaria(self, ahora, clave, firma):
+        espera = max(0.0, self._bloqueo_hasta - ahora)
+        if len(self._global) >= self.max_peticiones:
+            espera = max(espera, self._global[0] + self.ventana - ahora)
+        cola = self._por_contrato.get(clave)
+        if cola and len(cola) >= self.max_por_contrato:
+            espera = max(espera, cola[0] + self.ventana_contrato - ahora)
+        if firma is not None and firma in self._firmas:
+            espera = max(espera, self._firmas[firma] + self.identica - ahora)
+        return espera
+
+    def _intentar(self, clave, firma):
+        """Reserva el token si se puede; si no, devuelve los segundos a esperar."""
+        with self._lock:
+            ahora = self.reloj()
+            self._purgar(ahora)
+            espera = self._espera_necesaria(ahora, clave, firma)
+            if espera > 0:
+                return espera + MARGEN_SG
+            self._global.append(ahora)
+            self._por_contrato.setdefault(clave, deque()).append(ahora)
+            if firma is not None:
+                self._firmas[firma] = ahora
+            return 0.0
+
+    def _registrar(self, clave, firma, total):
+        with self._lock:
+            self.peticiones += 1
+            self.espera_total += total
+            self.espera_max = max(self.espera_max, total)
+        if total > 0:
+            logger.debug(f"Pacing: {clave} esperó {total:.2f} s")
+
+    # ----------------------------
+    # API
+    # ----------------------------
+    def adquirir(self, clave, firma=None):
+        """
+        Bloquea hasta poder lanzar una petición.
+        clave: identifica contrato/exchange/tick type (p.ej. (conId, "TRADES")).
+        firma: identifica la petición exacta (para la regla de 15 s). None si no aplica.
+        Devuelve los segundos esperados.
+        """
+        total = 0.0
+        while True:
+            espera = self._intentar(clave, firma)
+            if espera <= 0:
+                break
+            time.sleep(espera)
+            total += espera
+        self._registrar(clave, firma, total)
+        return total
+
+    async def adquirir_async(self, clave, firma=None):
+        total = 0.0
+        while True:
+            espera = self._intentar(clave, firma)
+            if espera <= 0:
+                break
+            await asyncio.sleep(espera)
+            total += espera
+        self._registrar(clave, firma, total)
+        return total
+
+    def notificar_error(self, codigo, mensaje=""):
+        """Aplica backoff exponencial si el error es de pacing. Devuelve True si lo era."""
+        es_pacing = codigo in CODIGOS_PACING and (codigo != 162 or "pacing" in str(mensaje).lower())
+        if not es_pacing:
+            return False
+        with self._lock:
+            self._bloqueo_hasta = max(self._bloqueo_hasta, self.reloj() + self._backoff)
+            logger.warning(f"Pacing violation ({codigo}): backoff {self._backoff:.0f} s")
+            self._backoff = min(self._backoff * 2, BACKOFF_MAX_SG)
+        return True
+
+    def notificar_exito(self):
+        """Una petición ha ido bien: se resetea el backoff."""
+        with self._lock:
+            self._backoff = BACKOFF_INICIAL_SG
+
+    def on_error(self, reqId, errorCode, errorString, contract=None):
+        """Handler para ib.errorEvent: backoff si es de pacing y anota los fallos de petición."""
+        self.notificar_error(errorCode, errorString)
+        if reqId is None or reqId < 0 or errorCode in AVISOS_IB:
+            return
+        if MENSAJE_SIN_DATOS in str(errorString).lower():
+            return
+        with self._lock:
+            self._n_errores += 1
+            self._errores.append((self._n_errores, reqId, getattr(contract, "conId", 0) or 0,
+                                  errorCode, errorString))
+
+    def marca(self):
+        """
+        Marca de errores anotados: se toma justo antes de lanzar la petición. El contador sólo
+        crece (un éxito no lo resetea), así que cualquier error posterior queda después de la marca.
+        """
+        with self._lock:
+            return self._n_errores
+
+    def error_desde(self, marca, contract=None):
+        """(código, mensaje) del primer error anotado después de marca (del contrato, si se indica)."""
+        con_id = getattr(contract, "conId", 0) or 0
+        with self._lock:
+            for n, _, c, codigo, mensaje in self._errores:
+                if n > marca and (not con_id or not c or c == con_id):
+                    return codigo, mensaje
+        return None
+
+    def verificar_respuesta(self, marca, contract, respuesta):
+        """
+        Devuelve la respuesta; si viene vacía y entre medias IB avisó de un error para el
+        contrato, lanza ErrorPeticionIB (la petición falló: no es un tramo sin datos).
+        """
+        if not respuesta:
+            error = self.error_desde(marca, contract)
+            if error is not None:
+                raise ErrorPeticionIB(*error)
+        return respuesta
+
+    def resumen(self):
+        """Estadísticas de espera: nº peticiones, total, media y máxima (segundos)."""
+        return {
+            "peticiones": self.peticiones,
+            "espera_total": self.espera_total,
+            "espera_media": self.espera_total / self.peticiones if self.peticiones else 0.0,
+            "espera_max": self.espera_max,
+        }
+
+
+def clave_contrato(contract, what_to_show):
+    """Clave para la regla por contrato/exchange/tick type."""
+    con_id = getattr(contract, "conId", 0) or getattr(contract, "symbol", "")
+    return (con_id, getattr(contract, "exchange", ""), str(what_to_show).upper())
+
+
+# Gobernador compartido por todos los descargadores del proceso
+gobernador = GobernadorPacing()
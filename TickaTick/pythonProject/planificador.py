@@ -0,0 +1,301 @@
+'''
+Planificador de descargas: compara activos.xlsx con el manifiesto y devuelve la lista
+explícita de tareas que faltan, antes de pedir nada a IB.
+
+ib_downloader.main y motor_async.planificar leían el Excel fila a fila y decidían sobre la
+marcha qué pedir (con el caso especial de INIT_DAYS_BACK para los activos sin historial).
+Aquí se hace una sola vez:
+
+1.- cargar_config lee y valida el Excel (columnas, tipos soportados, tickers repetidos,
+    marcas 0/1 de las barras). Las filas inválidas se avisan y se saltan.
+2.- planificar cruza cada (activo, barra) con el manifiesto y genera una tarea por sesión:
+        bloques    reqHistoricalData; peticiones = bloques que faltan (los de staging no cuentan)
+        ticks      una sesión Tick2Tick (nº de páginas estimado con la media de filas)
+        completar  una sesión parcial: sólo se piden sus huecos
+        derivar    15m / 1h / diarias desde la sesión de 1 sg (ya completa o planificada)
+        guardar    sesión con todos sus bloques ya en staging: sólo falta juntarla
+    El plan trabaja por sesión: el troceo en bloques lo decide el ejecutor (y lo guarda en
+    el staging), así que aquí sólo se cuentan las peticiones para la estimación.
+    El rango por activo cubre siempre las últimas INIT_DAYS_BACK sesiones y, si es anterior,
+    desde la sesión siguiente a la frontera de backfill del manifiesto (hasta ahí el historial
+    no tiene huecos): así un backfill aplazado (programador.py) o un hueco se vuelven a proponer
+    aunque ya se haya descargado una sesión más reciente. La frontera avanza al planificar.
+    Con el mercado abierto no entra el día en curso.
+    Sólo se consulta el manifiesto desde el inicio del rango, más las MAX_PARCIALES_POR_RUN
+    sesiones parciales más recientes: el coste no crece con el historial.
+3.- Las tareas salen ordenadas por prioridad (Bars1s primero, luego por día): una derivada
+    siempre va después de la sesión de 1 sg de la que sale.
+4.- Plan.estimar da el nº de peticiones y el tiempo de pared esperado (latencia observada
+    en plan_bloques.json y límites del gobernador de pacing). No cuenta aciertos de caché.
+
+Los ejecutores (ib_downloader, motor_async) recorren plan.sesiones() en ese orden.
+
+Uso (dry-run, sin conectar a IB):
+    python planificador.py
+    python planificador.py --config activos.xlsx --concurrencia 8 --tareas
+'''
+
+import argparse
+import math
+import os
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+import pandas as pd
+import pytz
+
+import logging
+
+from almacen import BASE_DIR, StagingSesion
+from bloques import plan_bloques, TABLA_BARRAS
+from calendario import calendario_tipo, CALENDARIO_POR_TIPO
+from manifiesto import Manifiesto, filas_esperadas, SEGUNDOS_BARRA, ESTADO_COMPLETA
+from pacing import MAX_PETICIONES_VENTANA, VENTANA_SG
+from remuestreo import es_derivable, BARRA_ORIGEN
+from validacion import VENTANA_MAX_SG
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+EXCEL_CONFIG = os.path.join(BASE_DIR, "activos.xlsx")
+MANIFIESTO_DB = os.path.join(BASE_DIR, "manifiesto.sqlite")
+PLAN_BLOQUES_JSON = os.path.join(BASE_DIR, "plan_bloques.json")
+NY_TZ = pytz.timezone("America/New_York")
+INIT_DAYS_BACK = 5                  # sesiones hacia atrás para un activo sin historial (ib_downloader pasa el suyo)
+BARRAS = ["Bars1s", "Bars15m", "Bars1h", "BarsD", "Tick2Tick"]    # columnas del Excel, como en ib_downloader
+TICKS_POR_PAGINA = 1000             # máximo de reqHistoricalTicks
+MAX_PETICIONES_RELLENO = 20         # tope de peticiones de relleno por sesión (como en ib_downloader)
+TIPOS_SOPORTADOS = set(CALENDARIO_POR_TIPO)     # stock, index, future, forex
+PRIORIDAD_BARRA = {"Bars1s": 0, "Tick2Tick": 1, "BarsD": 2, "Bars1h": 3, "Bars15m": 4}
+PAGINAS_TICKS_DEFECTO = 50          # páginas de Tick2Tick por sesión si no hay historial
+PAGINAS_RELLENO_TICKS = 2           # páginas por sesión Tick2Tick parcial
+MAX_PARCIALES_POR_RUN = 20          # sesiones parciales (las más recientes) que se reintentan por activo y barra
+LATENCIA_DEFECTO_SG = 2.0           # segundos por petición si plan_bloques aún no la conoce
+CONCURRENCIA = 1                    # peticiones en vuelo (ib_downloader: 1; motor_async: 8)
+
+Activo = namedtuple("Activo", ["ticker", "tipo", "barras"])
+Tarea = namedtuple("Tarea", ["id", "ticker", "tipo", "barra", "dia", "accion", "peticiones", "prioridad"])
+Sesion = namedtuple("Sesion", ["ticker", "tipo", "barra", "dia"])
+Estimacion = namedtuple("Estimacion", ["sesiones", "tareas", "peticiones", "derivadas", "segundos"])
+
+
+# ----------------------------
+# CONFIGURACIÓN DE ACTIVOS
+# ----------------------------
+def cargar_config(path=EXCEL_CONFIG, barras_validas=BARRAS):
+    """Lee y valida activos.xlsx. Devuelve [Activo] con las barras marcadas en orden de barras_validas."""
+    config = pd.read_excel(path)
+    faltan = {"Ticker", "Tipo"} - set(config.columns)
+    if faltan:
+        raise ValueError(f"{path}: faltan las columnas {sorted(faltan)}")
+
+    activos, vistos = [], set()
+    for i, row in config.iterrows():
+        fila = i + 2                    # fila del Excel (la 1 es la cabecera)
+        ticker = str(row["Ticker"]).strip() if pd.notna(row["Ticker"]) else ""
+        tipo = str(row["Tipo"]).strip().lower() if pd.notna(row["Tipo"]) else ""
+        if not ticker:
+            logger.warning(f"  ⚠️ {path} fila {fila}: sin Ticker, se salta")
+            continue
+        if tipo not in TIPOS_SOPORTADOS:
+            logger.warning(f"  ⚠️ {path} fila {fila}: tipo '{row['Tipo']}' no soportado para {ticker}, se salta")
+            continue
+        if ticker in vistos:
+            logger.warning(f"  ⚠️ {path} fila {fila}: {ticker} repetido, se salta")
+            continue
+
+        barras, erronea = [], False
+        for barra in barras_validas:
+            marca = row.get(barra, 0)
+            marca = 0 if pd.isna(marca) else marca
+            if marca not in (0, 1):
+                logger.warning(f"  ⚠️ {path} fila {fila}: {barra}={marca!r} para {ticker} (debe ser 0 o 1), se salta")
+                erronea = True
+                break
+            if marca == 1:
+                barras.append(barra)
+        if erronea:
+            continue
+        vistos.add(ticker)
+        activos.append(Activo(ticker, tipo, barras))
+    return activos
+
+
+# ----------------------------
+# PLAN
+# ----------------------------
+class Plan:
+    """Tareas (una por sesión) ordenadas por prioridad y su estimación de coste."""
+
+    def __init__(self, tareas):
+        self.tareas = tareas
+
+    def sesiones(self):
+        """(ticker, tipo, barra, dia) a ejecutar, en el orden de las tareas."""
+        vistas = OrderedDict()
+        for t in self.tareas:
+            vistas.setdefault(Sesion(t.ticker, t.tipo, t.barra, t.dia), None)
+        return list(vistas)
+
+    def estimar(self, concurrencia=CONCURRENCIA):
+        """
+        Peticiones a IB y tiempo de pared: lo mayor entre la latencia acumulada repartida en
+        la concurrencia y lo que obliga el pacing (MAX_PETICIONES_VENTANA cada VENTANA_SG).
+        """
+        peticiones = sum(t.peticiones for t in self.tareas)
+        derivadas = sum(1 for t in self.tareas if t.accion == "derivar")
+        latencia = sum(t.peticiones * plan_bloques.latencia(t.barra, LATENCIA_DEFECTO_SG) for t in self.tareas)
+        ventanas = math.ceil(peticiones / MAX_PETICIONES_VENTANA) - 1 if peticiones else 0
+        segundos = max(latencia / max(1, concurrencia), ventanas * VENTANA_SG)
+        return Estimacion(len(self.sesiones()), len(self.tareas), peticiones, derivadas, segundos)
+
+    def resumen(self, concurrencia=CONCURRENCIA):
+        e = self.estimar(concurrencia)
+        lineas = [f"Plan: {e.sesiones} sesiones, {e.peticiones} peticiones a IB, "
+                  f"{e.derivadas} derivadas en local; ~{_hms(e.segundos)} con concurrencia {concurrencia}"]
+        for barra in sorted({t.barra for t in self.tareas}, key=PRIORIDAD_BARRA.get):
+            tareas = [t for t in self.tareas if t.barra == barra]
+            sesiones = len({(t.ticker, t.dia) for t in tareas})
+            lineas.append(f"  {barra:<10} {sesiones:>5} sesiones {sum(t.peticiones for t in tareas):>6} peticiones")
+        return "\n".join(lineas)
+
+
+def _hms(segundos):
+    segundos = int(round(segundos))
+    return f"{segundos // 3600}h{segundos % 3600 // 60:02d}m{segundos % 60:02d}s"
+
+
+def rango_activo(manifiesto, ticker, barra, cal, hoy, mercado_abierto, init_days_back=INIT_DAYS_BACK):
+    """
+    (desde, hasta) a revisar: las últimas init_days_back sesiones y, si la frontera de backfill
+    es anterior, desde la sesión siguiente a ella. Sin frontera guardada (manifiesto anterior a
+    ella) se usa el último día descargado. Con el mercado abierto no se incluye la sesión en curso.
+    """
+    hasta = cal.anterior(hoy) if mercado_abierto else hoy
+    desde = cal.retroceder(hasta, init_days_back)
+    frontera = manifiesto.frontera(ticker, barra) or manifiesto.ultima_descargada(ticker, barra)
+    if frontera is not None:
+        desde = min(desde, cal.siguiente(frontera))
+    return desde, hasta
+
+
+def avanzar_frontera(manifiesto, ticker, barra, cal, desde, hasta, descargadas):
+    """
+    Guarda como frontera de backfill la última sesión de [desde, hasta] antes del primer día
+    sin descargar (una parcial también la detiene). Devuelve la frontera.
+    """
+    frontera = cal.anterior(desde)
+    for d in cal.sesiones(desde, hasta):
+        if d not in descargadas:
+            break
+        frontera = d
+    manifiesto.fijar_frontera(ticker, barra, frontera)
+    return frontera
+
+
+def _peticiones_relleno(manifiesto, ticker, barra, sesion):
+    """Peticiones para completar una sesión parcial (como mucho MAX_PETICIONES_RELLENO)."""
+    if barra not in VENTANA_MAX_SG:
+        return PAGINAS_RELLENO_TICKS
+    previa = manifiesto.sesion(ticker, barra, sesion[0].date())
+    esperadas = filas_esperadas(barra, sesion[0].astimezone(pytz.utc), sesion[1].astimezone(pytz.utc))
+    if not previa or not esperadas:
+        return 1
+    faltan_sg = max(0, esperadas - previa["filas"]) * SEGUNDOS_BARRA[barra]
+    return min(MAX_PETICIONES_RELLENO, max(1, math.ceil(faltan_sg / VENTANA_MAX_SG[barra])))
+
+
+def _bloques_pendientes(ticker, barra, d, sesion):
+    """Nº de bloques de la sesión que faltan (con el troceo guardado en staging, si lo hay)."""
+    inicio, fin = (x.astimezone(pytz.utc) for x in sesion)
+    staging = StagingSesion(os.path.join(BASE_DIR, barra, ticker), d)
+    hechos = staging.bloques_completados()
+    if staging.plan is not None:
+        return sum(1 for fin_bloque, _, _ in staging.plan if fin_bloque not in hechos)
+    if hechos:
+        inicio = max(inicio, max(pd.Timestamp(h) for h in hechos).to_pydatetime())
+    return len(plan_bloques.bloques(barra, inicio, fin))
+
+
+def _completa(manifiesto, ticker, barra, d):
+    fila = manifiesto.sesion(ticker, barra, d)
+    return fila is not None and fila["estado"] == ESTADO_COMPLETA
+
+
+def planificar(activos, manifiesto, hoy=None, ahora=None, init_days_back=INIT_DAYS_BACK):
+    """Plan con las tareas que faltan para dejar el almacén al día con la configuración."""
+    ahora = ahora or datetime.now(pytz.utc)
+    hoy = hoy or ahora.astimezone(NY_TZ).date()
+    tareas = []
+    origen = set()                      # (ticker, dia) con sesión de Bars1s en el plan
+
+    def nueva(activo, barra, d, accion, peticiones):
+        tareas.append(Tarea(len(tareas), activo.ticker, activo.tipo, barra, d, accion,
+                            peticiones, PRIORIDAD_BARRA[barra]))
+
+    # Bars1s va primero: las derivadas necesitan saber si su sesión de 1 sg está en el plan
+    for barra in sorted(PRIORIDAD_BARRA, key=PRIORIDAD_BARRA.get):
+        for activo in activos:
+            if barra not in activo.barras:
+                continue
+            cal = calendario_tipo(activo.tipo)
+            ruta = os.path.join(BASE_DIR, barra, activo.ticker)
+            if not manifiesto.tiene_entradas(activo.ticker, barra) and os.path.isdir(ruta):
+                manifiesto.importar_directorio(activo.ticker, barra, ruta, cal)
+
+            desde, hasta = rango_activo(manifiesto, activo.ticker, barra, cal, hoy, cal.abierto(ahora),
+                                       init_days_back)
+            descargadas = manifiesto.fechas_descargadas(activo.ticker, barra, desde=desde)
+            avanzar_frontera(manifiesto, activo.ticker, barra, cal, desde, hasta, descargadas)
+            # cada parcial se lee del disco para estimar su relleno: no se recorre todo el historial
+            parciales = manifiesto.fechas_incompletas(activo.ticker, barra, limite=MAX_PARCIALES_POR_RUN)
+            dias = {d for d in cal.sesiones(desde, hasta) if d not in descargadas} | parciales
+            filas = manifiesto.filas_medias(activo.ticker, barra) if barra == "Tick2Tick" else None
+
+            for d in sorted(dias):
+                sesion = cal.sesion(d)
+                if sesion is None:
+                    continue
+                derivable = es_derivable(barra) and BARRA_ORIGEN in activo.barras
+                if barra == BARRA_ORIGEN:
+                    origen.add((activo.ticker, d))
+                if derivable and ((activo.ticker, d) in origen
+                                  or _completa(manifiesto, activo.ticker, BARRA_ORIGEN, d)):
+                    nueva(activo, barra, d, "derivar", 0)
+                elif d in parciales:
+                    nueva(activo, barra, d, "completar", _peticiones_relleno(manifiesto, activo.ticker, barra, sesion))
+                elif barra in TABLA_BARRAS:
+                    bloques = _bloques_pendientes(activo.ticker, barra, d, sesion)
+                    # todo en staging: sólo falta juntar y guardar la sesión
+                    nueva(activo, barra, d, "bloques" if bloques else "guardar", bloques)
+                else:
+                    paginas = math.ceil(filas / TICKS_POR_PAGINA) if filas else PAGINAS_TICKS_DEFECTO
+                    nueva(activo, barra, d, "ticks", paginas)
+
+    tareas.sort(key=lambda t: (t.prioridad, t.dia, t.ticker, t.id))
+    return Plan([t._replace(id=i) for i, t in enumerate(tareas)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan de descargas (dry-run): tareas, peticiones y tiempo estimado")
+    parser.add_argument("--config", default=EXCEL_CONFIG)
+    parser.add_argument("--concurrencia", type=int, default=CONCURRENCIA)
+    parser.add_argument("--tareas", action="store_true", help="listar todas las tareas")
+    args = parser.parse_args()
+
+    plan_bloques.cargar(PLAN_BLOQUES_JSON)
+    manifiesto = Manifiesto(MANIFIESTO_DB)
+    plan = planificar(cargar_config(args.config), manifiesto)
+    manifiesto.close()
+
+    if args.tareas:
+        for t in plan.tareas:
+            print(f"{t.id:>6} {t.ticker:<8} {t.barra:<10} {t.dia} {t.accion:<9} {t.peticiones:>3}")
+    print(plan.resumen(args.concurrencia))
+
+
+if __name__ == "__main__":
+    main()
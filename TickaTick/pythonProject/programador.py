@@ -0,0 +1,178 @@
+'''
+Programador del plan de descargas: puesta al día primero, backfill después y con presupuesto.
+
+Al añadir un activo, su backfill de INIT_DAYS_BACK sesiones (o un hueco antiguo) retrasaba la
+puesta al día de todos los activos que iban detrás en el Excel. Aquí las sesiones del plan
+(planificador.Plan) se reparten en dos colas:
+
+1.- reciente: las DIAS_RECIENTES últimas sesiones cerradas ("la de ayer para todos"). Va
+    siempre entera y primero.
+2.- backfill: el resto. Cada sesión pesa 0.5 ** (edad / SEMIVIDA_SESIONES) (edad = sesiones
+    cerradas desde entonces): se sirve primero el activo cuyo hueco pendiente es más reciente
+    y, a igualdad de peso, por turnos (round-robin), así que un backfill largo no acapara la noche.
+3.- presupuesto: pasado presupuesto_sg desde el inicio no se empieza ninguna sesión más de
+    backfill. Las aplazadas siguen fuera del manifiesto y quedan después de la frontera de
+    backfill (manifiesto.frontera), así que el planificador las vuelve a proponer en la
+    siguiente ejecución aunque la puesta al día ya haya guardado sesiones más recientes.
+
+Dentro de un activo las sesiones del mismo día van en el orden de prioridad de barras del
+plan (Bars1s antes que sus derivadas), así que se respetan las dependencias.
+
+Uso (orden de ejecución sin conectar a IB):
+    python programador.py --presupuesto-sg 7200
+'''
+
+import argparse
+import heapq
+import time
+from collections import namedtuple, OrderedDict, defaultdict
+from datetime import datetime
+
+import pytz
+
+import logging
+
+from calendario import calendario_tipo
+from planificador import (
+    PRIORIDAD_BARRA, EXCEL_CONFIG, MANIFIESTO_DB, PLAN_BLOQUES_JSON, NY_TZ, LATENCIA_DEFECTO_SG, Sesion,
+    cargar_config, planificar,
+)
+from bloques import plan_bloques
+from manifiesto import Manifiesto
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+DIAS_RECIENTES = 1                  # sesiones cerradas que cuentan como puesta al día (1 = la última)
+SEMIVIDA_SESIONES = 5               # cada 5 sesiones de antigüedad el peso de un hueco se reduce a la mitad
+COLA_RECIENTE = "reciente"
+COLA_BACKFILL = "backfill"
+
+Turno = namedtuple("Turno", ["sesion", "cola", "edad", "peso"])
+
+
+def ultima_sesion_cerrada(cal, ahora):
+    """Último día cuya sesión ya ha cerrado en el calendario cal."""
+    hoy = ahora.astimezone(NY_TZ).date()
+    sesion = cal.sesion(hoy)
+    if sesion is not None and ahora >= sesion[1]:
+        return hoy
+    return cal.anterior(hoy)
+
+
+class Programa:
+    """Orden de ejecución de las sesiones de un plan (ver docstring del módulo)."""
+
+    def __init__(self, plan, presupuesto_sg=None, ahora=None, reloj=time.monotonic):
+        self.presupuesto_sg = presupuesto_sg
+        self.reloj = reloj
+        self._inicio = reloj()
+        self.aplazadas = 0
+        self.turnos = self._ordenar(self._clasificar(plan, ahora or datetime.now(pytz.utc)))
+
+    # ----------------------------
+    # Colas
+    # ----------------------------
+    @staticmethod
+    def _clasificar(plan, ahora):
+        referencia = {}                 # tipo -> (calendario, última sesión cerrada)
+        turnos = []
+        for s in plan.sesiones():
+            if s.tipo not in referencia:
+                cal = calendario_tipo(s.tipo)
+                referencia[s.tipo] = (cal, ultima_sesion_cerrada(cal, ahora))
+            cal, ultima = referencia[s.tipo]
+            edad = max(0, len(cal.sesiones(s.dia, ultima)) - 1)
+            cola = COLA_RECIENTE if edad < DIAS_RECIENTES else COLA_BACKFILL
+            turnos.append(Turno(s, cola, edad, 0.5 ** (edad / SEMIVIDA_SESIONES)))
+        return turnos
+
+    @staticmethod
+    def _ordenar(turnos):
+        """Cola reciente y después backfill, cada una repartida entre activos."""
+        salida = []
+        for cola in (COLA_RECIENTE, COLA_BACKFILL):
+            por_activo = OrderedDict()
+            for t in turnos:
+                if t.cola == cola:
+                    por_activo.setdefault(t.sesion.ticker, []).append(t)
+            for lista in por_activo.values():
+                lista.sort(key=lambda t: (t.edad, PRIORIDAD_BARRA[t.sesion.barra]))
+
+            # montículo por (peso de la siguiente sesión del activo, veces servido, orden del Excel)
+            servidos = defaultdict(int)
+            monticulo = [(-lista[0].peso, 0, i, ticker) for i, (ticker, lista) in enumerate(por_activo.items())]
+            heapq.heapify(monticulo)
+            while monticulo:
+                _, _, i, ticker = heapq.heappop(monticulo)
+                lista = por_activo[ticker]
+                salida.append(lista.pop(0))
+                servidos[ticker] += 1
+                if lista:
+                    heapq.heappush(monticulo, (-lista[0].peso, servidos[ticker], i, ticker))
+        return salida
+
+    # ----------------------------
+    # Presupuesto
+    # ----------------------------
+    def agotado(self):
+        return self.presupuesto_sg is not None and self.reloj() - self._inicio >= self.presupuesto_sg
+
+    def aplazar(self, turno):
+        if not self.aplazadas:
+            logger.info(f"⏱️ Presupuesto de backfill agotado ({self.presupuesto_sg} sg): "
+                        f"el resto queda para la próxima ejecución")
+        self.aplazadas += 1
+
+    def __iter__(self):
+        """Turnos en orden; los de backfill dejan de salir en cuanto se agota el presupuesto."""
+        for turno in self.turnos:
+            if turno.cola == COLA_BACKFILL and self.agotado():
+                self.aplazar(turno)
+                continue
+            yield turno
+
+    def resumen(self):
+        recientes = sum(1 for t in self.turnos if t.cola == COLA_RECIENTE)
+        return (f"{recientes} sesiones de puesta al día, {len(self.turnos) - recientes} de backfill "
+                f"({self.aplazadas} aplazadas por presupuesto)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Orden de ejecución del plan: puesta al día y backfill")
+    parser.add_argument("--config", default=EXCEL_CONFIG)
+    parser.add_argument("--presupuesto-sg", type=float,
+                        help="segundos de backfill por ejecución (como PRESUPUESTO_BACKFILL_SG)")
+    args = parser.parse_args()
+
+    plan_bloques.cargar(PLAN_BLOQUES_JSON)
+    manifiesto = Manifiesto(MANIFIESTO_DB)
+    plan = planificar(cargar_config(args.config), manifiesto)
+    manifiesto.close()
+
+    # tiempo estimado de cada sesión (latencia observada, sin pacing) para ver dónde corta el presupuesto
+    coste = defaultdict(float)
+    for t in plan.tareas:
+        latencia = plan_bloques.latencia(t.barra, LATENCIA_DEFECTO_SG)
+        coste[Sesion(t.ticker, t.tipo, t.barra, t.dia)] += t.peticiones * latencia
+
+    # el mismo recorrido que los ejecutores (Programa.__iter__), con un reloj que avanza lo estimado
+    transcurrido = [0.0]
+    programa = Programa(plan, presupuesto_sg=args.presupuesto_sg, reloj=lambda: transcurrido[0])
+    ejecutadas = set()
+    for t in programa:
+        ejecutadas.add(id(t))
+        transcurrido[0] += coste[t.sesion]
+    for t in programa.turnos:
+        s = t.sesion
+        print(f"{t.cola:<9} {s.ticker:<8} {s.barra:<10} {s.dia} edad {t.edad:>3} peso {t.peso:.3f}"
+              f"{'' if id(t) in ejecutadas else '  aplazada'}")
+    print(plan.resumen())
+    print(programa.resumen())
+
+
+if __name__ == "__main__":
+    main()
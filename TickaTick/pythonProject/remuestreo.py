@@ -0,0 +1,99 @@
+'''
+Barras de 15 minutos, 1 hora y diarias construidas en local a partir de las barras de 1 sg.
+
+Si en activos.xlsx están marcados Bars1s y alguna barra más gruesa, ya tenemos la sesión de
+1 sg en disco: no hace falta gastar peticiones de IB para el resto. La agregación es OHLCV
+(open primero, high máximo, low mínimo, close último, volumen suma) y respeta la sesión:
+
+1.- Los cortes se alinean al reloj de Nueva York como hace IB con useRTH
+    (15m: 9:30, 9:45...; 1h: 9:30, 10:00, 11:00...; la primera barra empieza en la apertura).
+2.- La barra diaria es la sesión completa, con time = apertura.
+3.- Los intervalos sin barras de 1 sg no generan barra.
+'''
+
+import pandas as pd
+
+import logging
+
+from almacen import read_session_df
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+# Barra del Excel -> regla de pandas. None = una barra por sesión.
+BARRAS_DERIVABLES = {
+    "Bars15m": "15min",
+    "Bars1h": "1h",
+    "BarsD": None,
+}
+BARRA_ORIGEN = "Bars1s"
+
+AGREGACION_OHLCV = {
+    "open": "first",
+    "high": "max",
+    "low": "min",
+    "close": "last",
+    "volume": "sum",
+}
+
+
+def es_derivable(barra):
+    return barra in BARRAS_DERIVABLES
+
+
+def resample_session(df_1s, barra, session_start_ny, session_end_ny):
+    """
+    Agrega la sesión de 1 sg (time UTC tz-aware + OHLCV) a la barra indicada.
+    Devuelve DataFrame con las mismas columnas y time en UTC.
+    """
+    columnas = ["time"] + list(AGREGACION_OHLCV)
+    if df_1s is None or df_1s.empty:
+        return pd.DataFrame(columns=columnas)
+
+    tz = session_start_ny.tzinfo
+    df = df_1s.copy()
+    df["time"] = pd.to_datetime(df["time"], utc=True)
+    df = df.sort_values("time")
+    # sólo lo que cae dentro de la sesión
+    inicio = pd.Timestamp(session_start_ny).tz_convert("UTC")
+    fin = pd.Timestamp(session_end_ny).tz_convert("UTC")
+    df = df[(df["time"] >= inicio) & (df["time"] < fin)]
+    if df.empty:
+        return pd.DataFrame(columns=columnas)
+
+    regla = BARRAS_DERIVABLES[barra]
+    if regla is None:
+        fila = {
+            "time": inicio,
+            "open": df["open"].iloc[0],
+            "high": df["high"].max(),
+            "low": df["low"].min(),
+            "close": df["close"].iloc[-1],
+            "volume": df["volume"].sum(),
+        }
+        return pd.DataFrame([fila], columns=columnas)
+
+    # Cortes en hora local de NY (como IB), la primera barra arranca en la apertura
+    local = df.set_index(df["time"].dt.tz_convert(tz))[list(AGREGACION_OHLCV)]
+    out = local.resample(regla, label="left", closed="left", origin="start_day").agg(AGREGACION_OHLCV)
+    out = out.dropna(subset=["open"])
+    out.index = out.index.where(out.index >= pd.Timestamp(session_start_ny), pd.Timestamp(session_start_ny))
+    out.index = out.index.tz_convert("UTC")
+    out = out.reset_index(names="time")
+    return out[columnas]
+
+
+def derivar_sesion(ruta_1s, barra, d, session_start_ny, session_end_ny):
+    """
+    Lee la sesión de 1 sg del almacén y la agrega a la barra pedida.
+    Devuelve None si no hay sesión de 1 sg para ese día.
+    """
+    df_1s = read_session_df(ruta_1s, d)
+    if df_1s is None:
+        return None
+    df = resample_session(df_1s, barra, session_start_ny, session_end_ny)
+    logger.info(f"    {barra} {d} derivada de {len(df_1s)} barras de 1 sg -> {len(df)} barras")
+    return df
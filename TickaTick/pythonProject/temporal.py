@@ -4,7 +4,7 @@ Este script descarga datos en barras en 1sg de Interactivebrokers.
 Características principales del script:
 
 1.- Un directorio por activo (ejemplo: ./data/AAPL/).
-2.- Un fichero XLS por cada sesión de Wall Street (ejemplo: 2025-09-25.xls).
+2.- Un fichero por cada sesión de Wall Street (ejemplo: 2025-09-25.parquet). XLSX queda como exportación opcional (ver almacen.py).
 3.- La primera vez que se ejecuta para un activo:
     Crea el directorio si no existe.
     Intentará bajar el máximo histórico permitido
@@ -31,6 +31,9 @@ from ib_insync import IB, Stock, Future
 import logging
 from logging.handlers import TimedRotatingFileHandler
 
+# Guardado/lectura de sesiones (parquet por defecto, XLSX opcional)
+from almacen import save_session_df, list_downloaded_dates
+
 
 
 # === CONFIGURACIÓN GLOBAL ===
@@ -117,23 +120,6 @@ def ensure_symbol_dir(raiz, directorio, symbol):
     os.makedirs(d, exist_ok=True)
     return d
 
-def list_downloaded_dates(symbol_dir):
-    """Devuelve set de fechas descargadas en formato date (YYYY-MM-DD.xlsx)"""
-    if not os.path.exists(symbol_dir):
-        return set()
-    names = os.listdir(symbol_dir)
-    dates = set()
-    for n in names:
-        # aceptar .xlsx o .xls
-        if n.lower().endswith(".xlsx") or n.lower().endswith(".xls"):
-            base = os.path.splitext(n)[0]
-            try:
-                dt = datetime.strptime(base, "%Y-%m-%d").date()
-                dates.add(dt)
-            except Exception:
-                continue
-    return dates
-
 def build_contract(ticker: str, tipo: str):
     """Crea contrato IB según tipo indicado en Excel."""
     tipo = tipo.lower()
@@ -484,40 +470,6 @@ def fetch_ticks_for_session(ib, contract, session_start_ny, session_end_ny, barr
 
 
 
-# ----------------------------
-# GUARDADO por DÍA (XLSX)
-# ----------------------------
-def save_session_df(symbol_dir, date_obj, df):
-    """
-    Guarda dataframe de sesión en symbol_dir/YYYY-MM-DD.xlsx
-    Convierte time a tz-naive UTC antes de escribir y crea formato de columna.
-    """
-    from openpyxl import load_workbook
-
-    filename = os.path.join(symbol_dir, f"{date_obj.strftime('%Y-%m-%d')}.xlsx")
-    if df.empty:
-        print(f"    (vacío) No se guarda {filename}")
-        return
-
-    # convertir time tz-aware UTC -> tz-naive (Excel no acepta tz-aware)
-    df_to_write = df.copy()
-    df_to_write["time"] = pd.to_datetime(df_to_write["time"]).dt.tz_convert(pytz.utc).dt.tz_localize(None)
-
-    # Guardar con pandas (openpyxl) y luego aplicar formato a columna A
-    df_to_write.to_excel(filename, index=False)
-
-    # Formatear la columna A como datetime 'yyyy-mm-dd hh:mm:ss' usando openpyxl
-    try:
-        wb = load_workbook(filename)
-        ws = wb.active
-        for cell in ws["A"][2:]:  # saltar encabezado (fila 1)
-            cell.number_format = "yyyy-mm-dd hh:mm:ss"
-        wb.save(filename)
-    except Exception as e:
-        print(f"    ⚠️ No se pudo aplicar formato a {filename}: {e}")
-
-    print(f"    💾 Guardado {filename} ({len(df)} filas)")
-
 # ----------------------------
 # LÓGICA PRINCIPAL
 # ----------------------------
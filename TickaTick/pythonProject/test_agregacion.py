@@ -0,0 +1,68 @@
+'''Pruebas de agregacion: especificaciones y barras de tiempo, ticks, volumen y desequilibrio.'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from agregacion import Especificacion, agregar, nombre_barra, parse_barra
+
+APERTURA = pd.Timestamp("2025-03-03 14:30", tz="UTC")
+
+
+def _ticks(precios, tamaños, segundos):
+    return pd.DataFrame({"time": APERTURA + pd.to_timedelta(segundos, unit="s"),
+                         "price": np.asarray(precios, dtype=float),
+                         "size": np.asarray(tamaños, dtype=float)})
+
+
+def test_parse_y_nombre():
+    assert parse_barra("volume:50000") == Especificacion("volume", 50000.0)
+    assert nombre_barra(parse_barra("time:1min")) == "Agg_time_1min"
+    assert nombre_barra(parse_barra("dollar:5e6")) == "Agg_dollar_5000000"
+    assert nombre_barra(parse_barra("tick:2.5")) == "Agg_tick_2.5"
+    for texto in ("renko:10", "volume:", "volume:-1", "time:0s"):
+        with pytest.raises(ValueError):
+            parse_barra(texto)
+
+
+def test_barras_de_tiempo_alineadas_a_la_apertura():
+    df = _ticks([10, 11, 9, 12, 13], [1, 2, 3, 4, 5], [5, 30, 59, 61, 185])
+    barras = agregar(df, parse_barra("time:1min"), apertura=APERTURA)
+    assert barras["time"].tolist() == [APERTURA, APERTURA + pd.Timedelta("1min"),
+                                       APERTURA + pd.Timedelta("3min")]
+    assert barras[["open", "high", "low", "close"]].values.tolist() == [[10, 11, 9, 9], [12, 12, 12, 12],
+                                                                      [13, 13, 13, 13]]
+    assert barras["volume"].tolist() == [6, 4, 5]
+    assert barras["vwap"].iloc[0] == pytest.approx((10 + 22 + 27) / 6)
+
+
+def test_barras_de_ticks_y_de_volumen():
+    df = _ticks(np.arange(10) + 100, [3] * 10, np.arange(10))
+    assert agregar(df, parse_barra("tick:4"))["ticks"].tolist() == [4, 4, 2]
+    # el tick que cruza el umbral cierra la barra en la que empieza
+    por_volumen = agregar(df, parse_barra("volume:10"))
+    assert por_volumen["volume"].tolist() == [12, 9, 9]
+    assert por_volumen["volume"].sum() == 30
+
+
+def test_ticks_desordenados_y_sin_precio():
+    df = _ticks([2, 1, np.nan, 3], [1, 1, 1, 1], [2, 1, 3, 4])
+    barras = agregar(df, parse_barra("tick:10"))
+    assert barras[["open", "close", "ticks"]].values.tolist() == [[1, 3, 3]]
+
+
+def test_desequilibrio_cubre_todos_los_ticks():
+    rnd = np.random.default_rng(0)
+    precios = 100 + np.cumsum(rnd.choice([-0.01, 0.01], 5000))
+    df = _ticks(precios, rnd.integers(1, 100, 5000), np.arange(5000) * 0.5)
+    for texto in ("tick_imbalance:50", "volume_imbalance:50"):
+        barras = agregar(df, parse_barra(texto))
+        assert barras["ticks"].sum() == 5000
+        assert barras["time"].is_monotonic_increasing
+        assert len(barras) > 1
+
+
+def test_sesion_vacia():
+    barras = agregar(_ticks([], [], []), parse_barra("volume:10"))
+    assert barras.empty
+    assert list(barras.columns)[:2] == ["time", "time_fin"]
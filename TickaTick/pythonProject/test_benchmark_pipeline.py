@@ -0,0 +1,41 @@
+'''Pruebas del benchmark: casos pequeños contra FakeIB y detección de regresiones entre ejecuciones.'''
+
+import json
+
+import pytest
+
+import benchmark_pipeline
+import ib_downloader
+
+
+@pytest.fixture(scope="module")
+def resultados(tmp_path_factory):
+    # ejecutar cambia el gobernador del módulo: se restaura al acabar
+    gobernador = ib_downloader.gobernador
+    try:
+        yield benchmark_pipeline.ejecutar(["bars1s", "ticks1k"], False, str(tmp_path_factory.mktemp("bench")))
+    finally:
+        ib_downloader.gobernador = gobernador
+
+
+def test_casos_miden_todas_las_etapas(resultados):
+    barras, ticks = resultados["bars1s"], resultados["ticks1k"]
+    assert barras["filas"] == 23400
+    assert ticks["filas"] == 1000
+    assert set(ticks["etapas"]) == {"dicts", "DataFrame", "tz_convert", "ticks_to_frame",
+                                    "sort_values", "save_parquet"}
+    assert "fetch_ticks_for_session" in barras["etapas"]
+    for r in resultados.values():
+        assert r["bytes_disco"] > 0
+        assert all(e["segundos"] >= 0 and "pico_py_mb" in e for e in r["etapas"].values())
+
+
+def test_comparar_marca_regresiones(resultados, tmp_path):
+    anterior = json.loads(json.dumps(resultados))
+    for e in anterior["ticks1k"]["etapas"].values():
+        e["segundos"] = e["segundos"] * 2
+    anterior["ticks1k"]["etapas"]["sort_values"]["segundos"] = (
+        resultados["ticks1k"]["etapas"]["sort_values"]["segundos"] / 2)
+    fichero = tmp_path / "anterior.json"
+    fichero.write_text(json.dumps({"resultados": anterior}), encoding="utf-8")
+    assert benchmark_pipeline.comparar(resultados, str(fichero)) == 1
@@ -0,0 +1,69 @@
+'''Pruebas del calendario: festivos, cierres anticipados y sesiones por mercado.'''
+
+from datetime import date, time as dtime
+
+import pytest
+
+from calendario import Calendario, festivos_nyse
+
+
+@pytest.mark.parametrize("d", [
+    date(2025, 1, 1),       # Año Nuevo
+    date(2025, 1, 9),       # duelo nacional (cierre extraordinario)
+    date(2025, 1, 20),      # Martin Luther King
+    date(2025, 4, 18),      # Viernes Santo
+    date(2025, 6, 19),      # Juneteenth
+    date(2025, 7, 4),       # Independence Day
+    date(2025, 11, 27),     # Acción de Gracias
+    date(2025, 12, 25),     # Navidad
+    date(2021, 7, 5),       # 4 de julio en domingo -> lunes
+    date(2021, 12, 24),     # Navidad en sábado -> viernes
+])
+def test_festivos_nyse(d):
+    assert d in festivos_nyse(d.year)
+    assert not Calendario("NYSE").es_habil(d)
+
+
+def test_año_nuevo_en_sabado_no_se_traslada_en_nyse():
+    assert Calendario("NYSE").es_habil(date(2021, 12, 31))
+
+
+def test_año_nuevo_en_sabado_se_observa_el_año_anterior_en_cme():
+    cme = Calendario("CME")
+    assert not cme.es_habil(date(2021, 12, 31))
+    assert cme.es_habil(date(2022, 1, 3))
+    assert cme.anterior(date(2022, 1, 3)) == date(2021, 12, 30)
+
+
+@pytest.mark.parametrize("d", [date(2025, 7, 3), date(2025, 11, 28), date(2025, 12, 24)])
+def test_cierres_anticipados_nyse(d):
+    apertura, cierre = Calendario("NYSE").sesion(d)
+    assert apertura.time() == dtime(9, 30)
+    assert cierre.time() == dtime(13, 0)
+
+
+def test_sesion_normal_y_cambio_de_hora():
+    nyse = Calendario("NYSE")
+    apertura, cierre = nyse.sesion(date(2025, 3, 7))
+    assert (apertura.time(), cierre.time()) == (dtime(9, 30), dtime(16, 0))
+    assert apertura.utcoffset().total_seconds() == -5 * 3600
+    apertura, _ = nyse.sesion(date(2025, 3, 10))
+    assert apertura.utcoffset().total_seconds() == -4 * 3600
+    assert nyse.sesion(date(2025, 3, 8)) is None
+
+
+def test_cme_abre_la_vispera_y_cierra_pronto_en_festivos_nyse():
+    cme = Calendario("CME")
+    apertura, cierre = cme.sesion(date(2025, 3, 3))
+    assert apertura.date() == date(2025, 3, 2) and apertura.time() == dtime(18, 0)
+    assert cierre.time() == dtime(17, 0)
+    assert cme.sesion(date(2025, 7, 4))[1].time() == dtime(13, 0)
+
+
+def test_navegacion():
+    nyse = Calendario("NYSE")
+    assert nyse.siguiente(date(2025, 4, 17)) == date(2025, 4, 21)
+    assert nyse.anterior(date(2025, 1, 2)) == date(2024, 12, 31)
+    assert nyse.retroceder(date(2025, 1, 3), 3) == date(2024, 12, 31)
+    assert nyse.sesiones(date(2024, 12, 30), date(2025, 1, 3)) == [
+        date(2024, 12, 30), date(2024, 12, 31), date(2025, 1, 2), date(2025, 1, 3)]
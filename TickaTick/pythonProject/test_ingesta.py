@@ -0,0 +1,85 @@
+'''Pruebas de ingesta: DedupeFrontera entre páginas de ticks y el segundo frontera completo.'''
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pandas as pd
+
+import ib_downloader
+from ingesta import DedupeFrontera, ticks_to_frame
+from pacing import GobernadorPacing
+
+BASE = datetime(2025, 3, 3, 15, 0, 0, tzinfo=timezone.utc)
+
+
+def _tick(t, precio=1.0, tamaño=1.0):
+    return SimpleNamespace(time=t, price=precio, size=tamaño)
+
+
+def _pagina(ticks):
+    return ticks_to_frame(ticks, "TRADES")
+
+
+def test_solape_en_el_segundo_frontera():
+    dedupe = DedupeFrontera()
+    recientes = [_tick(BASE + timedelta(milliseconds=100 * i), precio=2.0 + i) for i in range(5)]
+    assert len(dedupe.filtrar(_pagina(recientes))) == 5
+    # la página anterior acaba en el mismo segundo: repite los tres primeros ticks de ese segundo
+    antiguos = [_tick(BASE - timedelta(seconds=1), precio=1.0)] + recientes[:3]
+    nuevos = dedupe.filtrar(_pagina(antiguos))
+    assert len(nuevos) == 1
+    assert nuevos["price"].tolist() == [1.0]
+
+
+def test_trades_identicos_en_el_mismo_instante_no_se_pierden():
+    dedupe = DedupeFrontera()
+    iguales = [_tick(BASE) for _ in range(3)]
+    assert len(dedupe.filtrar(_pagina(iguales[:2]))) == 2
+    # la siguiente página trae los dos ya vistos y un tercero idéntico
+    assert len(dedupe.filtrar(_pagina(iguales))) == 1
+
+
+def test_pagina_entera_del_segundo_frontera_queda_vacia():
+    dedupe = DedupeFrontera()
+    segundo = [_tick(BASE + timedelta(microseconds=100 * j), tamaño=float(j)) for j in range(50)]
+    dedupe.filtrar(_pagina(segundo[25:]))
+    assert len(dedupe.filtrar(_pagina(segundo[:25]))) == 25
+    assert dedupe.filtrar(_pagina(segundo)).empty
+
+
+def test_cargar_desde_staging():
+    dedupe = DedupeFrontera()
+    previos = _pagina([_tick(BASE + timedelta(milliseconds=10 * i)) for i in range(3)])
+    dedupe.cargar(previos)
+    assert dedupe.filtrar(previos).empty
+
+
+class _IBSegundoLleno:
+    """reqHistoricalTicks sobre una lista fija: IB sólo entiende segundos en endDateTime."""
+
+    def __init__(self, ticks):
+        self.ticks = ticks
+
+    def reqHistoricalTicks(self, contract, startDateTime, endDateTime, numberOfTicks, whatToShow,
+                           useRth, ignoreSize):
+        fin = endDateTime.replace(microsecond=0) + timedelta(seconds=1)
+        return [t for t in self.ticks if t.time < fin][-numberOfTicks:]
+
+
+def test_paginado_con_un_segundo_de_mas_de_una_pagina(monkeypatch):
+    ticks = [_tick(BASE - timedelta(seconds=300 - i), precio=1.0 + i) for i in range(300)]
+    ticks += [_tick(BASE + timedelta(microseconds=j * 100), precio=2.0, tamaño=float(j)) for j in range(1500)]
+    ticks += [_tick(BASE + timedelta(seconds=i), precio=3.0) for i in range(1, 100)]
+
+    monkeypatch.setattr(ib_downloader, "gobernador",
+                        GobernadorPacing(max_peticiones=10**6, identica=0.0, max_por_contrato=10**6))
+    monkeypatch.setattr(ib_downloader, "calendario_contrato", lambda c: SimpleNamespace(rth=True))
+    monkeypatch.setattr(ib_downloader, "WHAT_TO_SHOW", "TRADES")
+    contrato = SimpleNamespace(conId=1, symbol="X", exchange="SMART", secType="STK")
+
+    df = ib_downloader.fetch_ticks_tick2tick(_IBSegundoLleno(ticks), contrato,
+                                             BASE - timedelta(seconds=300), BASE + timedelta(seconds=100))
+    # el segundo frontera no cabe en una página: IB no sirve sus primeros 500 ticks, pero el
+    # paginado sigue hacia atrás en vez de cortar la sesión
+    assert df["time"].min() == pd.Timestamp(BASE - timedelta(seconds=300))
+    assert len(df) == 300 + ib_downloader.TICKS_POR_PAGINA + 99
@@ -0,0 +1,71 @@
+'''Pruebas de microestructura: OFI, variables por intervalo y caché incremental por día.'''
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import microestructura
+from almacen import save_session_df
+from microestructura import COLUMNAS_FEATURES, actualizar_symbol, calcular_features, ofi_ticks
+
+INICIO = pd.Timestamp("2025-03-03 14:30", tz="UTC")
+
+
+def _bid_ask(segundos, bid, ask, qb, qa):
+    bid = np.asarray(bid, dtype=float)
+    ask = np.asarray(ask, dtype=float)
+    return pd.DataFrame({"time": INICIO + pd.to_timedelta(segundos, unit="s"),
+                         "bid": bid, "bid_size": np.asarray(qb, dtype=float),
+                         "ask": ask, "ask_size": np.asarray(qa, dtype=float),
+                         "midpoint": (bid + ask) / 2})
+
+
+def test_ofi_por_cotizacion():
+    # sube el bid (+ su tamaño), baja el tamaño del ask al mismo precio (+ lo que se va), baja el bid
+    bid = np.array([10.0, 10.1, 10.1, 10.0])
+    ask = np.array([10.2, 10.2, 10.2, 10.2])
+    qb = np.array([5.0, 7.0, 7.0, 4.0])
+    qa = np.array([6.0, 6.0, 2.0, 2.0])
+    assert ofi_ticks(bid, ask, qb, qa).tolist() == [0.0, 7.0, 4.0, -7.0]
+
+
+def test_features_por_segundo():
+    df = _bid_ask([0.1, 0.5, 1.2, 1.7, 3.0],
+                  [10.0, 10.1, 10.1, 10.0, 10.0], [10.2, 10.2, 10.2, 10.2, 10.4],
+                  [5, 7, 7, 4, 4], [6, 6, 2, 2, 2])
+    trades = pd.DataFrame({"time": INICIO + pd.to_timedelta([0.6, 1.8], unit="s"), "price": [10.2, 10.0]})
+    f = calcular_features(df, trades)
+    assert list(f.columns) == COLUMNAS_FEATURES
+    assert f["time"].tolist() == [INICIO, INICIO + pd.Timedelta("1s"), INICIO + pd.Timedelta("3s")]
+    # en el 3.º intervalo el ask sube: su profundidad anterior cuenta a favor
+    assert f["ofi"].tolist() == [7.0, -3.0, 2.0]
+    assert f["spread"].tolist() == pytest.approx([0.1, 0.2, 0.4])
+    assert f["cotizaciones"].tolist() == [2, 2, 1]
+    assert f["microprice"].iloc[0] == pytest.approx((10.1 * 6 + 10.2 * 7) / 13)
+    assert f["ret_mid"].iloc[1] == pytest.approx(np.log(10.1 / 10.15))
+    assert f["spread_efectivo"].iloc[:2].tolist() == pytest.approx([0.1, 0.2])
+    assert np.isnan(f["spread_efectivo"].iloc[2])
+
+
+def test_cotizaciones_invalidas_y_sesion_vacia():
+    df = _bid_ask([0, 1], [0.0, np.nan], [10.2, 10.2], [1, 1], [1, 1])
+    f = calcular_features(df)
+    assert f.empty and list(f.columns) == COLUMNAS_FEATURES
+
+
+def test_cache_incremental(tmp_path, monkeypatch):
+    origen = tmp_path / "datatick" / "AAPL"
+    origen.mkdir(parents=True)
+    destino = tmp_path / "features"
+    df = _bid_ask(np.arange(10), np.full(10, 10.0), np.full(10, 10.1), np.ones(10), np.ones(10))
+    save_session_df(str(origen), date(2025, 3, 3), df)
+
+    assert actualizar_symbol(str(origen), str(destino)) == (1, 0)
+    assert actualizar_symbol(str(origen), str(destino)) == (0, 1)
+    save_session_df(str(origen), date(2025, 3, 4), df)
+    assert actualizar_symbol(str(origen), str(destino)) == (1, 1)
+    # otra versión del cálculo invalida todo
+    monkeypatch.setattr(microestructura, "VERSION_FEATURES", microestructura.VERSION_FEATURES + 1)
+    assert actualizar_symbol(str(origen), str(destino)) == (2, 0)
@@ -0,0 +1,56 @@
+'''Pruebas del motor asíncrono contra FakeIB: una sesión completa con errores de pacing inyectados.'''
+
+import asyncio
+import contextlib
+from datetime import date
+
+import pytest
+
+import pacing
+from fake_ib import FakeIB
+from ib_downloader import build_contract, ensure_symbol_dir
+from manifiesto import ESTADO_COMPLETA, Manifiesto
+from motor_async import MotorDescarga, Trabajo
+
+DIA = date(2025, 3, 3)
+
+
+class Pool:
+    """Pool de una sola conexión con la interfaz de PoolConexiones.usar."""
+
+    def __init__(self, ib):
+        self.ib = ib
+
+    @contextlib.contextmanager
+    def usar(self, tipo):
+        yield self.ib
+
+
+def _descargar(base, barra, error_pacing_cada):
+    gobernador = pacing.GobernadorPacing(max_peticiones=10**6, identica=0.0, max_por_contrato=10**6)
+    ib = FakeIB(None, latencia=0, jitter=0, error_pacing_cada=error_pacing_cada)
+    ib.errorEvent += gobernador.on_error
+    contrato = build_contract("AAPL", "stock")
+    ib.qualifyContracts(contrato)
+    base.mkdir()
+    manifiesto = Manifiesto(str(base / "manifiesto.sqlite"))
+    motor = MotorDescarga(Pool(ib), manifiesto, gobernador=gobernador)
+    trabajo = Trabajo("AAPL", contrato, barra, ensure_symbol_dir(str(base), barra, "AAPL"), DIA, None)
+    asyncio.run(motor.descargar_sesion(trabajo))
+    return motor, manifiesto.sesion("AAPL", barra, DIA), ib
+
+
+@pytest.mark.parametrize("barra, cada", [("Bars1s", 3), ("Tick2Tick", 2)])
+def test_sesion_con_errores_de_pacing(tmp_path, monkeypatch, barra, cada):
+    # backoff corto y sin margen: se prueba la cadena de reintentos, no las esperas
+    monkeypatch.setattr(pacing, "BACKOFF_INICIAL_SG", 0.01)
+    monkeypatch.setattr(pacing, "MARGEN_SG", 0.0)
+    _, limpia, ib_limpio = _descargar(tmp_path / "limpia", barra, 0)
+    motor, sesion, ib = _descargar(tmp_path / "pacing", barra, cada)
+
+    assert motor.fallidas == 0 and motor.guardadas == 1
+    assert sesion["estado"] == ESTADO_COMPLETA
+    # los bloques rechazados se reintentan: mismos datos que sin errores, con más peticiones
+    assert sesion["filas"] == limpia["filas"]
+    assert sesion["checksum"] == limpia["checksum"]
+    assert len(ib.peticiones) > len(ib_limpio.peticiones)
@@ -0,0 +1,83 @@
+'''Pruebas del gobernador de pacing: reglas de espera y ventana de errores marca/error_desde.'''
+
+from types import SimpleNamespace
+
+import pytest
+
+from pacing import GobernadorPacing, ErrorPeticionIB
+
+
+class Reloj:
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
+
+
+def _contrato(con_id=1):
+    return SimpleNamespace(conId=con_id, symbol="AAPL", exchange="SMART")
+
+
+def test_espera_por_contrato():
+    reloj = Reloj()
+    g = GobernadorPacing(max_peticiones=100, identica=0.0, max_por_contrato=2, ventana_contrato=2.0, reloj=reloj)
+    assert g._intentar("c", None) == 0.0
+    assert g._intentar("c", None) == 0.0
+    assert g._intentar("c", None) > 0
+    assert g._intentar("otro", None) == 0.0
+    reloj.t = 2.0
+    assert g._intentar("c", None) == 0.0
+
+
+def test_peticion_identica():
+    reloj = Reloj()
+    g = GobernadorPacing(identica=15.0, reloj=reloj)
+    assert g._intentar("c", "firma") == 0.0
+    assert g._intentar("c", "firma") > 0
+    reloj.t = 15.0
+    assert g._intentar("c", "firma") == 0.0
+
+
+def test_error_despues_de_marca():
+    g = GobernadorPacing()
+    c = _contrato()
+    marca = g.marca()
+    g.on_error(7, 200, "No security definition", c)
+    assert g.error_desde(marca, c) == (200, "No security definition")
+    with pytest.raises(ErrorPeticionIB):
+        g.verificar_respuesta(marca, c, [])
+    assert g.verificar_respuesta(marca, c, [1]) == [1]
+
+
+def test_exito_de_otra_peticion_no_borra_errores():
+    # marca -> otra petición acaba bien -> llega el error de la primera
+    g = GobernadorPacing()
+    c = _contrato()
+    g.on_error(1, 200, "anterior", c)
+    marca = g.marca()
+    g.notificar_exito()
+    g.on_error(2, 162, "Historical Market Data Service error message: pacing violation", c)
+    assert g.error_desde(marca, c) is not None
+    with pytest.raises(ErrorPeticionIB):
+        g.verificar_respuesta(marca, c, [])
+
+
+def test_errores_ignorados():
+    g = GobernadorPacing()
+    c = _contrato()
+    marca = g.marca()
+    g.on_error(-1, 1100, "Connectivity lost", None)
+    g.on_error(3, 2104, "Market data farm connection is OK", c)
+    g.on_error(4, 162, "HMDS query returned no data", c)
+    g.on_error(5, 200, "otro contrato", _contrato(2))
+    assert g.error_desde(marca, c) is None
+    assert g.verificar_respuesta(marca, c, []) == []
+
+
+def test_backoff_de_pacing():
+    reloj = Reloj()
+    g = GobernadorPacing(reloj=reloj)
+    assert g.notificar_error(162, "pacing violation")
+    assert g._intentar("c", None) > 0
+    assert not g.notificar_error(162, "HMDS query returned no data")
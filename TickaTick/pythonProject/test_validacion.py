@@ -0,0 +1,67 @@
+'''Pruebas de validacion: huecos, segundos sin trades y plan de peticiones de relleno.'''
+
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from validacion import HUECO_MIN_SG, planificar_peticiones, validar_sesion
+
+INICIO = pd.Timestamp("2025-03-03 14:30", tz="UTC")
+FIN = pd.Timestamp("2025-03-03 21:00", tz="UTC")
+
+
+def _barras(segundos, volumen=1.0):
+    return pd.DataFrame({"time": INICIO + pd.to_timedelta(segundos, unit="s"),
+                         "volume": np.full(len(segundos), volumen)})
+
+
+def _toda_la_sesion():
+    return np.arange(int((FIN - INICIO).total_seconds()))
+
+
+def test_sesion_completa_es_correcta():
+    informe = validar_sesion(_barras(_toda_la_sesion()), "Bars1s", INICIO, FIN)
+    assert informe.correcta
+    assert informe.huecos == []
+
+
+def test_segundos_sin_trades_no_son_huecos():
+    segundos = _toda_la_sesion()
+    # segundos sueltos y tramos cortos sin barra: IB no manda barra de TRADES si no hubo operaciones
+    quitar = np.r_[5, 17:40, 1000:1000 + HUECO_MIN_SG["Bars1s"] - 1]
+    informe = validar_sesion(_barras(np.setdiff1d(segundos, quitar)), "Bars1s", INICIO, FIN)
+    assert informe.huecos == []
+    assert planificar_peticiones(informe, "Bars1s") == []
+
+
+def test_bloque_perdido_es_hueco():
+    segundos = _toda_la_sesion()
+    perdido = np.arange(3600, 3600 + 1800)
+    informe = validar_sesion(_barras(np.setdiff1d(segundos, perdido)), "Bars1s", INICIO, FIN)
+    assert informe.huecos == [(INICIO + timedelta(seconds=3600), INICIO + timedelta(seconds=5400))]
+    peticiones = planificar_peticiones(informe, "Bars1s")
+    assert [(p.inicio, p.fin, p.duracion) for p in peticiones] == [
+        (INICIO + timedelta(seconds=3600), INICIO + timedelta(seconds=5400), "1800 S")]
+
+
+def test_huecos_al_principio_y_al_final():
+    segundos = np.arange(600, int((FIN - INICIO).total_seconds()) - 600)
+    informe = validar_sesion(_barras(segundos), "Bars1s", INICIO, FIN)
+    assert informe.huecos == [(INICIO, INICIO + timedelta(seconds=600)),
+                              (FIN - timedelta(seconds=600), FIN)]
+
+
+def test_fuera_de_sesion_y_duplicados():
+    df = _barras(np.r_[-10, 0, 0, 1:int((FIN - INICIO).total_seconds())])
+    informe = validar_sesion(df, "Bars1s", INICIO, FIN)
+    assert informe.fuera_sesion == 1
+    assert informe.duplicados == 1
+    assert not informe.correcta
+
+
+def test_ticks_silencio_corto_no_es_hueco():
+    t = INICIO + pd.to_timedelta(np.r_[0:600:30, 900:int((FIN - INICIO).total_seconds()):30], unit="s")
+    informe = validar_sesion(pd.DataFrame({"time": t}), "Tick2Tick", INICIO, FIN)
+    # entre 570 y 900 hay 330 sg de silencio (> UMBRAL_HUECO_TICKS_SG); los 30 sg entre ticks no cuentan
+    assert informe.huecos == [(INICIO + timedelta(seconds=570), INICIO + timedelta(seconds=900))]
@@ -0,0 +1,360 @@
+'''
+Captura en tiempo real de la sesión en curso (Bars1s y Tick2Tick).
+
+ib_downloader sólo baja sesiones ya cerradas: con el mercado abierto se salta el día en curso.
+Este script se lanza antes o durante la sesión y la va guardando mientras ocurre:
+
+1.- Por cada activo de activos.xlsx con Bars1s o Tick2Tick se abre una suscripción
+    tick a tick (reqTickByTickData: AllLast para Trades, BidAsk para Bid_Ask). Es una por
+    (contrato, tipo) aunque la usen las dos barras: Bars1s y Tick2Tick de Trades reparten los
+    mismos ticks (SuscripcionCompartida) y cada tipo pide con su copia del contrato, porque
+    ib_insync guarda un Ticker por objeto contrato y mezclaría los ticks de ambas.
+2.- Cada LOTE_SG segundos se vuelca un micro-lote al staging de la sesión de hoy
+    (<SYMBOL>/_vivo/YYYY-MM-DD/, un parquet por lote, igual que StagingSesion en las
+    descargas). Si el proceso se cae, al relanzar se sigue anexando al mismo staging.
+      Tick2Tick: los ticks tal cual llegan.
+      Bars1s:    barras de 1 sg construidas en local con agregacion (time:1s) sobre los
+                 segundos ya cerrados (RETRASO_SG de margen para ticks que llegan tarde).
+                 Los segundos sin trades se rellenan como IB (volumen 0 y precio del último
+                 cierre), pero sólo mientras la suscripción estaba viva: un corte de
+                 conexión queda como hueco.
+3.- Al cierre (calendario del activo) se junta el staging, se guarda la sesión con
+    save_session_df y se registra en el manifiesto. Si validar_sesion encuentra huecos
+    (arranque con la sesión empezada, cortes) queda como parcial y la pasada nocturna de
+    ib_downloader sólo pide esos huecos (completar_sesion). Bars15m / Bars1h / BarsD se
+    derivan después de Bars1s en esa misma pasada.
+
+No se usa reqRealTimeBars (sólo da barras de 5 sg) ni keepUpToDate (no admite barras de
+menos de 5 sg): del tick a tick salen tanto los ticks como las barras de 1 sg.
+
+Uso:
+    python tiempo_real.py                        # activos de activos.xlsx
+    python tiempo_real.py --tickers AAPL SPY --barras Bars1s
+'''
+
+import argparse
+import copy
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from agregacion import Especificacion, agregar
+from almacen import StagingSesion, save_session_df
+from contratos import cache_contratos
+from ib_downloader import (BASE_DIR, CONTRATOS_DB, EXCEL_CONFIG, MANIFIESTO_DB, NY_TZ, WHAT_TO_SHOW, logger,
+                           build_contract, connect_ib, ensure_symbol_dir, sesion_ny)
+from ingesta import COLUMNAS_BARRAS, NS_SEGUNDO, columnas_ticks, concat_frames, ticks_to_frame
+from manifiesto import ESTADO_PARCIAL, Manifiesto, filas_esperadas
+from planificador import cargar_config
+from validacion import limpiar_sesion, validar_sesion
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+BARRAS_TIEMPO_REAL = ["Bars1s", "Tick2Tick"]
+LOTE_SG = 30                        # cada cuánto se vuelca un micro-lote al staging
+RETRASO_SG = 2                      # un segundo no se cierra hasta RETRASO_SG después
+MARGEN_CIERRE_SG = 10               # espera tras la campana antes de cerrar la partición
+MAX_SUSCRIPCIONES = 5               # límite de suscripciones tick a tick simultáneas de la cuenta
+DIR_VIVO = "_vivo"                  # staging de la captura (aparte del de las descargas)
+TIPO_TICK_BY_TICK = {"trades": "AllLast", "bid_ask": "BidAsk"}
+
+# errorEvent: conexión perdida / recuperada con pérdida de datos / recuperada sin pérdida
+CODIGOS_CORTE = {1100, 2110}
+CODIGO_RECUPERADA_SIN_DATOS = 1101
+CODIGO_RECUPERADA = 1102
+
+UN_SEGUNDO = Especificacion("time", pd.Timedelta("1s"))
+
+
+def _segundo(ts):
+    """Timestamp UTC truncado al segundo, en ns."""
+    return pd.Timestamp(ts).value // NS_SEGUNDO * NS_SEGUNDO
+
+
+class SuscripcionCompartida:
+    """Una reqTickByTickData de (contrato, tipo) cuyos ticks se reparten entre las capturas que la usan."""
+
+    def __init__(self, ib, contract, tipo):
+        self.ib = ib
+        self.contract = copy.copy(contract)     # Ticker propio: ib_insync los indexa por id(contract)
+        self.tipo = tipo
+        self._ticker = None
+        self._receptores = []
+
+    def añadir(self, receptor):
+        """Da de alta receptor(ticks); la primera alta abre la suscripción en IB."""
+        if receptor not in self._receptores:
+            self._receptores.append(receptor)
+        if self._ticker is None:
+            self._pedir()
+
+    def quitar(self, receptor):
+        """Da de baja receptor; con la última baja se cancela en IB."""
+        if receptor in self._receptores:
+            self._receptores.remove(receptor)
+        if not self._receptores:
+            self._cancelar()
+
+    def _pedir(self):
+        self._ticker = self.ib.reqTickByTickData(self.contract, self.tipo, 0, False)
+        self._ticker.updateEvent += self._on_ticks
+
+    def _cancelar(self):
+        if self._ticker is not None:
+            self._ticker.updateEvent -= self._on_ticks
+            self.ib.cancelTickByTickData(self.contract, self.tipo)
+            self._ticker = None
+
+    def _on_ticks(self, t):
+        for receptor in self._receptores:
+            receptor(t.tickByTicks)
+
+    def on_error(self, req_id, codigo, mensaje, contract=None):
+        if codigo == CODIGO_RECUPERADA_SIN_DATOS and self._receptores:
+            # IB ha perdido las suscripciones: hay que pedirlas de nuevo (una vez, no por captura)
+            self._cancelar()
+            self._pedir()
+
+
+class CapturaSesion:
+    """Suscripción tick a tick de un activo y barra, volcada por micro-lotes a la sesión de hoy."""
+
+    def __init__(self, ib, contract, ticker, barra, ruta, d, session_start, session_end, suscripcion=None):
+        self.ib = ib
+        self.contract = contract
+        self.ticker = ticker
+        self.barra = barra
+        self.ruta = ruta
+        self.d = d
+        self.session_start = session_start
+        self.session_end = session_end
+        self.what_to_show = "Trades" if barra == "Bars1s" else WHAT_TO_SHOW
+        if self.what_to_show.lower() not in TIPO_TICK_BY_TICK:
+            raise ValueError(f"WHAT_TO_SHOW {self.what_to_show} no se puede capturar en tiempo real")
+        self.tipo = TIPO_TICK_BY_TICK[self.what_to_show.lower()]
+        self.suscripcion = suscripcion or SuscripcionCompartida(ib, contract, self.tipo)
+
+        self.staging = StagingSesion(ruta, d, subdir=DIR_VIVO)
+        cursor = json.loads(self.staging.cursor) if self.staging.cursor else {}
+        self._hasta = cursor.get("hasta", _segundo(session_start))    # ns ya volcados
+        self._ultimo_cierre = cursor.get("cierre")                      # para rellenar segundos sin trades
+        self._pendientes = []
+        self._cubierto_desde = None     # ns desde el que la suscripción no ha tenido cortes
+        self._suscrita = False
+        self.cerrada = False
+
+    # ----------------------------
+    # Suscripción
+    # ----------------------------
+    def suscribir(self):
+        self.suscripcion.añadir(self._on_ticks)
+        self._suscrita = True
+        self._cubierto_desde = _segundo(datetime.now(pytz.utc)) + NS_SEGUNDO
+        logger.info(f"  📡 {self.ticker} {self.barra}: suscrito ({self.tipo})")
+
+    def cancelar(self):
+        if self._suscrita:
+            self.suscripcion.quitar(self._on_ticks)
+            self._suscrita = False
+
+    def _on_ticks(self, ticks):
+        self._pendientes.extend(ticks)
+
+    def on_error(self, req_id, codigo, mensaje, contract=None):
+        if codigo in CODIGOS_CORTE:
+            self._cubierto_desde = None
+        elif codigo in (CODIGO_RECUPERADA, CODIGO_RECUPERADA_SIN_DATOS):
+            # sin datos: la SuscripcionCompartida se vuelve a pedir; cubierto desde ahora
+            self._cubierto_desde = _segundo(datetime.now(pytz.utc)) + NS_SEGUNDO
+
+    # ----------------------------
+    # Micro-lotes
+    # ----------------------------
+    def volcar(self, ahora, final=False):
+        """Guarda en el staging lo recibido hasta el último segundo cerrado."""
+        limite = _segundo(self.session_end) if final else \
+            min(_segundo(ahora) - RETRASO_SG * NS_SEGUNDO, _segundo(self.session_end))
+        if limite <= self._hasta:
+            return 0
+
+        recibidos, self._pendientes = self._pendientes, []
+        df = ticks_to_frame(recibidos, self.what_to_show)
+        ns = df["time"].astype("datetime64[ns, UTC]").array.asi8
+        # lo posterior al límite vuelve a la cola para el siguiente lote
+        self._pendientes = [t for t, n in zip(recibidos, ns) if n >= limite]
+        df = df[(ns >= self._hasta) & (ns < limite)].reset_index(drop=True)
+        if self.barra == "Bars1s":
+            df = self._barras(df, limite)
+
+        cursor = {"hasta": int(limite), "cierre": self._ultimo_cierre}
+        self.staging.guardar_bloque(f"vivo:{pd.Timestamp(limite, tz='UTC').isoformat()}", df,
+                                    cursor=json.dumps(cursor))
+        self._hasta = limite
+        return len(df)
+
+    def _barras(self, df, limite):
+        """Ticks de [self._hasta, limite) -> barras de 1 sg con los segundos cubiertos sin trades rellenos."""
+        barras = agregar(df, UN_SEGUNDO, apertura=pd.Timestamp(self._hasta, tz="UTC"))[["time"] + COLUMNAS_BARRAS]
+        desde = max(self._hasta, self._cubierto_desde) if self._cubierto_desde is not None else limite
+        if desde < limite:
+            rejilla = pd.to_datetime(np.arange(self._hasta, limite, NS_SEGUNDO), utc=True)
+            barras = barras.set_index("time").reindex(rejilla)
+            cubierto = rejilla.asi8 >= desde
+            cierre = barras["close"].ffill()
+            if self._ultimo_cierre is not None:
+                cierre = cierre.fillna(self._ultimo_cierre)
+            vacio = barras["close"].isna().to_numpy() & cubierto & cierre.notna().to_numpy()
+            for c in ("open", "high", "low", "close"):
+                barras.loc[vacio, c] = cierre[vacio]
+            barras.loc[vacio, "volume"] = 0.0
+            barras = barras.dropna(subset=["close"]).rename_axis("time").reset_index()
+        if not barras.empty:
+            self._ultimo_cierre = float(barras["close"].iloc[-1])
+        return barras
+
+    # ----------------------------
+    # Cierre de la partición
+    # ----------------------------
+    def cerrar(self, manifiesto):
+        """Último lote, sesión guardada y registrada. Devuelve el estado del manifiesto."""
+        self.volcar(None, final=True)
+        self.cancelar()
+        columnas = ["time"] + COLUMNAS_BARRAS if self.barra == "Bars1s" else columnas_ticks(self.what_to_show)
+        df_day = limpiar_sesion(concat_frames([self.staging.leer_bloques()], columnas),
+                                self.barra, self.session_start, self.session_end)
+        informe = validar_sesion(df_day, self.barra, self.session_start, self.session_end)
+        filename = save_session_df(self.ruta, self.d, df_day) if not df_day.empty else None
+        esperadas = filas_esperadas(self.barra, self.session_start.astimezone(pytz.utc),
+                                    self.session_end.astimezone(pytz.utc))
+        estado = manifiesto.registrar(self.ticker, self.barra, self.d, df_day, ruta=filename,
+                                      esperadas=esperadas,
+                                      estado=ESTADO_PARCIAL if informe.huecos else None)
+        logger.info(f"  🔔 {self.ticker} {self.barra} {self.d}: {len(df_day)} filas, "
+                    f"{len(informe.huecos)} huecos -> {estado}")
+        self.staging.limpiar()
+        self.cerrada = True
+        return estado
+
+
+# ----------------------------
+# BUCLE DE CAPTURA
+# ----------------------------
+def sesion_en_curso(contract, ahora):
+    """(día, apertura, cierre) de la sesión de hoy si no ha cerrado o de la de mañana si ya abrió (futuros)."""
+    hoy = ahora.astimezone(NY_TZ).date()
+    for d in (hoy, hoy + timedelta(days=1)):
+        sesion = sesion_ny(d, contract)
+        if sesion is not None and sesion[1] > ahora and (d == hoy or sesion[0] <= ahora):
+            return d, sesion[0], sesion[1]
+    return None
+
+
+def preparar_capturas(ib, activos, barras):
+    """activos: [(ticker, tipo, barras marcadas)] -> CapturaSesion de las sesiones de hoy."""
+    ahora = datetime.now(pytz.utc)
+    capturas = []
+    suscripciones = {}                  # (conId, tipo) -> SuscripcionCompartida
+    contratos = [build_contract(ticker, tipo) for ticker, tipo, _ in activos]
+    try:
+        cache_contratos.cualificar(ib, *contratos)
+    except Exception as e:
+        logger.info(f"  ⚠️ qualifyContracts fallo: {e}")
+    for (ticker, tipo, marcadas), contract in zip(activos, contratos):
+        sesion = sesion_en_curso(contract, ahora)
+        if sesion is None:
+            logger.info(f"  {ticker}: sin sesión hoy, no se captura")
+            continue
+        d, apertura, cierre = sesion
+        for barra in [b for b in barras if b in marcadas]:
+            what_to_show = "Trades" if barra == "Bars1s" else WHAT_TO_SHOW
+            clave = (contract.conId or ticker, TIPO_TICK_BY_TICK.get(what_to_show.lower()))
+            if clave not in suscripciones and len(suscripciones) >= MAX_SUSCRIPCIONES:
+                logger.warning(f"  ⚠️ {ticker} {barra}: límite de {MAX_SUSCRIPCIONES} suscripciones, "
+                               f"queda para la pasada nocturna")
+                continue
+            ruta = ensure_symbol_dir(BASE_DIR, barra, ticker)
+            captura = CapturaSesion(ib, contract, ticker, barra, ruta, d, apertura, cierre,
+                                    suscripciones.get(clave))
+            suscripciones[clave] = captura.suscripcion
+            capturas.append(captura)
+    return capturas
+
+
+def capturar(ib, manifiesto, capturas):
+    """Vuelca micro-lotes hasta que cierran todas las sesiones. Devuelve {estado: nº sesiones}."""
+    suscripciones = list({id(c.suscripcion): c.suscripcion for c in capturas}.values())
+    for s in suscripciones:
+        ib.errorEvent += s.on_error
+    for c in capturas:
+        c.suscribir()
+        ib.errorEvent += c.on_error
+    estados = {}
+    try:
+        while not all(c.cerrada for c in capturas):
+            ib.sleep(LOTE_SG)
+            ahora = datetime.now(pytz.utc)
+            for c in capturas:
+                if c.cerrada:
+                    continue
+                if ahora >= c.session_end + timedelta(seconds=MARGEN_CIERRE_SG):
+                    estado = c.cerrar(manifiesto)
+                    estados[estado] = estados.get(estado, 0) + 1
+                else:
+                    n = c.volcar(ahora)
+                    logger.debug(f"    {c.ticker} {c.barra}: lote de {n} filas")
+    except KeyboardInterrupt:
+        # lo volcado queda en el staging: al relanzar se sigue anexando a la misma sesión
+        for c in capturas:
+            if not c.cerrada:
+                c.volcar(datetime.now(pytz.utc))
+                c.cancelar()
+        logger.warning("Captura interrumpida: relanzar para seguir con la sesión en curso")
+    finally:
+        for c in capturas:
+            ib.errorEvent -= c.on_error
+        for s in suscripciones:
+            ib.errorEvent -= s.on_error
+    return estados
+
+
+def leer_activos(tickers=None):
+    """
+    [(ticker, tipo, barras marcadas)] de activos.xlsx (o los tickers indicados como stock).
+    El Excel se valida con planificador.cargar_config: las filas que el planificador salta
+    tampoco se capturan.
+    """
+    if tickers:
+        return [(t, "stock", set(BARRAS_TIEMPO_REAL)) for t in tickers]
+    return [(a.ticker, a.tipo, set(a.barras) & set(BARRAS_TIEMPO_REAL)) for a in cargar_config(EXCEL_CONFIG)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Captura en tiempo real de la sesión en curso")
+    parser.add_argument("--tickers", nargs="+", help="en vez de activos.xlsx (tipo stock)")
+    parser.add_argument("--barras", nargs="+", choices=BARRAS_TIEMPO_REAL, default=BARRAS_TIEMPO_REAL)
+    args = parser.parse_args()
+
+    ib = connect_ib()
+    manifiesto = Manifiesto(MANIFIESTO_DB)
+    cache_contratos.abrir(CONTRATOS_DB)
+    try:
+        capturas = preparar_capturas(ib, leer_activos(args.tickers), args.barras)
+        if not capturas:
+            print("Nada que capturar")
+            return
+        estados = capturar(ib, manifiesto, capturas)
+    finally:
+        cache_contratos.close()
+        manifiesto.close()
+        ib.disconnect()
+    for estado, n in sorted(estados.items()):
+        print(f"{estado:<10} {n:>4} sesiones")
+
+
+if __name__ == "__main__":
+    main()
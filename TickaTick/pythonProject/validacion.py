@@ -0,0 +1,218 @@
+'''
+Validación de sesiones guardadas y plan mínimo de peticiones para rellenar huecos.
+
+Un bloque que falla o una página de ticks vacía pueden dejar la sesión guardada con huecos
+sin que nadie se entere. validar_sesion revisa una sesión (vectorizado sobre int64 ns):
+
+1.- Huecos: tramos sin barras (15m / 1h: saltos mayores que la barra; Bars1s: saltos de al
+    menos HUECO_MIN_SG, porque IB no manda barra de TRADES en los segundos sin operaciones)
+    o, en ticks, silencios mayores que UMBRAL_HUECO_TICKS_SG. Incluye el principio y el
+    final de la sesión.
+2.- Filas fuera de sesión.
+3.- Timestamps duplicados (sólo barras: en ticks dos trades en el mismo instante son legítimos).
+4.- Tramos largos con volumen 0.
+
+planificar_peticiones convierte los huecos en el menor número de peticiones a IB: en barras
+cubre los huecos con ventanas de la duración máxima admitida (recubrimiento voraz, que es
+óptimo para ventanas de longitud fija); en ticks, una cadena de páginas por hueco.
+
+Uso (revisar un directorio del almacén):
+    python validacion.py E:/DATOSBOLSA/Bars1s/AAPL Bars1s --tipo stock
+'''
+
+import argparse
+import math
+from collections import namedtuple
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+import logging
+
+from almacen import list_downloaded_dates, read_session_df
+from bloques import TABLA_BARRAS, duracion_str
+from calendario import calendario_tipo
+
+logger = logging.getLogger("IBDownloader")
+
+
+# ----------------------------
+# CONFIGURACIÓN (TOP LEVEL)
+# ----------------------------
+# Segundos por barra: separación normal entre dos filas consecutivas
+PASO_BARRA_SG = {
+    "Bars1s": 1,
+    "Bars15m": 15 * 60,
+    "Bars1h": 60 * 60,
+}
+# barSizeSetting y duración máxima de una petición de relleno (segundos), de la tabla de bloques.py
+TAMAÑO_BARRA = {b: t.tamaño for b, t in TABLA_BARRAS.items()}
+VENTANA_MAX_SG = {b: t.max_sg for b, t in TABLA_BARRAS.items()}
+UMBRAL_HUECO_TICKS_SG = 120         # silencio entre ticks a partir del cual se considera hueco
+# Salto mínimo entre barras para contar como hueco. En Bars1s lo que falta por debajo son
+# segundos sin trades: un bloque perdido nunca es menor que el mínimo de bloques.py (60 s)
+HUECO_MIN_SG = {b: TABLA_BARRAS[b].min_sg for b in ("Bars1s",)}
+MIN_TRAMO_SIN_VOLUMEN = 300         # filas seguidas con volumen 0 que se informan
+RELLENAR_SIN_VOLUMEN = False        # pedir también los tramos sin volumen (IB a veces los da legítimos)
+NS = 1_000_000_000
+
+
+class Informe(namedtuple("Informe", ["filas", "huecos", "fuera_sesion", "duplicados", "sin_volumen"])):
+    """
+    Resultado de validar una sesión. huecos y sin_volumen son listas de (inicio, fin) UTC
+    (pd.Timestamp, intervalo semiabierto [inicio, fin)).
+    """
+    __slots__ = ()
+
+    @property
+    def correcta(self):
+        return not (self.huecos or self.fuera_sesion or self.duplicados)
+
+    def resumen(self):
+        falta = sum((f - i).total_seconds() for i, f in self.huecos)
+        return (f"{self.filas} filas, {len(self.huecos)} huecos ({falta:.0f} sg), "
+                f"{self.fuera_sesion} fuera de sesión, {self.duplicados} duplicados, "
+                f"{len(self.sin_volumen)} tramos sin volumen")
+
+
+Peticion = namedtuple("Peticion", ["inicio", "fin", "duracion", "tamaño"])
+
+
+def _ns(ts):
+    return pd.Timestamp(ts).tz_convert("UTC").value
+
+
+def _tramos(ns_inicio, ns_fin):
+    return [(pd.Timestamp(int(i), tz="UTC"), pd.Timestamp(int(f), tz="UTC"))
+            for i, f in zip(ns_inicio, ns_fin)]
+
+
+def _tramos_true(mascara, ns, paso_ns):
+    """Tramos de filas consecutivas con mascara True -> (inicio, fin) en ns."""
+    borde = np.diff(np.concatenate(([0], mascara.astype(np.int8), [0])))
+    inicios = np.flatnonzero(borde == 1)
+    fines = np.flatnonzero(borde == -1)
+    return inicios, fines, ns[inicios], ns[fines - 1] + paso_ns
+
+
+def validar_sesion(df, barra, session_start, session_end):
+    """Revisa la sesión df (time UTC) de la barra indicada contra [session_start, session_end)."""
+    inicio, fin = _ns(session_start), _ns(session_end)
+    if df is None or df.empty:
+        huecos = [] if barra == "BarsD" else _tramos([inicio], [fin])
+        return Informe(0, huecos, 0, 0, [])
+
+    ns = df["time"].astype("datetime64[ns, UTC]").array.asi8
+    dentro = (ns >= inicio) & (ns < fin)
+    fuera = int((~dentro).sum())
+    ns_ok = np.sort(ns[dentro])
+
+    es_ticks = barra not in PASO_BARRA_SG and barra != "BarsD"
+    duplicados = 0 if es_ticks else int(len(ns_ok) - len(np.unique(ns_ok)))
+
+    huecos = []
+    if barra != "BarsD":
+        paso = UMBRAL_HUECO_TICKS_SG * NS if es_ticks else PASO_BARRA_SG[barra] * NS
+        if len(ns_ok) == 0:
+            huecos = _tramos([inicio], [fin])
+        else:
+            unicos = np.unique(ns_ok)
+            # cada fila cubre [t, t + paso) en barras; en ticks se mira el silencio entre ticks
+            cubierto = 0 if es_ticks else paso
+            saltos = np.flatnonzero(np.diff(unicos) > paso)
+            ini = unicos[saltos] + cubierto
+            fi = unicos[saltos + 1]
+            if unicos[0] - inicio > (paso if es_ticks else 0):
+                ini, fi = np.concatenate(([inicio], ini)), np.concatenate(([unicos[0]], fi))
+            if fin - (unicos[-1] + cubierto) > (paso if es_ticks else 0):
+                ini, fi = np.concatenate((ini, [unicos[-1] + cubierto])), np.concatenate((fi, [fin]))
+            if barra in HUECO_MIN_SG:
+                largos = (fi - ini) >= HUECO_MIN_SG[barra] * NS
+                ini, fi = ini[largos], fi[largos]
+            huecos = _tramos(ini, fi)
+
+    sin_volumen = []
+    if "volume" in df.columns and barra in PASO_BARRA_SG:
+        orden = np.argsort(ns, kind="stable")
+        vol = df["volume"].to_numpy(np.float64)[orden][dentro[orden]]
+        i, f, ni, nf = _tramos_true(vol == 0, ns[orden][dentro[orden]], PASO_BARRA_SG[barra] * NS)
+        largos = (f - i) >= MIN_TRAMO_SIN_VOLUMEN
+        sin_volumen = _tramos(ni[largos], nf[largos])
+
+    return Informe(int(dentro.sum()), huecos, fuera, duplicados, sin_volumen)
+
+
+def limpiar_sesion(df, barra, session_start, session_end):
+    """Quita filas fuera de sesión y, en barras, timestamps duplicados (se queda la última)."""
+    if df is None or df.empty:
+        return df
+    t = df["time"]
+    df = df[(t >= pd.Timestamp(session_start)) & (t < pd.Timestamp(session_end))]
+    if barra in PASO_BARRA_SG or barra == "BarsD":
+        df = df.drop_duplicates("time", keep="last")
+    return df.sort_values("time", kind="stable").reset_index(drop=True)
+
+
+def planificar_peticiones(informe, barra):
+    """Menor conjunto de peticiones a IB que cubre los huecos del informe."""
+    tramos = list(informe.huecos)
+    if RELLENAR_SIN_VOLUMEN:
+        tramos += informe.sin_volumen
+    if not tramos:
+        return []
+    tramos.sort()
+
+    if barra not in VENTANA_MAX_SG:
+        # ticks: una cadena de páginas hacia atrás por hueco (reqHistoricalTicks no tiene duración)
+        return [Peticion(i, f, None, None) for i, f in tramos]
+
+    ventana = timedelta(seconds=VENTANA_MAX_SG[barra])
+    peticiones = []
+    i = 0
+    inicio = tramos[0][0]
+    while i < len(tramos):
+        inicio = max(inicio, tramos[i][0])
+        limite = inicio + ventana
+        fin = inicio
+        # todos los huecos que caben (enteros o el principio del que se sale) en esta ventana
+        while i < len(tramos) and tramos[i][0] < limite:
+            fin = max(fin, min(tramos[i][1], limite))
+            if tramos[i][1] > limite:
+                break
+            i += 1
+        segundos = math.ceil((fin - inicio).total_seconds())
+        peticiones.append(Peticion(inicio, inicio + timedelta(seconds=segundos),
+                                   duracion_str(segundos), TAMAÑO_BARRA[barra]))
+        inicio = fin
+    return peticiones
+
+
+def escanear(symbol_dir, barra, cal):
+    """Valida todas las sesiones guardadas en symbol_dir. Genera (fecha, informe)."""
+    for d in sorted(list_downloaded_dates(symbol_dir)):
+        sesion = cal.sesion(d)
+        if sesion is None:
+            continue
+        yield d, validar_sesion(read_session_df(symbol_dir, d), barra, *sesion)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Valida las sesiones guardadas de un activo")
+    parser.add_argument("directorio", help="directorio del activo (BASE_DIR/<barra>/<SYMBOL>)")
+    parser.add_argument("barra", choices=["Bars1s", "Bars15m", "Bars1h", "BarsD", "Tick2Tick"])
+    parser.add_argument("--tipo", default="stock", help="tipo de activo (calendario)")
+    args = parser.parse_args()
+
+    total = 0
+    for d, informe in escanear(args.directorio, args.barra, calendario_tipo(args.tipo)):
+        if informe.correcta and not informe.sin_volumen:
+            continue
+        peticiones = planificar_peticiones(informe, args.barra)
+        total += len(peticiones)
+        print(f"{d}: {informe.resumen()} -> {len(peticiones)} peticiones")
+    print(f"Total peticiones de relleno: {total}")
+
+
+if __name__ == "__main__":
+    main()